@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -84,6 +85,19 @@ DATABASES = {
 }
 
 
+# Sessions are read from the cache and written through to the DB, so authenticated requests
+# normally don't touch the sessions table.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# CachedModelBackend memoizes User rows per process; ModelBackend stays listed so sessions
+# created before the switch remain valid.
+AUTHENTICATION_BACKENDS = [
+    'downloader_ytdlp.auth_backends.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+AUTH_USER_CACHE_TTL = 30 # Seconds; also the upper bound for other processes to notice a changed user
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -155,5 +169,117 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Asia/Karachi'
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1 # Workers take one job at a time; ordering is decided by the fair-share dispatcher
+# KiB. After each task a prefork child whose peak RSS passed this is replaced before its next task (see memory.py)
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = int(os.environ.get('CELERY_WORKER_MAX_MEMORY_PER_CHILD', 1024 * 1024))
+# Redis priorities: 0 is served first. 'priority' ordering makes the worker always drain the lowest step first.
+# visibility_timeout: with late acks, an unacknowledged download is redelivered after this long, so it must
+# exceed the longest download or a healthy task gets a duplicate.
+CELERY_BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(10)), 'sep': ':', 'queue_order_strategy': 'priority', 'visibility_timeout': 12 * 60 * 60}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://192.168.18.90:6379/1',
+    }
+}
 
+# --- Logging ---
+# App and yt-dlp records go through a queue to a background thread (downloader_ytdlp.logs), so
+# writing to stdout never blocks a request or a download. Add fields with extra={...}.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text') # 'text' (key=value fields) or 'json' (one object per line)
+LOG_YTDLP_LEVEL = os.environ.get('LOG_YTDLP_LEVEL', 'WARNING') # INFO shows yt-dlp's status lines, DEBUG its debug output
+LOG_SAMPLE_EVERY = 20 # Noisy per-item messages (playlist entries, yt-dlp status lines) are logged once per this many
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {'()': 'downloader_ytdlp.logs.StructuredFormatter', 'json': LOG_FORMAT == 'json'},
+    },
+    'filters': {
+        'sampling': {'()': 'downloader_ytdlp.logs.SamplingFilter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'structured'},
+        'background': {'class': 'downloader_ytdlp.logs.BackgroundQueueHandler', 'handlers': ['console'], 'filters': ['sampling']},
+    },
+    'loggers': {
+        'downloader_ytdlp': {'handlers': ['background'], 'level': LOG_LEVEL, 'propagate': False},
+        'yt_dlp': {'handlers': ['background'], 'level': LOG_YTDLP_LEVEL, 'propagate': False},
+    },
+}
 
+# --- Download scheduling ---
+DOWNLOAD_SCHEDULER_BACKEND = 'redis' # 'redis' (shared by web + workers) or 'memory' (single process, dev only)
+DOWNLOAD_SCHEDULER_REDIS_URL = CELERY_BROKER_URL
+DOWNLOAD_PER_USER_RUNNING_CAP = 2 # Max jobs per user handed to the workers at once
+DOWNLOAD_MAX_IN_FLIGHT = int(os.environ.get('DOWNLOAD_MAX_IN_FLIGHT', os.cpu_count() or 4)) # Jobs in the broker or running, all users together: set to the total worker concurrency
+DOWNLOAD_SLOT_RECONCILE_INTERVAL = 60 # Seconds between checks for running slots that were never given back (scheduler.reconcile_running_slots)
+DOWNLOAD_SLOT_LEASE_SLACK = 60 * 60 # Broker wait allowed on top of a job's run time before its slot is freed regardless (e.g. the message was purged)
+DOWNLOAD_BATCH_MAX_ITEMS = 100 # Items accepted by POST /api/download/batch/
+DOWNLOAD_RESULT_CACHE_TIMEOUT = 24 * 60 * 60 # Identical requests (same video, format, clip range) reuse a finished download this long
+
+# Speculative prefetch (speculation.py): a format probe starts downloading the recommended format
+DOWNLOAD_SPECULATIVE_PREFETCH = os.environ.get('DOWNLOAD_SPECULATIVE_PREFETCH', '0') == '1' # Opt-in; clients can still skip it with "prefetch": false
+DOWNLOAD_SPECULATIVE_TIMEOUT = 120 # Seconds for a download request to adopt it before it is cancelled
+DOWNLOAD_SPECULATIVE_MAX_BYTES = 500 * 1024 ** 2 # Larger (or unknown size) downloads are not speculated on
+DOWNLOAD_SPECULATIVE_MAX_QUEUE_DEPTH = 10 # Only while no more jobs than this are waiting for a worker
+DOWNLOAD_SPECULATIVE_PRIORITY = 9 # Lowest; raised to the normal priority once adopted
+
+# Playlist browsing (POST /api/playlist/entries/)
+PLAYLIST_PAGE_SIZE = 50
+PLAYLIST_MAX_PAGE_SIZE = 200
+PLAYLIST_PAGE_CACHE_TIMEOUT = 15 * 60
+# Size-aware priorities (Celery priority, 0 = first). (tier, max estimated bytes, priority); None = no upper bound.
+DOWNLOAD_SIZE_TIERS = [
+    ('small', 50 * 1024 ** 2, 0),
+    ('medium', 500 * 1024 ** 2, 3),
+    ('large', 4 * 1024 ** 3, 6),
+    ('huge', None, 8),
+]
+DOWNLOAD_UNKNOWN_SIZE_PRIORITY = 4 # Single video that was never probed
+DOWNLOAD_PLAYLIST_PRIORITY = 9
+DOWNLOAD_PRIORITY_AGING_SECONDS = 300 # A waiting job moves up one priority step per interval
+
+# Retries: transient failures retry with exponential backoff, resuming partial files
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_RETRY_BACKOFF = 30 # Seconds before the first retry; doubles each attempt
+DOWNLOAD_RETRY_BACKOFF_MAX = 15 * 60
+
+# Stall watchdog (watchdog.py): a download below the minimum rate for a whole window is retried, then failed
+DOWNLOAD_STALL_WINDOW = 120 # Seconds
+DOWNLOAD_STALL_MIN_RATE = 20 * 1024 # Bytes/s
+DOWNLOAD_STALL_FRAGMENT_CONCURRENCY = 4 # Concurrent fragments tried on a stalled fragmented (HLS/DASH) download
+
+# Celery time limits per task, scaled with the estimated size (job_cost.time_limits)
+DOWNLOAD_TIME_LIMIT_BASE = 10 * 60 # Extraction and post-processing allowance; also the minimum
+DOWNLOAD_TIME_LIMIT_MIN_RATE = 256 * 1024 # Bytes/s the size is divided by
+DOWNLOAD_TIME_LIMIT_UNKNOWN_SIZE = 2 * 60 * 60
+DOWNLOAD_TIME_LIMIT_MAX = 11 * 60 * 60 # Playlists; stays below the broker's visibility_timeout
+DOWNLOAD_TIME_LIMIT_GRACE = 5 * 60 # Hard limit after the soft one, for the task to clean up
+
+# Admission control: submissions are refused (429/503 + Retry-After) instead of queued without bound
+DOWNLOAD_ADMISSION_MAX_QUEUE_DEPTH = 500 # Jobs waiting for a worker (fair-share pending + broker)
+DOWNLOAD_ADMISSION_MAX_ACTIVE = 100 # Downloads running on the workers
+DOWNLOAD_ADMISSION_MAX_OUTSTANDING_PER_USER = 50 # A user's unfinished jobs, including attached followers
+DOWNLOAD_ADMISSION_MIN_FREE_BYTES = 5 * 1024 ** 3 # Free space to keep under MEDIA_ROOT after the estimated job size
+DOWNLOAD_USER_QUOTA_BYTES = int(os.environ.get('DOWNLOAD_USER_QUOTA_BYTES', 50 * 1024 ** 3)) or None # Stored bytes per user (usage.py); 0 = no quota. Per-user override: UserStorageUsage.quota_bytes
+DOWNLOAD_ADMISSION_THROUGHPUT_WINDOW = 15 * 60 # Seconds of finished downloads used for ETA and Retry-After
+DOWNLOAD_ADMISSION_RETRY_AFTER_MIN = 5
+DOWNLOAD_ADMISSION_RETRY_AFTER_MAX = 10 * 60
+DOWNLOAD_ADMISSION_SNAPSHOT_TTL = 2 # Seconds the global load snapshot is shared between requests
+DOWNLOAD_ADMISSION_CHECK_BROKER = True # Count messages already in the broker queue
+
+# Where finished downloads live: 'local' (MEDIA_ROOT, served from MEDIA_URL) or 's3' (any S3-compatible
+# store; clients get presigned URLs). For a local MinIO: DOWNLOAD_S3_ENDPOINT_URL='http://localhost:9000'.
+DOWNLOAD_STORAGE_BACKEND = os.environ.get('DOWNLOAD_STORAGE_BACKEND', 'local')
+DOWNLOAD_S3_BUCKET = os.environ.get('DOWNLOAD_S3_BUCKET', '')
+DOWNLOAD_S3_ENDPOINT_URL = os.environ.get('DOWNLOAD_S3_ENDPOINT_URL') or None
+DOWNLOAD_S3_REGION = os.environ.get('DOWNLOAD_S3_REGION') or None
+DOWNLOAD_S3_ACCESS_KEY_ID = os.environ.get('DOWNLOAD_S3_ACCESS_KEY_ID') or None
+DOWNLOAD_S3_SECRET_ACCESS_KEY = os.environ.get('DOWNLOAD_S3_SECRET_ACCESS_KEY') or None
+DOWNLOAD_S3_PRESIGNED_URL_EXPIRY = 60 * 60
+DOWNLOAD_S3_MULTIPART_CHUNK_SIZE = 16 * 1024 ** 2
+DOWNLOAD_S3_UPLOAD_CONCURRENCY = 8 # Parts in flight per file
+DOWNLOAD_S3_KEEP_LOCAL_COPY = False # Remove the worker's copy once uploaded
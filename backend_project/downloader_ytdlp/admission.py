@@ -0,0 +1,168 @@
+# downloader_ytdlp/admission.py
+"""
+Admission control for download submissions.
+
+Before any DownloadLog is created, a submission is checked against the current
+load:
+- jobs waiting for a worker (the fair-share pending queue plus messages
+  already in the broker)
+- downloads running on the workers
+- free disk under MEDIA_ROOT
+- the user's own unfinished jobs
+- the storage quota of each user the files will belong to (usage.owner_id, the
+  user charge() bills), one lookup of their usage counters
+
+When the system is full the answer is 503, and when a user is over their
+allowance it is 429. Both carry a Retry-After computed from recent throughput
+(DownloadLogs finished per second), so clients back off and the queue stays
+bounded. The same throughput gives the ETA returned with every accepted
+submission.
+
+A user whose storage quota is used up gets 507; only deleting downloads helps
+there (DELETE /api/download/<log_id>/files/).
+
+The global figures are shared between requests for
+DOWNLOAD_ADMISSION_SNAPSHOT_TTL seconds, so a burst of submissions does not
+become a burst of broker and DB round trips.
+"""
+import logging
+import math
+import os
+import shutil
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import DownloadLog, UserStorageUsage
+from .scheduler import get_dispatcher
+from .usage import owner_id, quota_for
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = 'admission:snapshot'
+RUNNING_STATUSES = ('STARTED', 'DOWNLOADING', 'VERIFYING', 'RETRYING')
+OUTSTANDING_STATUSES = ('PENDING', 'ATTACHED', 'LINKING') + RUNNING_STATUSES # LINKING: a follower receiving its leader's files
+
+
+def broker_queue_depth():
+    """Messages waiting in the default Celery queue, across all priority levels (passive queue_declare)."""
+    from celery import current_app
+    with current_app.connection_for_read() as conn:
+        conn.ensure_connection(max_retries=1)
+        return conn.default_channel.queue_declare(queue=current_app.conf.task_default_queue, passive=True).message_count
+
+
+def free_disk_bytes():
+    path = str(settings.MEDIA_ROOT)
+    while not os.path.exists(path) and os.path.dirname(path) != path: # MEDIA_ROOT is created by the first download
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def take_snapshot():
+    window = settings.DOWNLOAD_ADMISSION_THROUGHPUT_WINDOW
+    counts = DownloadLog.objects.aggregate(
+        active=Count('id', filter=Q(status__in=RUNNING_STATUSES)),
+        # Followers never occupied a worker and cancelled jobs mostly never ran, so neither counts towards throughput
+        finished=Count('id', filter=Q(finished_at__gte=timezone.now() - timedelta(seconds=window), leader__isnull=True) & ~Q(status='CANCELLED')),
+    )
+    queue_depth = get_dispatcher().store.pending_count()
+    if settings.DOWNLOAD_ADMISSION_CHECK_BROKER:
+        try: queue_depth += broker_queue_depth()
+        except Exception as e: logger.warning("Could not read broker queue depth: %s", e)
+    return {'queue_depth': queue_depth, 'active': counts['active'], 'throughput': counts['finished'] / window, 'free_bytes': free_disk_bytes()}
+
+
+def get_snapshot():
+    """Current global load, or None when it cannot be determined (admission then fails open)."""
+    try:
+        snapshot = cache.get(SNAPSHOT_KEY)
+        if snapshot is None:
+            snapshot = take_snapshot()
+            cache.set(SNAPSHOT_KEY, snapshot, settings.DOWNLOAD_ADMISSION_SNAPSHOT_TTL)
+        return snapshot
+    except Exception as e:
+        logger.warning("Admission snapshot unavailable, admitting without global checks: %s", e)
+        return None
+
+
+def retry_after(excess_jobs, throughput):
+    """Seconds for `excess_jobs` jobs to drain at `throughput` jobs/s, clamped to the configured range."""
+    low, high = settings.DOWNLOAD_ADMISSION_RETRY_AFTER_MIN, settings.DOWNLOAD_ADMISSION_RETRY_AFTER_MAX
+    if not throughput:
+        return high
+    return max(low, min(high, math.ceil(excess_jobs / throughput)))
+
+
+def eta_seconds(snapshot, position=1):
+    """
+    Rough seconds until a job admitted now finishes, as if the queue were FIFO: the
+    running and queued jobs ahead of it, then the job itself, at the recent rate.
+    Fair-share dispatch usually does better for users with little queued. None when unknown.
+    """
+    if not snapshot or not snapshot['throughput']:
+        return None
+    return math.ceil((snapshot['active'] + snapshot['queue_depth'] + position) / snapshot['throughput'])
+
+
+def admit(user, log_entries):
+    """
+    Decide how many of log_entries (unsaved, in submission order) may be queued.
+    Returns (admitted, refusal, snapshot): the first `admitted` entries may go ahead;
+    refusal is None, or {'status', 'error', 'retry_after'} explaining why the rest may not.
+    """
+    wanted = len(log_entries)
+    limits = [] # (entries that still fit, refusal)
+
+    window = settings.DOWNLOAD_ADMISSION_THROUGHPUT_WINDOW
+    mine = DownloadLog.objects.filter(user=user, speculative=False).aggregate(
+        outstanding=Count('id', filter=Q(status__in=OUTSTANDING_STATUSES)),
+        finished=Count('id', filter=Q(finished_at__gte=timezone.now() - timedelta(seconds=window))),
+    )
+    room = settings.DOWNLOAD_ADMISSION_MAX_OUTSTANDING_PER_USER - mine['outstanding']
+    limits.append((room, {
+        'status': 429, 'error': f"At most {settings.DOWNLOAD_ADMISSION_MAX_OUTSTANDING_PER_USER} unfinished downloads per user ({mine['outstanding']} now); wait for some to finish.",
+        'retry_after': retry_after(max(1, 1 - room), mine['finished'] / window),
+    }))
+
+    # Each entry counts against its owner's quota; the first entry an owner cannot fit ends the run
+    owners = {owner_id(log_entry) for log_entry in log_entries}
+    usages = {usage.user_id: usage for usage in UserStorageUsage.objects.filter(user_id__in=owners)}
+    spare, room, full = {}, 0, None
+    for log_entry in log_entries:
+        owner = owner_id(log_entry); usage = usages.get(owner); quota = quota_for(usage)
+        if quota is None:
+            room += 1; continue
+        used = usage.bytes_used if usage else 0
+        spare[owner] = spare.get(owner, quota - used) - (log_entry.estimated_bytes or 0)
+        if spare[owner] < 0:
+            full = (used, quota); break
+        room += 1
+    if full is not None:
+        used, quota = full
+        limits.append((room, {'status': 507, 'error': f"Storage quota used up ({used // 1024 ** 2} of {quota // 1024 ** 2} MiB); delete some downloads first.", 'retry_after': settings.DOWNLOAD_ADMISSION_RETRY_AFTER_MAX}))
+
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        rate = snapshot['throughput']
+        room = settings.DOWNLOAD_ADMISSION_MAX_QUEUE_DEPTH - snapshot['queue_depth']
+        limits.append((room, {'status': 503, 'error': 'The download queue is full, try again later.', 'retry_after': retry_after(max(1, 1 - room), rate)}))
+        room = settings.DOWNLOAD_ADMISSION_MAX_ACTIVE - snapshot['active']
+        limits.append((wanted if room > 0 else 0, {'status': 503, 'error': 'Too many downloads are running, try again later.', 'retry_after': retry_after(max(1, 1 - room), rate)}))
+
+        # Finished jobs do not give disk space back, so there is no rate to derive a retry from
+        spare, room = snapshot['free_bytes'] - settings.DOWNLOAD_ADMISSION_MIN_FREE_BYTES, 0
+        for log_entry in log_entries:
+            spare -= log_entry.estimated_bytes or 0
+            if spare < 0: break
+            room += 1
+        limits.append((room, {'status': 503, 'error': 'The server is low on disk space, try again later.', 'retry_after': settings.DOWNLOAD_ADMISSION_RETRY_AFTER_MAX}))
+
+    room, refusal = min(limits, key=lambda limit: limit[0])
+    if room >= wanted:
+        return wanted, None, snapshot
+    logger.info("Admission limited: %s", refusal['error'], extra={'user': user.username, 'submitted': wanted, 'admitted': max(0, room), 'status': refusal['status']})
+    return max(0, room), refusal, snapshot
@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class DownloaderConfig(AppConfig): # Make sure this class name is correct
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'downloader_ytdlp' # <---- CHANGE THIS LINE
\ No newline at end of file
+    name = 'downloader_ytdlp' # <---- CHANGE THIS LINE
+
+    def ready(self):
+        from . import auth_backends # noqa: F401 -- connects the user-cache invalidation signals
\ No newline at end of file
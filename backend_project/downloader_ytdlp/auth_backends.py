@@ -0,0 +1,61 @@
+# downloader_ytdlp/auth_backends.py
+"""
+Authentication backend with a short-lived, per-process User cache.
+
+Every authenticated request (the 4-second status polls especially) resolves
+request.user from the session. With the cached_db session engine the session
+itself comes from the cache; this backend removes the remaining User query by
+memoizing users for AUTH_USER_CACHE_TTL seconds. Entries are dropped on logout
+and whenever a User is saved or deleted in this process; other processes pick
+up changes when the TTL runs out, which is why it is kept short.
+"""
+import copy
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+_lock = threading.Lock()
+_users = {} # user_id -> (expires_at, User)
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        now = time.monotonic()
+        with _lock:
+            cached = _users.get(user_id)
+        if cached and cached[0] > now:
+            return copy.copy(cached[1]) # Requests must not share (and mutate) one instance
+        user = super().get_user(user_id)
+        if user is not None:
+            with _lock:
+                _users[user_id] = (now + settings.AUTH_USER_CACHE_TTL, copy.copy(user)) # Nor share the first one
+        return user
+
+
+def invalidate_user(user_id):
+    with _lock:
+        # Session data stores the pk as a string; model instances carry the int
+        _users.pop(user_id, None); _users.pop(str(user_id), None)
+
+
+def clear_user_cache():
+    with _lock:
+        _users.clear()
+
+
+@receiver(user_logged_out)
+def _forget_logged_out_user(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_user(user.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _forget_changed_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
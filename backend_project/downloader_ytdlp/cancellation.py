@@ -0,0 +1,180 @@
+# downloader_ytdlp/cancellation.py
+"""
+Cancelling downloads (POST /api/download/<log_id>/cancel/).
+
+What happens depends on where the job is:
+- waiting in the fair-share queue: it is taken out and never reaches a worker
+- published to Celery but not started, or waiting to retry: the task is revoked,
+  so the worker drops the message (the task_revoked handler frees its slot)
+- running: a flag is set in the cache. download_video_task's CancelWatch looks at
+  it at most once per CANCEL_POLL_INTERVAL, from the progress hook (which then
+  aborts yt-dlp) and from a watcher thread that terminates the task's ffmpeg
+  processes, since merging and conversion report no progress. The task removes
+  its partial files and marks the log CANCELLED itself.
+  The same watch enforces the task's soft time limit (deadline): past it, the
+  hook raises DownloadCancelled and the thread stops ffmpeg, because yt-dlp
+  swallows Celery's SoftTimeLimitExceeded like any other error in playlists.
+- an attached follower: it is detached; the leader carries on for the others.
+
+Followers of a cancelled leader are handed over as if the leader had failed -
+straight away when it never left the fair-share queue, otherwise once a worker
+confirms it has stopped (the task_revoked handler, or the task itself), so a
+promoted follower never downloads alongside it.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import DownloadLog
+from .scheduler import get_dispatcher
+from .singleflight import ACTIVE_LEADER_STATUSES, notify_followers
+from .ytdl import get_yt_dlp
+
+logger = logging.getLogger(__name__)
+
+CANCELLABLE_STATUSES = ('ATTACHED',) + ACTIVE_LEADER_STATUSES
+CANCEL_FLAG_TIMEOUT = 12 * 60 * 60 # Outlives any download (the broker's visibility timeout)
+CANCEL_POLL_INTERVAL = 1.0 # Seconds between cache lookups while a download runs
+CHILD_PROCESS_NAMES = ('ffmpeg', 'ffprobe')
+
+
+def _flag_key(task_id):
+    return 'cancel:' + task_id
+
+
+def cancel_requested(task_id):
+    try:
+        return bool(cache.get(_flag_key(task_id)))
+    except Exception as e:
+        logger.warning("Cancellation flags unavailable: %s", e)
+        return False
+
+
+def revoke_task(task_id):
+    """Tell the workers to drop this task's message if it has not started (or comes back for a retry)."""
+    from celery import current_app
+    try:
+        current_app.control.revoke(task_id)
+    except Exception as e: # The flag still stops the task once it runs
+        logger.warning("Could not revoke task: %s", e, extra={'task_id': task_id})
+
+
+def mark_cancelled(log_entry):
+    """Record the cancellation unless the log already finished. Returns True when it was marked."""
+    now = timezone.now()
+    reason = 'Speculative download not needed' if log_entry.speculative else 'Cancelled by user'
+    marked = DownloadLog.objects.filter(id=log_entry.id, status__in=CANCELLABLE_STATUSES).update(
+        status='CANCELLED', error_message=reason, finished_at=now, updated_at=now) == 1
+    if marked:
+        log_entry.status, log_entry.error_message, log_entry.finished_at = 'CANCELLED', reason, now
+    return marked
+
+
+def request_cancellation(log_entry):
+    """
+    Cancel log_entry wherever it is. Returns its status afterwards: 'CANCELLED', an
+    active status while the worker still has to stop it, or the final status if it
+    finished first.
+    """
+    if log_entry.status == 'ATTACHED':
+        if not mark_cancelled(log_entry):
+            log_entry.refresh_from_db(fields=['status'])
+        return log_entry.status
+
+    cache.set(_flag_key(log_entry.task_id), 1, CANCEL_FLAG_TIMEOUT) # Raises when the cache is down: a running task could not be stopped
+    dequeued = get_dispatcher().cancel(log_entry.task_id)
+    if not dequeued:
+        revoke_task(log_entry.task_id)
+    if dequeued or log_entry.status in ('PENDING', 'RETRYING'):
+        # Not on a worker right now. If a worker picks it up regardless, the flag stops it before it downloads.
+        if mark_cancelled(log_entry):
+            if dequeued: # Never reached a worker: hand over to the followers now
+                notify_followers(log_entry)
+            # Otherwise a worker may have taken it already (the log says PENDING until the task starts), and a
+            # promoted follower would download alongside it: the worker hands over once it has stopped
+        else:
+            log_entry.refresh_from_db(fields=['status'])
+        logger.info("Download cancelled before it ran", extra={'log_id': log_entry.id, 'task_id': log_entry.task_id})
+        return log_entry.status
+    logger.info("Cancellation requested for running download", extra={'log_id': log_entry.id, 'task_id': log_entry.task_id})
+    return log_entry.status
+
+
+def child_processes(names):
+    """PIDs of this process's children running one of `names` (from /proc; none where there is no /proc)."""
+    me = os.getpid(); found = []
+    try: entries = os.listdir('/proc')
+    except OSError: return found
+    for entry in entries:
+        if not entry.isdigit(): continue
+        try:
+            with open(f'/proc/{entry}/stat') as f: stat = f.read()
+        except OSError: continue # Exited meanwhile
+        # "pid (comm) state ppid ...": comm may itself contain spaces and parentheses
+        comm, rest = stat[stat.index('(') + 1:stat.rindex(')')], stat[stat.rindex(')') + 2:].split()
+        if int(rest[1]) == me and comm in names:
+            found.append(int(entry))
+    return found
+
+
+class CancelWatch:
+    """
+    Cancellation check for one task run. check() is cheap enough for the progress
+    hook; while started, a thread also polls and terminates the task's ffmpeg
+    processes (SIGTERM, then SIGKILL if one is still there on the next poll).
+    deadline is a time.monotonic() value past which the run is stopped the same way.
+    """
+    def __init__(self, task_id, interval=CANCEL_POLL_INTERVAL, deadline=None):
+        self.task_id = task_id
+        self.interval = interval
+        self.deadline = deadline
+        self.cancelled = False
+        self._checked_at = None
+        self._stopping = threading.Event()
+        self._thread = None
+        self._terminated = set()
+
+    def check(self, force=False):
+        if not self.cancelled and (force or self._checked_at is None or time.monotonic() - self._checked_at >= self.interval):
+            self._checked_at = time.monotonic()
+            self.cancelled = cancel_requested(self.task_id)
+        return self.cancelled
+
+    def timed_out(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def raise_if_cancelled(self):
+        """For the progress hook: yt-dlp lets DownloadCancelled through even with ignoreerrors."""
+        if self.check():
+            raise get_yt_dlp().utils.DownloadCancelled('Cancelled by user')
+        if self.timed_out():
+            raise get_yt_dlp().utils.DownloadCancelled('Time limit exceeded')
+
+    def kill_children(self):
+        for pid in child_processes(CHILD_PROCESS_NAMES):
+            try:
+                os.kill(pid, signal.SIGKILL if pid in self._terminated else signal.SIGTERM)
+                self._terminated.add(pid)
+                logger.info("Stopped child process %d", pid, extra={'task_id': self.task_id})
+            except ProcessLookupError:
+                pass
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval):
+            if self.check() or self.timed_out():
+                self.kill_children() # Keeps going: the next post-processor may start another one
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name=f'cancel-watch-{self.task_id}', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,167 @@
+# downloader_ytdlp/job_cost.py
+"""
+Job cost estimation for size-aware scheduling.
+
+get_available_formats already sees every format's filesize and the media
+duration; a compact summary of that probe is cached per URL so that the
+download request that follows can be given an estimated size, a size tier and
+a Celery priority without probing again. The same summary drives budget format
+selection: the best format code that fits a target file size or bitrate.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+PROBE_CACHE_TIMEOUT = 60 * 60 # Seconds a probe summary stays usable for dispatch
+
+# Rough bytes/second used when a format has no size information but the duration is known
+FALLBACK_VIDEO_BYTES_PER_SEC = 5_000_000 // 8
+FALLBACK_AUDIO_BYTES_PER_SEC = 160_000 // 8
+
+
+def _probe_key(url):
+    return 'probe:' + hashlib.sha1(url.encode()).hexdigest()
+
+
+def _format_size(f, duration):
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = f['tbr'] * 1000 / 8 * duration # tbr is in kbit/s
+    return int(size) if size else None
+
+
+def remember_probe(url, info_dict):
+    """Cache what the dispatcher needs from a probe: per-format sizes, bitrates and the duration."""
+    duration = info_dict.get('duration')
+    sizes, formats, best_video, best_audio = {}, [], None, None
+    for f in info_dict.get('formats') or []:
+        size = _format_size(f, duration)
+        if not f.get('format_id'):
+            continue
+        has_video, has_audio = f.get('vcodec') not in (None, 'none'), f.get('acodec') not in (None, 'none')
+        tbr = f.get('tbr') or (size * 8 / 1000 / duration if size and duration else None)
+        if has_video or has_audio:
+            formats.append({'id': f['format_id'], 'video': has_video, 'audio': has_audio, 'size': size, 'tbr': tbr, 'height': f.get('height')})
+        if not size:
+            continue
+        sizes[f['format_id']] = size
+        if f.get('vcodec', 'none') != 'none':
+            best_video = max(best_video or 0, size)
+        elif f.get('acodec', 'none') != 'none':
+            best_audio = max(best_audio or 0, size)
+    summary = {
+        'id': info_dict.get('id'), 'extractor_key': info_dict.get('extractor_key'),
+        'duration': duration, 'sizes': sizes, 'best_video': best_video, 'best_audio': best_audio, 'formats': formats,
+    }
+    try:
+        cache.set(_probe_key(url), summary, PROBE_CACHE_TIMEOUT)
+    except Exception as e: # The summary is still usable by the caller
+        logger.warning("Could not cache probe: %s", e, extra={'url': url})
+    return summary
+
+
+def get_probe(url):
+    try:
+        return cache.get(_probe_key(url))
+    except Exception as e: # A cache outage must not block downloads
+        logger.warning("Probe cache unavailable: %s", e)
+        return None
+
+
+def clip_share(duration, clip_start=None, clip_end=None):
+    """Fraction of the media a clip covers (1.0 for the whole thing or an unknown duration)."""
+    if not duration or (clip_start is None and clip_end is None):
+        return 1.0
+    section = min(clip_end if clip_end is not None else duration, duration) - (clip_start or 0)
+    return max(0.0, section) / duration
+
+
+def estimate_job_bytes(url, format_code, format_type, is_playlist, clip_start=None, clip_end=None):
+    """Estimated download size in bytes, or None when there is nothing to go on. Clips count their share of the duration."""
+    if is_playlist:
+        return None
+    probe = get_probe(url)
+    if not probe:
+        return None
+    # Only the first alternative of a selector like 'bestvideo[ext=mp4]+bestaudio/best' matters
+    selector = format_code.split('_convert_')[0].split('/')[0]
+    total = 0
+    for part in selector.split('+'):
+        size = probe['sizes'].get(part)
+        if size is None and part.startswith('bestaudio'):
+            size = probe['best_audio']
+        elif size is None and (part.startswith('bestvideo') or part.startswith('best')):
+            size = probe['best_video']
+        if size is None:
+            total = None
+            break
+        total += size
+    if total is None and probe.get('duration'):
+        rate = FALLBACK_VIDEO_BYTES_PER_SEC if format_type == 'video' else FALLBACK_AUDIO_BYTES_PER_SEC
+        total = int(probe['duration'] * rate)
+    if total:
+        total = int(total * clip_share(probe.get('duration'), clip_start, clip_end))
+    return total
+
+
+def pick_budget_format(probe, format_type, max_bytes=None, max_kbps=None, share=1.0):
+    """
+    Best format code within a size and/or bitrate budget: a progressive format or a
+    video-only + audio-only pair for video, an audio-only format for audio. Formats whose
+    size (or bitrate) is unknown cannot be shown to fit and are skipped. `share` scales
+    sizes for clips. Returns (format_code, estimated_bytes), or None when nothing fits.
+    """
+    formats = probe.get('formats') or []
+    if format_type == 'audio':
+        combos = [[f] for f in formats if f['audio'] and not f['video']]
+    else:
+        video_only = [f for f in formats if f['video'] and not f['audio']]
+        audio_only = [f for f in formats if f['audio'] and not f['video']]
+        combos = [[f] for f in formats if f['video'] and f['audio']] + [[v, a] for v in video_only for a in audio_only]
+    best = None
+    for combo in combos:
+        sizes, rates = [f['size'] for f in combo], [f['tbr'] for f in combo]
+        size = None if None in sizes else int(sum(sizes) * share)
+        kbps = None if None in rates else sum(rates)
+        if max_bytes is not None and (size is None or size > max_bytes):
+            continue
+        if max_kbps is not None and (kbps is None or kbps > max_kbps):
+            continue
+        quality = (max(f['height'] or 0 for f in combo), kbps or 0, size or 0) # Resolution first, then bitrate
+        if best is None or quality > best[0]:
+            best = (quality, combo, size)
+    if best is None:
+        return None
+    return '+'.join(f['id'] for f in best[1]), best[2]
+
+
+def time_limits(estimated_bytes, is_playlist):
+    """
+    (soft, hard) Celery time limits in seconds: the estimated size at the slowest acceptable
+    rate plus a fixed allowance for extraction and post-processing. Playlists get the maximum.
+    """
+    if is_playlist:
+        soft = settings.DOWNLOAD_TIME_LIMIT_MAX
+    elif estimated_bytes is None:
+        soft = settings.DOWNLOAD_TIME_LIMIT_UNKNOWN_SIZE
+    else:
+        soft = settings.DOWNLOAD_TIME_LIMIT_BASE + estimated_bytes / settings.DOWNLOAD_TIME_LIMIT_MIN_RATE
+    soft = int(min(max(soft, settings.DOWNLOAD_TIME_LIMIT_BASE), settings.DOWNLOAD_TIME_LIMIT_MAX))
+    return soft, soft + settings.DOWNLOAD_TIME_LIMIT_GRACE
+
+
+def classify_job(estimated_bytes, is_playlist):
+    """Map an estimate to (size_tier, celery_priority). Lower priority numbers run first."""
+    if is_playlist:
+        return 'playlist', settings.DOWNLOAD_PLAYLIST_PRIORITY
+    if estimated_bytes is None:
+        return 'unknown', settings.DOWNLOAD_UNKNOWN_SIZE_PRIORITY
+    for tier, max_bytes, priority in settings.DOWNLOAD_SIZE_TIERS:
+        if max_bytes is None or estimated_bytes <= max_bytes:
+            return tier, priority
+    return settings.DOWNLOAD_SIZE_TIERS[-1][0], settings.DOWNLOAD_SIZE_TIERS[-1][2]
+
@@ -0,0 +1,158 @@
+# downloader_ytdlp/logs.py
+"""
+Logging plumbing for the request and task hot paths (wired up by LOGGING in settings).
+
+- BackgroundQueueHandler: emit() only puts the record on an in-memory queue; a
+  listener thread formats and writes it, so a slow stdout (a pipe to the
+  container runtime, a full terminal) never stalls a request or a download.
+- SamplingFilter: records logged with extra={'sample': N} pass once every N
+  times per message, so per-item chatter (playlist entries, yt-dlp status lines)
+  stays visible without flooding. Warnings and errors always pass.
+- StructuredFormatter: one line per record, with the `extra` fields appended as
+  key=value pairs, or one JSON object per line with LOG_FORMAT=json.
+- FieldsAdapter: binds fields (task_id, log_id) to every record of one task run.
+- YtDlpLogger: the 'logger' option for yt-dlp, so its output goes through the
+  above at the proper level instead of straight to stdout.
+
+Nothing here imports Django: settings load this module while configuring logging.
+"""
+import atexit
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+# Attributes every LogRecord has; anything else on a record came in through `extra`
+RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName', 'sample_key'}
+
+
+def record_fields(record):
+    return {k: v for k, v in vars(record).items() if k not in RESERVED_ATTRS and not k.startswith('_')}
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json=False, **kwargs):
+        kwargs.setdefault('fmt', '%(asctime)s %(levelname)s %(name)s: %(message)s')
+        super().__init__(**kwargs)
+        self.as_json = json
+
+    def format(self, record):
+        record.message = record.getMessage()
+        fields = record_fields(record)
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if self.as_json:
+            entry = {'ts': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'msg': record.message, **fields}
+            if exc_text: entry['exc'] = exc_text
+            return json.dumps(entry, default=str)
+        if self.usesTime(): record.asctime = self.formatTime(record, self.datefmt)
+        line = self.formatMessage(record)
+        if fields: line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        if exc_text: line += '\n' + exc_text
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Pass 1 in `sample` records per logger and message template (or `sample_key` when
+    the message text varies); records without `sample` always pass.
+    """
+    def __init__(self, name=''):
+        super().__init__(name)
+        self.counters = {}
+
+    def filter(self, record):
+        every = getattr(record, 'sample', None)
+        if not every or every <= 1 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, getattr(record, 'sample_key', record.msg))
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters.setdefault(key, itertools.count())
+        return next(counter) % every == 0
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler whose listener (built by dictConfig from the 'handlers' key) is started
+    lazily in every process that logs. A forked child (Celery prefork pool, gunicorn
+    --preload) gets a fresh queue and listener instead of the parent's dead thread.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self._pid = None # Process whose listener thread is running
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def _start_listener(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None: # Forked: the inherited queue may hold a lock taken by a thread that no longer exists
+                self.queue = queue.Queue()
+                self.listener = logging.handlers.QueueListener(self.queue, *self.listener.handlers, respect_handler_level=self.listener.respect_handler_level)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Write out what is still queued and stop this process's listener thread (run at exit)."""
+        with self._lock:
+            if self._pid == os.getpid():
+                self.listener.stop()
+                self._pid = None # Restarted by the next emit()
+
+    def prepare(self, record):
+        # Merge the arguments now (they may change after the call returns) but leave
+        # formatting, including the traceback layout, to the target handler's formatter.
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid() and self.listener is not None:
+            self._start_listener()
+        super().emit(record)
+
+
+class FieldsAdapter(logging.LoggerAdapter):
+    """LoggerAdapter whose fields are merged with a call's own extra= (a plain LoggerAdapter drops those before 3.13)."""
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return msg, kwargs
+
+
+class YtDlpLogger:
+    """
+    yt-dlp 'logger' option. yt-dlp sends its screen output to debug(); only lines
+    tagged '[debug] ' are real debug output, the rest is status and logged at INFO,
+    sampled per '[extractor]'/'[download]' tag, since a playlist produces several
+    lines per entry.
+    """
+    logger = logging.getLogger('yt_dlp')
+
+    def __init__(self, sample=1, **fields):
+        self.fields = fields
+        self.sample = sample
+
+    def debug(self, msg):
+        if msg.startswith('[debug] '):
+            self.logger.debug(msg[8:], extra=self.fields)
+        else:
+            self.info(msg)
+
+    def info(self, msg):
+        self.logger.info(msg, extra={**self.fields, 'sample': self.sample, 'sample_key': msg.split(' ', 1)[0]})
+
+    def warning(self, msg):
+        self.logger.warning(msg, extra=self.fields)
+
+    def error(self, msg):
+        self.logger.error(msg, extra=self.fields)
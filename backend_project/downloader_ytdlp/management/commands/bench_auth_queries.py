@@ -0,0 +1,60 @@
+# downloader_ytdlp/management/commands/bench_auth_queries.py
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+
+from downloader_ytdlp.auth_backends import clear_user_cache
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+CONFIGS = {
+    'db sessions + ModelBackend (before)': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'AUTHENTICATION_BACKENDS': ['django.contrib.auth.backends.ModelBackend'],
+    },
+    'cached_db sessions + CachedModelBackend (current)': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db',
+        'AUTHENTICATION_BACKENDS': ['downloader_ytdlp.auth_backends.CachedModelBackend'],
+    },
+}
+ENDPOINTS = ['/api/auth/status/', '/api/forum/topics/']
+
+
+class Command(BaseCommand):
+    help = "Compare DB queries and latency per authenticated request for the old and the cached session/auth setup (runs on a throwaway test DB)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and configuration.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            User.objects.create_user('bench', password='bench-password')
+            for label, overrides in CONFIGS.items():
+                with override_settings(CACHES=LOCMEM_CACHE, **overrides):
+                    self.run_config(label, options['requests'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run_config(self, label, n):
+        clear_user_cache()
+        client = Client()
+        client.post('/api/auth/login/', {'username': 'bench', 'password': 'bench-password'}, content_type='application/json')
+        self.stdout.write(label)
+        for endpoint in ENDPOINTS:
+            client.get(endpoint) # Warm caches, as a logged-in browser would have
+            queries, timings = [], []
+            for _ in range(n):
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    response = client.get(endpoint)
+                    timings.append(time.perf_counter() - start)
+                queries.append(len(ctx.captured_queries))
+            self.stdout.write(f"  {endpoint:<22} status {response.status_code}  queries/request {statistics.mean(queries):5.2f}  median {statistics.median(timings) * 1000:6.2f} ms")
@@ -0,0 +1,123 @@
+# downloader_ytdlp/management/commands/bench_probe_logging.py
+import contextlib
+import io
+import logging
+import pprint
+import statistics
+import subprocess
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from downloader_ytdlp import views
+
+
+def youtube_like_info(n_formats=30, n_caption_languages=150):
+    """Synthetic info dict shaped like a YouTube extraction: signed URLs everywhere, auto-captions in every language."""
+    url = 'https://rr3---sn-bench.googlevideo.com/videoplayback?' + '&'.join(f'p{i}=' + 'x' * 24 for i in range(40))
+    headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0', 'Accept': '*/*', 'Accept-Language': 'en-us,en;q=0.5'}
+    formats = []
+    for i in range(n_formats):
+        video = i % 3 != 0; height = 144 * (1 + i % 6)
+        formats.append({
+            'format_id': str(100 + i), 'format_note': f'{height}p' if video else 'medium', 'ext': 'mp4' if video else 'm4a', 'protocol': 'https', 'url': url,
+            'vcodec': 'avc1.4d401f' if video else 'none', 'acodec': 'none' if video else 'mp4a.40.2', 'height': height if video else None, 'width': height * 16 // 9 if video else None,
+            'fps': 30 if video else None, 'tbr': height * 5 if video else 128, 'filesize': height * 400_000 if video else 9_600_000,
+            'http_headers': headers, 'downloader_options': {'http_chunk_size': 10485760}, 'quality': i, 'has_drm': False,
+        })
+    captions = {f'l{i:03}': [{'ext': ext, 'url': url, 'name': f'Language {i}'} for ext in ('json3', 'srv1', 'srv2', 'srv3', 'ttml', 'vtt')] for i in range(n_caption_languages)}
+    return {
+        'id': 'bench000001', 'title': 'Benchmark video', 'description': 'Lorem ipsum dolor sit amet. ' * 150, 'duration': 600, 'extractor_key': 'Youtube',
+        'webpage_url': 'https://www.youtube.com/watch?v=bench000001', 'formats': formats, 'automatic_captions': captions, 'subtitles': {},
+        'thumbnails': [{'url': url[:300], 'preference': -i, 'id': str(i)} for i in range(40)], 'tags': [f'tag{i}' for i in range(30)],
+    }
+
+
+class StubYoutubeDL:
+    info = None
+    legacy_output = False # Also do what get_available_formats printed before structured logging
+
+    def __init__(self, opts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        info = dict(self.info, webpage_url=url)
+        if self.legacy_output:
+            print(f"Fetching formats for URL: {url}")
+            print(f"--- INFO DICT for {url} (get_available_formats) ---"); pprint.pprint(info)
+            print(f"--- RAW FORMATS COUNT from yt-dlp: {len(info['formats'])} ---")
+            print("--- FIRST RAW FORMAT EXAMPLE: ---"); pprint.pprint(info['formats'][0])
+        return info
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the latency logging adds to format probes (POST /api/formats/) with a stubbed, instant yt-dlp: "
+        "the old print/pprint output against structured logging, written synchronously or through the background queue. "
+        "Output goes to a pipe drained by another process, as stdout is under a container runtime or process manager."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--formats', type=int, default=30, help='Formats in the synthetic info dict.')
+        parser.add_argument('--sink', choices=('pipe', 'devnull'), default='pipe', help="Where output goes; 'devnull' leaves only the formatting cost.")
+
+    def handle(self, *args, **options):
+        StubYoutubeDL.info = youtube_like_info(options['formats'])
+        self.stdout.write(f"Info dict: {len(StubYoutubeDL.info['formats'])} formats, {len(pprint.pformat(StubYoutubeDL.info)) // 1024} KB pretty-printed")
+
+        if options['sink'] == 'pipe':
+            consumer = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            sink = io.TextIOWrapper(consumer.stdin, encoding='utf-8', line_buffering=True) # Like PYTHONUNBUFFERED=1 in a container
+        else:
+            consumer = None; sink = open('/dev/null', 'w')
+
+        app_logger = logging.getLogger('downloader_ytdlp')
+        console, background = logging.getHandlerByName('console'), logging.getHandlerByName('background')
+        old_stream = console.setStream(sink)
+        factory = APIRequestFactory(); user = User(username='bench')
+
+        def probe():
+            request = factory.post('/api/formats/', {'url': 'https://www.youtube.com/watch?v=bench000001'}, format='json')
+            force_authenticate(request, user=user)
+            start = time.perf_counter()
+            response = views.get_available_formats(request)
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.data
+            return elapsed
+
+        def run(label, legacy=False, handler=background):
+            StubYoutubeDL.legacy_output = legacy
+            app_logger.disabled = legacy # The old code had no logging calls
+            app_logger.handlers = [handler]
+            with contextlib.redirect_stdout(sink):
+                for _ in range(10): probe()
+                timings = sorted(probe() for _ in range(options['requests']))
+                if handler is background: background.stop() # Flush, so the next mode starts with an empty queue
+            p50, p95 = statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+            self.stdout.write(f"  {label:<40} p50 {p50 * 1000:7.2f} ms   p95 {p95 * 1000:7.2f} ms")
+            return p50
+
+        try:
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}), \
+                 mock.patch('downloader_ytdlp.views.new_youtube_dl', StubYoutubeDL):
+                self.stdout.write(f"{options['requests']} probes per mode, output to {options['sink']}:")
+                before = run('print + pprint(info_dict) (before)', legacy=True)
+                run('structured logging, synchronous handler', handler=console)
+                after = run('structured logging, background queue', handler=background)
+            self.stdout.write(f"Removed from each probe: {(before - after) * 1000:.2f} ms at p50")
+        finally:
+            app_logger.disabled = False; app_logger.handlers = [background]
+            console.setStream(old_stream)
+            sink.close()
+            if consumer: consumer.wait()
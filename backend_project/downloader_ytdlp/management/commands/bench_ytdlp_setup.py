@@ -0,0 +1,64 @@
+# downloader_ytdlp/management/commands/bench_ytdlp_setup.py
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Run in a fresh interpreter so module caches from this process don't leak in.
+COLD_START_SNIPPET = """
+import os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_project.settings')
+start = time.perf_counter()
+import django
+django.setup()
+import downloader_ytdlp.urls
+{extra}
+print(time.perf_counter() - start, 'yt_dlp' in sys.modules)
+"""
+
+
+class Command(BaseCommand):
+    help = "Measure web cold-start time and per-task yt-dlp setup overhead (fresh vs. warm worker pool)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--tasks', type=int, default=20, help='Simulated tasks per setup mode.')
+
+    def handle(self, *args, **options):
+        runs = options['runs']
+        self.stdout.write("Web cold start (django.setup + URLconf import):")
+        for label, extra in (('lazy yt_dlp (current)', ''), ('eager yt_dlp (before)', 'import yt_dlp')):
+            timings = []
+            loaded = False
+            for _ in range(runs):
+                out = subprocess.run(
+                    [sys.executable, '-c', COLD_START_SNIPPET.format(extra=extra)],
+                    cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+                ).stdout.split()
+                timings.append(float(out[0])); loaded = out[1] == 'True'
+            self.stdout.write(f"  {label:<24} median {statistics.median(timings) * 1000:8.1f} ms  (yt_dlp loaded: {loaded})")
+
+        from downloader_ytdlp import ytdl
+        yt_dlp = ytdl.get_yt_dlp()
+        opts = {'quiet': True, 'no_warnings': True, 'noplaylist': True}
+
+        def per_task(factory):
+            timings = []
+            for _ in range(options['tasks']):
+                start = time.perf_counter()
+                with factory(opts) as ydl:
+                    ydl._request_director # Force handler setup, as the first request would
+                timings.append(time.perf_counter() - start)
+            return timings
+
+        self.stdout.write("Per-task YoutubeDL setup:")
+        fresh = per_task(lambda o: yt_dlp.YoutubeDL({**ytdl.BASE_NETWORK_OPTS, **o}))
+        warm_cost = ytdl.warm_up()
+        pooled = per_task(ytdl.new_youtube_dl)
+        self.stdout.write(f"  fresh YoutubeDL per task (before) median {statistics.median(fresh) * 1000:8.2f} ms")
+        self.stdout.write(f"  pooled after warm-up (current)    median {statistics.median(pooled) * 1000:8.2f} ms  (one-off warm-up {warm_cost * 1000:.1f} ms)")
+        self.stdout.write("  Connection reuse is not measured here: fresh instances open new TCP/TLS sessions on their first request, pooled ones reuse the handler's keep-alive connections.")
+        ytdl.shutdown()
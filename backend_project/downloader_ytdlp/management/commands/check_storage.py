@@ -0,0 +1,46 @@
+# downloader_ytdlp/management/commands/check_storage.py
+import os
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from downloader_ytdlp.storage import get_storage, path_for_key
+
+
+class Command(BaseCommand):
+    help = "Round-trip a test file through the configured storage backend (e.g. a local MinIO): upload, URL, link, delete."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=64, help='Test file size; above DOWNLOAD_S3_MULTIPART_CHUNK_SIZE exercises multipart upload.')
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        key = f"downloads/_storage_check/{uuid.uuid4()}/probe.bin"
+        copy_key = key.replace('probe.bin', 'probe-link.bin')
+        local_path = path_for_key(key)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as f:
+            for _ in range(options['size_mb']):
+                f.write(os.urandom(1024 * 1024))
+
+        self.stdout.write(f"Backend: {storage.name} ({settings.DOWNLOAD_S3_ENDPOINT_URL or 'default endpoint'} / {settings.DOWNLOAD_S3_BUCKET or settings.MEDIA_ROOT})")
+        try:
+            start = time.perf_counter()
+            storage.store(local_path, key)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"  store: {options['size_mb']} MB in {elapsed:.2f}s ({options['size_mb'] / max(elapsed, 1e-9):.1f} MB/s)")
+            self.stdout.write(f"  url:   {storage.url(key)}")
+            storage.link(key, copy_key)
+            self.stdout.write(f"  link:  {copy_key}")
+        except Exception as e:
+            raise CommandError(f"Storage check failed: {type(e).__name__}: {e}")
+        finally:
+            for k in (key, copy_key):
+                try: storage.delete(k)
+                except Exception: pass
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        self.stdout.write(self.style.SUCCESS("Storage backend OK"))
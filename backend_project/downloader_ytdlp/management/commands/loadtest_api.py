@@ -0,0 +1,252 @@
+# downloader_ytdlp/management/commands/loadtest_api.py
+import http.client
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from backend_project.celery import app as celery_app
+from downloader_ytdlp import scheduler
+from downloader_ytdlp.auth_backends import clear_user_cache
+from downloader_ytdlp.models import DownloadLog, ForumTopic, ForumPost
+from downloader_ytdlp.scheduler import get_dispatcher, make_job
+
+# Everything external gets a local stand-in, so runs are reproducible on one machine
+STAND_INS = {
+    'DEBUG': False, 'ALLOWED_HOSTS': ['127.0.0.1'],
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, # Instead of Redis
+    'DOWNLOAD_SCHEDULER_BACKEND': 'memory',
+    # Celery publishes to kombu's in-process broker and keeps results in an in-process cache (read before the app is configured)
+    'CELERY_BROKER_URL': 'memory://', 'CELERY_RESULT_BACKEND': 'cache+memory://', 'CELERY_BROKER_TRANSPORT_OPTIONS': {},
+    # Let the download endpoint run flat out rather than measuring admission refusals
+    'DOWNLOAD_ADMISSION_MAX_QUEUE_DEPTH': 10 ** 9, 'DOWNLOAD_ADMISSION_MAX_ACTIVE': 10 ** 9,
+    'DOWNLOAD_ADMISSION_MAX_OUTSTANDING_PER_USER': 10 ** 9, 'DOWNLOAD_ADMISSION_MIN_FREE_BYTES': 0,
+}
+
+USERNAME, PASSWORD = 'loadtest', 'loadtest-password'
+MB = 1024 ** 2
+FAKE_INFO = {
+    'id': 'loadtest', 'extractor_key': 'Youtube', 'title': 'Load test video', 'duration': 600, '_type': 'video',
+    'formats': (
+        [{'format_id': f'v{h}', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'none', 'height': h, 'width': h * 16 // 9, 'fps': 30, 'vbr': h * 5, 'tbr': h * 5, 'filesize': h * 400_000, 'url': f'https://media.invalid/v{h}'} for h in (144, 240, 360, 480, 720, 1080, 1440, 2160)]
+        + [{'format_id': f'a{abr}', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a', 'abr': abr, 'tbr': abr, 'filesize': abr * 75_000, 'url': f'https://media.invalid/a{abr}'} for abr in (48, 128, 160)]
+        + [{'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 360, 'width': 640, 'abr': 96, 'vbr': 500, 'filesize': 30 * MB, 'url': 'https://media.invalid/18'}]
+    ),
+}
+
+
+class StubYoutubeDL:
+    """Stands in for new_youtube_dl(): canned extraction results after a fixed delay, no network."""
+    delay = 0.0
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        time.sleep(self.delay)
+        if self.opts.get('extract_flat'):
+            first, last = (int(n) for n in self.opts['playlist_items'].split('-'))
+            entries = [{'id': f'e{i}', 'title': f'Entry {i}', 'duration': 60, 'url': f'https://www.youtube.com/watch?v=e{i}'} for i in range(first, min(last, 500) + 1)]
+            return {'_type': 'playlist', 'id': 'PLload', 'title': 'Load test playlist', 'playlist_count': 500, 'entries': entries}
+        return dict(FAKE_INFO, webpage_url=url)
+
+
+def counting_queries(application):
+    """WSGI wrapper reporting the DB queries a request made in an X-DB-Queries response header."""
+    def app(environ, start_response):
+        count = [0]
+        def wrapper(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+        def start(status, headers, exc_info=None):
+            return start_response(status, headers + [('X-DB-Queries', str(count[0]))], exc_info)
+        with connection.execute_wrapper(wrapper):
+            return application(environ, start)
+    return app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True # Headers and body go out in separate writes; don't let delayed ACKs add 40 ms
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port_sender):
+    """Server process: Django behind the threaded WSGI server runserver uses; only app warnings and errors reach stderr."""
+    httpd = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+    httpd.set_app(counting_queries(get_wsgi_application()))
+    logging.getLogger('downloader_ytdlp').setLevel(logging.WARNING) # After setup() configured logging; not a line per request in the report
+    port_sender.send(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+class Session:
+    """One scripted client: its own keep-alive connection, cookies and CSRF token."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+        self.cookies = {'csrftoken': secrets.token_hex(16)} # Any 32-char token works as long as the header matches
+
+    def request(self, method, path, body=None):
+        headers = {'Cookie': '; '.join(f"{k}={v}" for k, v in self.cookies.items()), 'X-CSRFToken': self.cookies['csrftoken']}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode(); headers['Content-Type'] = 'application/json' # bytes go out with the headers
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+            try:
+                start = time.perf_counter()
+                self.conn.request(method, path, body=data, headers=headers)
+                response = self.conn.getresponse(); response.read()
+                elapsed = time.perf_counter() - start
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close(); self.conn = None # Server dropped the keep-alive connection: reconnect once
+                if attempt == 2: raise
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for key, morsel in SimpleCookie(header).items():
+                self.cookies[key] = morsel.value
+        return response.status, elapsed, int(response.headers.get('X-DB-Queries', -1))
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the HTTP API under a real threaded WSGI server process with local stand-ins "
+        "(in-memory Celery broker and result backend, in-memory scheduler, LocMem cache, stubbed YoutubeDL) "
+        "on a throwaway SQLite DB. Reports throughput, p50/p95/p99 latency and DB queries per endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent scripted clients.')
+        parser.add_argument('--login-requests', type=int, default=20, help='Measured requests for auth_login (each one hashes a password).')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per endpoint first.')
+        parser.add_argument('--extract-ms', type=float, default=0.0, help='Simulated yt-dlp extraction time per probe.')
+        parser.add_argument('--endpoints', nargs='*', help='Subset of endpoints to run (default: all).')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        tmpdir = tempfile.mkdtemp(prefix='loadtest-')
+        # A file DB (not :memory:) so the server's request threads share it
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'loadtest.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        overrides = override_settings(MEDIA_ROOT=tmpdir, **STAND_INS)
+        overrides.enable()
+        scheduler._dispatcher = None
+        clear_user_cache()
+        StubYoutubeDL.delay = options['extract_ms'] / 1000
+        server = None
+        try:
+            with mock.patch('downloader_ytdlp.views.new_youtube_dl', StubYoutubeDL):
+                scenarios = self.seed()
+                selected = options['endpoints'] or list(scenarios)
+                unknown = set(selected) - set(scenarios)
+                if unknown: raise CommandError(f"Unknown endpoints {sorted(unknown)}; choose from {list(scenarios)}")
+                connections.close_all() # The server process must not share our SQLite handles
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                server = multiprocessing.get_context('fork').Process(target=serve, args=(sender,), daemon=True)
+                server.start()
+                port = receiver.recv()
+                self.run(port, {name: scenarios[name] for name in selected}, options)
+        finally:
+            if server is not None: server.terminate(); server.join()
+            overrides.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def seed(self):
+        """Users, forum content, finished and queued downloads; returns {endpoint: i -> (method, path, body)}."""
+        user = User.objects.create_user(USERNAME, password=PASSWORD)
+        topics = [ForumTopic.objects.create(title=f"Topic {n}", author=user) for n in range(50)]
+        for topic in topics[:5]:
+            ForumPost.objects.bulk_create([ForumPost(topic=topic, author=user, content=f"Post {n} " * 20) for n in range(30)])
+        done = []
+        for n in range(50):
+            task_id = str(uuid.uuid4())
+            files = [{'filename': f'video{n}.mp4', 'file_url': f'/media/downloads/{USERNAME}/{n}/video{n}.mp4', 'storage_key': f'downloads/{USERNAME}/{n}/video{n}.mp4'}]
+            DownloadLog.objects.create(user=user, target_user_for_download=user, url=f'https://www.youtube.com/watch?v=done{n}', format_code_selected='best', format_type_selected='video', task_id=task_id, status='SUCCESS', downloaded_files_info=files)
+            celery_app.backend.store_result(task_id, files, 'SUCCESS')
+            done.append(task_id)
+        # Published to the in-memory broker up to the per-user cap; the rest wait in the fair-share queue
+        job_kwargs = {'url': 'https://www.youtube.com/watch?v=queued', 'format_code': 'best', 'format_type': 'video', 'target_username': USERNAME}
+        queued = [make_job(str(uuid.uuid4()), uuid.uuid4(), 'queued-user', job_kwargs) for _ in range(50)]
+        get_dispatcher().submit_many(queued)
+        queued = [job['task_id'] for job in queued if get_dispatcher().queue_position(job['task_id'])]
+        topic_id = topics[0].id
+        return {
+            'auth_status': lambda i: ('GET', '/api/auth/status/', None),
+            'auth_login': lambda i: ('POST', '/api/auth/login/', {'username': USERNAME, 'password': PASSWORD}),
+            'task_status_success': lambda i: ('GET', f"/api/task_status/{done[i % len(done)]}/", None),
+            'task_status_queued': lambda i: ('GET', f"/api/task_status/{queued[i % len(queued)]}/", None),
+            'get_formats': lambda i: ('POST', '/api/get_formats/', {'url': f'https://www.youtube.com/watch?v=load{i % 50}'}),
+            'playlist_entries': lambda i: ('POST', '/api/playlist/entries/', {'url': 'https://www.youtube.com/playlist?list=PLload', 'page': i % 10 + 1}),
+            'forum_topics': lambda i: ('GET', '/api/forum/topics/', None),
+            'forum_topic_detail': lambda i: ('GET', f"/api/forum/topics/{topic_id}/", None),
+            'forum_post_create': lambda i: ('POST', f"/api/forum/topics/{topics[1].id}/posts/", {'content': f'Load test post {i}'}),
+            'download': lambda i: ('POST', '/api/download/', {'url': f'https://www.youtube.com/watch?v=dl{uuid.uuid4().hex[:11]}', 'format_code': 'best', 'format_type': 'video'}),
+        }
+
+    def run(self, port, scenarios, options):
+        sessions = [Session(port) for _ in range(options['concurrency'])]
+        for session in sessions:
+            status, _, _ = session.request('POST', '/api/auth/login/', {'username': USERNAME, 'password': PASSWORD})
+            if status != 200: raise CommandError(f"Login failed with HTTP {status}")
+        self.stdout.write(f"{options['concurrency']} clients, {options['requests']} requests per endpoint, yt-dlp stub {options['extract_ms']:.0f} ms")
+        self.stdout.write(f"{'endpoint':<22}{'ok':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+        for name, scenario in scenarios.items():
+            n = options['login_requests'] if name == 'auth_login' else options['requests']
+            self.phase(sessions, scenario, options['warmup'])
+            start = time.perf_counter()
+            results = self.phase(sessions, scenario, n)
+            wall = time.perf_counter() - start
+            ok = [r for r in results if 200 <= r[0] < 300]
+            latencies = sorted(r[1] * 1000 for r in ok) or [0.0]
+            queries = [r[2] for r in ok if r[2] >= 0]
+            self.stdout.write(
+                f"{name:<22}{len(ok):>6}{len(results) - len(ok):>8}{len(results) / wall:>9.1f}"
+                f"{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}{percentile(latencies, 99):>9.1f}"
+                f"{(statistics.mean(queries) if queries else float('nan')):>9.2f}"
+            )
+
+    def phase(self, sessions, scenario, n):
+        counter = itertools.count()
+        def client(session):
+            results = []
+            for i in iter(lambda: next(counter), None):
+                if i >= n: return results
+                method, path, body = scenario(i)
+                try: results.append(session.request(method, path, body))
+                except Exception: results.append((0, 0.0, -1)) # Connection-level failure
+        with ThreadPoolExecutor(len(sessions)) as pool:
+            return [r for results in pool.map(client, sessions) for r in results]
@@ -0,0 +1,37 @@
+# downloader_ytdlp/management/commands/report_completion_times.py
+import statistics
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from downloader_ytdlp.models import DownloadLog
+
+TIER_ORDER = ['small', 'medium', 'large', 'huge', 'unknown', 'playlist']
+
+
+class Command(BaseCommand):
+    help = "Mean/median completion time (submission to finish) of finished downloads, broken down by size tier."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Only include downloads submitted in the last N days.')
+        parser.add_argument('--status', default='SUCCESS', help="Terminal status to include (e.g. SUCCESS, FAILURE, or 'all').")
+
+    def handle(self, *args, **options):
+        logs = DownloadLog.objects.filter(
+            finished_at__isnull=False, created_at__gte=timezone.now() - timedelta(days=options['days'])
+        )
+        if options['status'] != 'all':
+            logs = logs.filter(status=options['status'])
+
+        by_tier = {}
+        for size_tier, created_at, finished_at in logs.values_list('size_tier', 'created_at', 'finished_at'):
+            by_tier.setdefault(size_tier, []).append((finished_at - created_at).total_seconds())
+
+        if not by_tier:
+            self.stdout.write("No finished downloads in range.")
+            return
+        self.stdout.write(f"{'tier':<10} {'jobs':>6} {'mean s':>10} {'median s':>10} {'max s':>10}")
+        for size_tier in sorted(by_tier, key=lambda t: TIER_ORDER.index(t) if t in TIER_ORDER else len(TIER_ORDER)):
+            times = by_tier[size_tier]
+            self.stdout.write(f"{size_tier:<10} {len(times):>6} {statistics.mean(times):>10.1f} {statistics.median(times):>10.1f} {max(times):>10.1f}")
@@ -0,0 +1,31 @@
+# downloader_ytdlp/management/commands/report_speculation.py
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+
+from downloader_ytdlp.models import DownloadLog
+
+
+def mib(n):
+    return f"{n / 1024 ** 2:.1f} MiB"
+
+
+class Command(BaseCommand):
+    help = "Hit rate of speculative prefetch (downloads started by a format probe) and the bandwidth it spent."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Only include speculative downloads started in the last N days.')
+
+    def handle(self, *args, **options):
+        logs = DownloadLog.objects.filter(speculative=True, created_at__gte=timezone.now() - timedelta(days=options['days'])).annotate(adopters=Count('followers'))
+        rows = list(logs.values_list('status', 'adopters', 'transferred_bytes'))
+        if not rows:
+            self.stdout.write("No speculative downloads in range.")
+            return
+        hits = [row for row in rows if row[1]]
+        cancelled = sum(1 for row in rows if row[0] == 'CANCELLED')
+        spent, wasted = sum(row[2] for row in rows), sum(row[2] for row in rows if not row[1])
+        self.stdout.write(f"Started: {len(rows)}   adopted: {len(hits)} (hit rate {len(hits) / len(rows):.1%}, {sum(row[1] for row in hits)} request(s) served)   cancelled: {cancelled}")
+        self.stdout.write(f"Transferred: {mib(spent)}   of which never used: {mib(wasted)}")
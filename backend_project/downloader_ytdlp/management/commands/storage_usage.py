@@ -0,0 +1,34 @@
+# downloader_ytdlp/management/commands/storage_usage.py
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from downloader_ytdlp.models import DownloadLog, UserStorageUsage
+from downloader_ytdlp.usage import evict, quota_for, recount
+
+
+class Command(BaseCommand):
+    help = "Who uses the download storage: per-user usage counters. Can also evict old downloads or rebuild the counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='Number of users to list.')
+        parser.add_argument('--evict-older-than', type=int, metavar='DAYS', help='First delete the files of downloads finished more than DAYS days ago.')
+        parser.add_argument('--recount', action='store_true', help='First rebuild the counters from the download logs.')
+
+    def handle(self, *args, **options):
+        if options['evict_older_than'] is not None:
+            old = DownloadLog.objects.filter(status='SUCCESS', finished_at__lt=timezone.now() - timedelta(days=options['evict_older_than']))
+            freed = sum(evict(log_entry) for log_entry in old.iterator())
+            self.stdout.write(f"Evicted downloads older than {options['evict_older_than']} days: {freed / 1024 ** 2:.1f} MiB freed")
+        if options['recount']:
+            self.stdout.write(f"Recounted usage of {recount()} user(s)")
+
+        rows = UserStorageUsage.objects.select_related('user').filter(bytes_used__gt=0).order_by('-bytes_used')[:options['top']]
+        if not rows:
+            self.stdout.write("No stored downloads.")
+            return
+        self.stdout.write(f"{'user':<20} {'files':>7} {'MiB':>10} {'quota MiB':>10}")
+        for usage in rows:
+            quota = quota_for(usage)
+            self.stdout.write(f"{usage.user.username:<20} {usage.files:>7} {usage.bytes_used / 1024 ** 2:>10.1f} {quota / 1024 ** 2 if quota else float('inf'):>10.1f}")
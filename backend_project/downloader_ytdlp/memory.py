@@ -0,0 +1,93 @@
+# downloader_ytdlp/memory.py
+"""
+Per-task memory accounting for download workers.
+
+TaskMemory measures one download_video_task run: the resident set size at the
+start and end, and the peak in between. The peak comes from the kernel's
+high-water mark (VmHWM), reset at the start of the task through
+/proc/self/clear_refs. Where that is not possible, RSS is sampled from the
+progress hook instead. Everything is read from /proc; without it (non-Linux)
+the figures are None.
+
+Recycling a worker that has grown too large is left to Celery
+(CELERY_WORKER_MAX_MEMORY_PER_CHILD): the pool child checks its size after each
+task and is replaced before it takes the next one, never mid-download.
+"""
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+SAMPLE_INTERVAL = 1.0 # Seconds between RSS samples from the progress hook
+_libc = None
+
+
+def current_rss():
+    """Resident set size in bytes, or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    """High-water mark of the resident set size in bytes (since the last reset_peak()), or None."""
+    try:
+        with open('/proc/self/status') as f:
+            match = re.search(r'^VmHWM:\s+(\d+) kB', f.read(), re.MULTILINE)
+        return int(match.group(1)) * 1024 if match else None
+    except OSError:
+        return None
+
+
+def reset_peak():
+    """Start a new high-water mark at the current RSS. True when the kernel allowed it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def release_memory():
+    """Collect garbage and hand freed heap pages back to the OS (glibc keeps them otherwise)."""
+    global _libc
+    gc.collect()
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        _libc.malloc_trim(0)
+    except (OSError, AttributeError): # Not glibc
+        _libc = False
+
+
+class TaskMemory:
+    def __init__(self):
+        self.start_rss = current_rss()
+        self.kernel_peak = reset_peak() and peak_rss() is not None
+        self.sampled_peak = self.start_rss
+        self._sampled_at = time.monotonic()
+
+    def sample(self, d=None):
+        """Progress-hook compatible; only samples when the kernel high-water mark is unavailable."""
+        if self.kernel_peak or time.monotonic() - self._sampled_at < SAMPLE_INTERVAL:
+            return
+        self._sampled_at = time.monotonic()
+        rss = current_rss()
+        if rss is not None:
+            self.sampled_peak = max(self.sampled_peak or 0, rss)
+
+    def finish(self):
+        """(peak_rss, rss_delta) in bytes for the task so far; either may be None."""
+        end_rss = current_rss()
+        peak = peak_rss() if self.kernel_peak else max(self.sampled_peak or 0, end_rss or 0) or None
+        delta = end_rss - self.start_rss if end_rss is not None and self.start_rss is not None else None
+        return peak, delta
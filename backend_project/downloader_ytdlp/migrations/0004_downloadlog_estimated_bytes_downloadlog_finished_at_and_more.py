@@ -0,0 +1,28 @@
+# Generated by Django 6.1.2 on 2026-10-19 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0003_alter_downloadlog_task_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='estimated_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='size_tier',
+            field=models.CharField(db_index=True, default='unknown', max_length=20),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.1.2 on 2026-10-19 13:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0004_downloadlog_estimated_bytes_downloadlog_finished_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='filename_template',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='leader',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='followers', to='downloader_ytdlp.downloadlog'),
+        ),
+    ]
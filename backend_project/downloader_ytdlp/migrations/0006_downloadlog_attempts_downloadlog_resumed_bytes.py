@@ -0,0 +1,23 @@
+# Generated by Django 6.1.2 on 2026-10-19 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0005_downloadlog_filename_template_downloadlog_leader'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='resumed_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
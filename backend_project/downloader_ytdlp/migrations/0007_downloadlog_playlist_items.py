@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-19 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0006_downloadlog_attempts_downloadlog_resumed_bytes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='playlist_items',
+            field=models.CharField(blank=True, max_length=1000, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.1.2 on 2026-10-19 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0007_downloadlog_playlist_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='accurate_cut',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='clip_end',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='clip_start',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
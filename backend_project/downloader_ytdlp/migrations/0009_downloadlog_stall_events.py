@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-19 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0008_downloadlog_accurate_cut_downloadlog_clip_end_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='stall_events',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
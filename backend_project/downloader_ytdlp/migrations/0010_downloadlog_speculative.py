@@ -0,0 +1,23 @@
+# Generated by Django 6.1.2 on 2026-10-19 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0009_downloadlog_stall_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='speculative',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='transferred_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.1.2 on 2026-10-19 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader_ytdlp', '0010_downloadlog_speculative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadlog',
+            name='peak_rss_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='rss_delta_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.1.2 on 2026-10-19 14:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('downloader_ytdlp', '0011_downloadlog_memory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes_used', models.BigIntegerField(default=0)),
+                ('files', models.IntegerField(default=0)),
+                ('quota_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='downloadlog',
+            name='storage_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -13,6 +13,12 @@ class DownloadLog(models.Model):
     format_code_selected = models.CharField(max_length=100)
     format_type_selected = models.CharField(max_length=20)
     is_playlist_download = models.BooleanField(default=False)
+    playlist_items = models.CharField(max_length=1000, null=True, blank=True) # yt-dlp playlist_items spec, e.g. "1,3,5-9"; null = whole playlist
+    filename_template = models.CharField(max_length=255, null=True, blank=True)
+    # Time-range clip: only this section is fetched (seconds; null start = 0, null end = to the end)
+    clip_start = models.FloatField(null=True, blank=True)
+    clip_end = models.FloatField(null=True, blank=True)
+    accurate_cut = models.BooleanField(default=False) # Re-encode around the cuts instead of snapping to keyframes
 
     # --- MODIFIED task_id field ---
     task_id = models.CharField(max_length=100, unique=True, db_index=True, null=True, blank=True)
@@ -24,6 +30,30 @@ class DownloadLog(models.Model):
     downloaded_files_info = models.JSONField(null=True, blank=True)
     error_message = models.TextField(null=True, blank=True)
 
+    # --- Scheduling: cost estimate from the format probe ---
+    estimated_bytes = models.BigIntegerField(null=True, blank=True)
+    size_tier = models.CharField(max_length=20, default='unknown', db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True) # Set on SUCCESS/FAILURE; completion time = finished_at - created_at
+
+    # --- Crash/retry resume ---
+    attempts = models.PositiveIntegerField(default=0) # Task executions, including retries and redeliveries
+    resumed_bytes = models.BigIntegerField(default=0) # Partial bytes reused from earlier attempts instead of re-downloaded
+    stall_events = models.JSONField(default=list, blank=True) # [{at, attempt, rate, downloaded_bytes, action}], see watchdog.py
+    transferred_bytes = models.BigIntegerField(default=0) # Received from the network over all attempts (progress hook)
+
+    # --- Worker memory, see memory.py ---
+    peak_rss_bytes = models.BigIntegerField(null=True, blank=True) # Highest worker RSS while this download ran (any attempt)
+    rss_delta_bytes = models.BigIntegerField(null=True, blank=True) # Worker RSS after the last attempt minus before it
+
+    # --- Speculative prefetch: queued by a format probe, not a user request (see speculation.py) ---
+    speculative = models.BooleanField(default=False, db_index=True)
+
+    # --- Storage accounting: bytes of downloaded_files_info charged to the target user (see usage.py) ---
+    storage_bytes = models.BigIntegerField(default=0)
+
+    # --- Single-flight: identical in-flight requests follow one leader (status 'ATTACHED') ---
+    leader = models.ForeignKey('self', on_delete=models.SET_NULL, related_name='followers', null=True, blank=True)
+
     def __str__(self):
         user_display = self.target_user_for_download.username if self.target_user_for_download else self.user.username
         return f"{user_display} - {self.url[:50]} - {self.status}"
@@ -31,6 +61,17 @@ class DownloadLog(models.Model):
     class Meta:
         ordering = ['-created_at']
         
+# --- Per-user storage usage: materialized counters, kept in step with DownloadLog.storage_bytes by usage.py ---
+class UserStorageUsage(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='storage_usage')
+    bytes_used = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+    quota_bytes = models.BigIntegerField(null=True, blank=True) # Overrides DOWNLOAD_USER_QUOTA_BYTES for this user
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username}: {self.bytes_used} bytes in {self.files} files"
+
 # --- Forum Models ---
 class ForumTopic(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
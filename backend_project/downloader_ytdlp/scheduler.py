@@ -0,0 +1,435 @@
+# downloader_ytdlp/scheduler.py
+"""
+Per-user fair-share dispatch of download jobs.
+
+Download requests are not sent to Celery directly. They wait in a per-user
+pending queue and are released to the workers round-robin across users, with
+at most DOWNLOAD_PER_USER_RUNNING_CAP jobs per user in flight at once. A user
+who submits a pile of playlists therefore only ever occupies their own share
+of the workers; everybody else keeps getting a turn. Speculative downloads
+(speculation.py) are queued under one shared pseudo-user, SPECULATIVE_QUEUE, so
+together they hold at most that cap and never take up the probing user's share.
+
+Within a user's queue, and in the broker via Celery message priorities, jobs
+are ordered by estimated size (see job_cost.py) to approximate shortest-job-
+first. Waiting jobs age: they gain one priority step every
+DOWNLOAD_PRIORITY_AGING_SECONDS, so a big playlist is delayed but not starved.
+Aging only happens here - a message's broker priority is fixed once published -
+so at most DOWNLOAD_MAX_IN_FLIGHT jobs (the total worker concurrency) are in the
+broker or running at once. Released jobs then never wait behind later, smaller
+ones in the broker; all the waiting, and so all the aging, happens in the
+dispatcher.
+
+A running slot is given back by the task itself (or the task_revoked/task_failure
+handlers in tasks.py). For the paths that skip all of them - a lost worker, a
+message purged from the broker - reconcile_running_slots() frees slots whose
+DownloadLog has finished, and any held past their lease (slot_lease: every
+attempt running into its hard time limit, plus the retry backoffs). It runs at
+most every DOWNLOAD_SLOT_RECONCILE_INTERVAL seconds per process, on submission
+and whenever a task gives its slot back.
+
+A job is a plain dict: {'task_id', 'log_id', 'username', 'kwargs', 'priority',
+'submitted_at', 'soft_time_limit', 'time_limit'}. The task_id is generated up front so the client can poll
+status while the job is queued.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .job_cost import classify_job, time_limits
+
+logger = logging.getLogger(__name__)
+
+
+# --- Queue stores ---
+class InMemoryQueueStore:
+    """Single-process store. Used for development, the test suite and simulations."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.ring = []          # Usernames with pending jobs, least recently served first
+        self.pending = {}       # username -> [job, ...]
+        self.running = {}       # username -> count
+        self.running_jobs = {}  # task_id -> username
+        self.running_lease = {} # task_id -> time the slot is freed regardless
+        self.pending_index = {} # task_id -> username
+
+    def lock(self):
+        return self._lock
+
+    def get_ring(self):
+        return list(self.ring)
+
+    def set_ring(self, users):
+        self.ring = list(users)
+
+    def push_jobs(self, jobs):
+        for job in jobs:
+            self.pending.setdefault(job['username'], []).append(job)
+            self.pending_index[job['task_id']] = job['username']
+
+    def pending_jobs(self, username):
+        return list(self.pending.get(username, []))
+
+    def remove_pending(self, username, task_id):
+        jobs = self.pending.get(username, [])
+        self.pending[username] = [j for j in jobs if j['task_id'] != task_id]
+        self.pending_index.pop(task_id, None)
+
+    def pending_user(self, task_id):
+        return self.pending_index.get(task_id)
+
+    def pending_count(self):
+        return len(self.pending_index)
+
+    def running_count(self, username):
+        return self.running.get(username, 0)
+
+    def running_total(self):
+        return len(self.running_jobs)
+
+    def running_leases(self):
+        return {task_id: self.running_lease.get(task_id) for task_id in self.running_jobs}
+
+    def mark_running(self, username, task_id, lease_until=None):
+        self.running_jobs[task_id] = username
+        self.running_lease[task_id] = lease_until
+        self.running[username] = self.running.get(username, 0) + 1
+
+    def mark_finished(self, task_id):
+        self.running_lease.pop(task_id, None)
+        username = self.running_jobs.pop(task_id, None)
+        if username is not None:
+            self.running[username] = max(0, self.running.get(username, 0) - 1)
+        return username
+
+
+class RedisQueueStore:
+    """Store shared by all web and worker processes. Mutations happen under a Redis lock."""
+    PREFIX = 'dl:fairshare:'
+
+    def __init__(self, url):
+        import redis # celery's redis transport already depends on redis-py
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def _key(self, *parts):
+        return self.PREFIX + ':'.join(parts)
+
+    def lock(self):
+        return self.redis.lock(self._key('lock'), timeout=10, blocking_timeout=10)
+
+    def get_ring(self):
+        return self.redis.lrange(self._key('ring'), 0, -1)
+
+    def set_ring(self, users):
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key('ring'))
+        if users:
+            pipe.rpush(self._key('ring'), *users)
+        pipe.execute()
+
+    def push_jobs(self, jobs):
+        pipe = self.redis.pipeline() # One round trip for the whole batch
+        for job in jobs:
+            pipe.rpush(self._key('pending', job['username']), json.dumps(job))
+            pipe.hset(self._key('pending_index'), job['task_id'], job['username'])
+        pipe.execute()
+
+    def pending_jobs(self, username):
+        return [json.loads(raw) for raw in self.redis.lrange(self._key('pending', username), 0, -1)]
+
+    def remove_pending(self, username, task_id):
+        key = self._key('pending', username)
+        for raw in self.redis.lrange(key, 0, -1):
+            if json.loads(raw)['task_id'] == task_id:
+                self.redis.lrem(key, 1, raw)
+                break
+        self.redis.hdel(self._key('pending_index'), task_id)
+
+    def pending_user(self, task_id):
+        return self.redis.hget(self._key('pending_index'), task_id)
+
+    def pending_count(self):
+        return self.redis.hlen(self._key('pending_index'))
+
+    def running_count(self, username):
+        return int(self.redis.hget(self._key('running'), username) or 0)
+
+    def running_total(self):
+        return self.redis.hlen(self._key('running_jobs'))
+
+    def running_leases(self):
+        task_ids = self.redis.hkeys(self._key('running_jobs'))
+        leases = self.redis.hmget(self._key('running_lease'), task_ids) if task_ids else []
+        return {task_id: float(until) if until else None for task_id, until in zip(task_ids, leases)}
+
+    def mark_running(self, username, task_id, lease_until=None):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('running_jobs'), task_id, username)
+        if lease_until is not None:
+            pipe.hset(self._key('running_lease'), task_id, lease_until)
+        pipe.hincrby(self._key('running'), username, 1)
+        pipe.execute()
+
+    def mark_finished(self, task_id):
+        self.redis.hdel(self._key('running_lease'), task_id)
+        username = self.redis.hget(self._key('running_jobs'), task_id)
+        if username is not None and self.redis.hdel(self._key('running_jobs'), task_id):
+            if self.redis.hincrby(self._key('running'), username, -1) < 0:
+                self.redis.hset(self._key('running'), username, 0)
+        return username
+
+
+# --- Dispatcher ---
+class FairShareDispatcher:
+    def __init__(self, store, per_user_cap, publish, aging_seconds=None, clock=time.time, lease=None, max_in_flight=None):
+        self.store = store
+        self.per_user_cap = per_user_cap
+        self.max_in_flight = max_in_flight # Released jobs across all users (None: only the per-user cap)
+        self.publish = publish # Callable taking a list of released jobs
+        self.aging_seconds = aging_seconds
+        self.clock = clock
+        self.lease = lease # Callable: seconds a released job may hold its slot (None: no limit)
+
+    def effective_priority(self, job, now):
+        priority = job.get('priority', 0)
+        if self.aging_seconds:
+            priority -= int((now - job.get('submitted_at', now)) // self.aging_seconds)
+        return max(0, priority)
+
+    def _ordered(self, jobs, now):
+        # Shortest (highest priority) first, FIFO among equals
+        return sorted(jobs, key=lambda j: (self.effective_priority(j, now), j.get('submitted_at', 0)))
+
+    def submit(self, job):
+        """Queue a job for its user and release whatever the caps now allow."""
+        return self.submit_many([job])
+
+    def submit_many(self, jobs):
+        """Queue several jobs at once; everything releasable is published together."""
+        with self.store.lock():
+            self.store.push_jobs(jobs)
+            ring = self.store.get_ring()
+            new_users = [u for u in dict.fromkeys(job['username'] for job in jobs) if u not in ring]
+            if new_users:
+                self.store.set_ring(ring + new_users)
+        return self.release()
+
+    def release(self):
+        """
+        Hand jobs to the workers round-robin across users until every user with
+        pending work is at their running cap, or max_in_flight jobs are out. Returns the released jobs.
+        """
+        released = []
+        now = self.clock()
+        with self.store.lock():
+            ring = self.store.get_ring()
+            room = None if self.max_in_flight is None else self.max_in_flight - self.store.running_total()
+            progressed = True
+            while progressed and (room is None or room > 0):
+                progressed = False
+                for username in list(ring):
+                    if room is not None and room <= 0:
+                        break
+                    if self.store.running_count(username) >= self.per_user_cap:
+                        continue
+                    jobs = self.store.pending_jobs(username)
+                    if not jobs:
+                        ring.remove(username)
+                        continue
+                    job = self._ordered(jobs, now)[0]
+                    job['effective_priority'] = self.effective_priority(job, now)
+                    self.store.remove_pending(username, job['task_id'])
+                    lease = self.lease(job) if self.lease else None
+                    self.store.mark_running(username, job['task_id'], now + lease if lease else None)
+                    released.append(job)
+                    if room is not None: room -= 1
+                    ring.remove(username)
+                    ring.append(username) # Served: go to the back of the line
+                    progressed = True
+            self.store.set_ring(ring)
+        if released:
+            self.publish(released)
+        return released
+
+    def finish(self, task_id):
+        """A job reached a terminal state: free its slot and release the next jobs."""
+        with self.store.lock():
+            self.store.mark_finished(task_id)
+        return self.release()
+
+    def reconcile(self, finished):
+        """
+        Free running slots that were never given back: jobs finished(task_ids) reports as done,
+        and jobs past their lease. Returns the freed task ids.
+        """
+        now = self.clock()
+        with self.store.lock():
+            running = self.store.running_leases()
+        stale = set(finished(list(running))) if running else set()
+        stale |= {task_id for task_id, until in running.items() if until is not None and now > until}
+        if not stale:
+            return stale
+        with self.store.lock():
+            for task_id in stale:
+                self.store.mark_finished(task_id)
+        logger.warning("Freed %d running slot(s) never given back", len(stale), extra={'task_ids': sorted(stale)})
+        self.release()
+        return stale
+
+    def cancel(self, task_id):
+        """Drop a job that is still waiting here. True if it was (it never reached the workers)."""
+        with self.store.lock():
+            username = self.store.pending_user(task_id)
+            if username is None:
+                return False
+            self.store.remove_pending(username, task_id)
+        return True
+
+    def reprioritize(self, task_id, priority):
+        """Give a job that is still waiting here a new priority. True if it was (and was moved)."""
+        with self.store.lock():
+            username = self.store.pending_user(task_id)
+            job = next((j for j in self.store.pending_jobs(username) if j['task_id'] == task_id), None) if username else None
+            if job is None:
+                return False
+            self.store.remove_pending(username, task_id)
+            self.store.push_jobs([{**job, 'priority': priority}])
+        return True
+
+    def queue_position(self, task_id):
+        """1-based position of a still-pending job within its user's queue, or None."""
+        username = self.store.pending_user(task_id)
+        if username is None:
+            return None
+        for index, job in enumerate(self._ordered(self.store.pending_jobs(username), self.clock())):
+            if job['task_id'] == task_id:
+                return index + 1
+        return None
+
+
+def publish_to_celery(jobs):
+    """
+    Publish released jobs over a single producer/connection for the lot. Every job is sent
+    once: after a failure part-way, only the jobs not sent yet are retried, one by one.
+    """
+    from celery import current_app
+    from .models import DownloadLog
+    from .tasks import download_video_task # Avoid a circular import at module load
+
+    def signature(job):
+        return download_video_task.signature(
+            kwargs=job['kwargs'], task_id=job['task_id'], priority=job.get('effective_priority', job.get('priority')),
+            soft_time_limit=job.get('soft_time_limit'), time_limit=job.get('time_limit'), # Retries keep them
+        )
+    sent = set()
+    try:
+        with current_app.producer_or_acquire() as producer:
+            for job in jobs:
+                signature(job).apply_async(producer=producer)
+                sent.add(job['task_id'])
+        return
+    except Exception as e:
+        logger.warning("Could not publish %d of %d task(s) together, falling back to one by one: %s", len(jobs) - len(sent), len(jobs), e)
+    for job in jobs:
+        if job['task_id'] in sent: # Already in the broker: sending it again would run it twice
+            continue
+        try:
+            signature(job).apply_async()
+        except Exception as e:
+            logger.exception("Could not publish task to Celery", extra={'task_id': job['task_id'], 'log_id': job['log_id']})
+            DownloadLog.objects.filter(id=job['log_id']).update(status='FAILURE', error_message=f"Queue fail: {str(e)}")
+            dispatcher = get_dispatcher()
+            with dispatcher.store.lock():
+                dispatcher.store.mark_finished(job['task_id'])
+
+
+_dispatcher = None
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        if settings.DOWNLOAD_SCHEDULER_BACKEND == 'memory':
+            store = InMemoryQueueStore()
+        else:
+            store = RedisQueueStore(settings.DOWNLOAD_SCHEDULER_REDIS_URL)
+        _dispatcher = FairShareDispatcher(store, settings.DOWNLOAD_PER_USER_RUNNING_CAP, publish_to_celery, aging_seconds=settings.DOWNLOAD_PRIORITY_AGING_SECONDS, lease=slot_lease, max_in_flight=settings.DOWNLOAD_MAX_IN_FLIGHT)
+    return _dispatcher
+
+
+def slot_lease(job):
+    """
+    Seconds a released job may hold its running slot: every attempt running into its hard
+    time limit, the retry backoffs in between, and DOWNLOAD_SLOT_LEASE_SLACK of broker wait.
+    """
+    hard_limit = job.get('time_limit') or settings.DOWNLOAD_TIME_LIMIT_MAX + settings.DOWNLOAD_TIME_LIMIT_GRACE
+    retries = settings.DOWNLOAD_MAX_RETRIES
+    return (retries + 1) * hard_limit + retries * settings.DOWNLOAD_RETRY_BACKOFF_MAX * 1.25 + settings.DOWNLOAD_SLOT_LEASE_SLACK
+
+
+def finished_task_ids(task_ids):
+    """Those of task_ids whose DownloadLog is no longer active (or no longer exists)."""
+    from .models import DownloadLog
+    from .singleflight import ACTIVE_LEADER_STATUSES # Avoid a circular import at module load
+    active = set(DownloadLog.objects.filter(task_id__in=task_ids, status__in=ACTIVE_LEADER_STATUSES).values_list('task_id', flat=True))
+    return [task_id for task_id in task_ids if task_id not in active]
+
+
+_reconciled_at = None
+
+def reconcile_running_slots(force=False):
+    """FairShareDispatcher.reconcile against the DownloadLogs, at most every DOWNLOAD_SLOT_RECONCILE_INTERVAL seconds."""
+    global _reconciled_at
+    if not force and _reconciled_at is not None and time.monotonic() - _reconciled_at < settings.DOWNLOAD_SLOT_RECONCILE_INTERVAL:
+        return set()
+    _reconciled_at = time.monotonic()
+    try:
+        return get_dispatcher().reconcile(finished_task_ids)
+    except Exception:
+        logger.exception("Could not reconcile running slots")
+        return set()
+
+
+# Not a valid Django username, so it cannot clash with a real user's queue
+SPECULATIVE_QUEUE = '(speculative)'
+
+
+def make_job(task_id, log_id, username, kwargs, priority=0, submitted_at=None, soft_time_limit=None, time_limit=None):
+    return {
+        'task_id': task_id, 'log_id': str(log_id), 'username': username, 'kwargs': kwargs,
+        'priority': priority, 'submitted_at': time.time() if submitted_at is None else submitted_at,
+        'soft_time_limit': soft_time_limit, 'time_limit': time_limit,
+    }
+
+
+def job_for_log(log_entry):
+    """Rebuild the dispatch job for a DownloadLog (used for new requests and promoted followers)."""
+    target = log_entry.target_user_for_download or log_entry.user
+    _, priority = classify_job(log_entry.estimated_bytes, log_entry.is_playlist_download)
+    username = log_entry.user.username
+    if log_entry.speculative:
+        priority = settings.DOWNLOAD_SPECULATIVE_PRIORITY # Until somebody adopts it
+        username = SPECULATIVE_QUEUE
+    soft_time_limit, time_limit = time_limits(log_entry.estimated_bytes, log_entry.is_playlist_download)
+    kwargs = dict(
+        url=log_entry.url, format_code=log_entry.format_code_selected, format_type=log_entry.format_type_selected,
+        target_username=target.username, is_playlist=log_entry.is_playlist_download,
+        playlist_items=log_entry.playlist_items, filename_template=log_entry.filename_template, log_id=str(log_entry.id),
+        clip_start=log_entry.clip_start, clip_end=log_entry.clip_end, accurate_cut=log_entry.accurate_cut,
+    )
+    return make_job(log_entry.task_id, log_entry.id, username, kwargs, priority=priority, soft_time_limit=soft_time_limit, time_limit=time_limit)
+
+
+def submit_log(log_entry):
+    """Queue a DownloadLog's job with the fair-share dispatcher. Returns the dispatcher."""
+    return submit_logs([log_entry])
+
+
+def submit_logs(log_entries):
+    reconcile_running_slots()
+    dispatcher = get_dispatcher()
+    dispatcher.submit_many([job_for_log(log_entry) for log_entry in log_entries])
+    return dispatcher
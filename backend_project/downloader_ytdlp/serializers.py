@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
 from .models import DownloadLog, ForumTopic, ForumPost # Ensure these models are defined in models.py
+from .storage import refresh_urls
 
 # --- User Serializers ---
 class UserSerializer(serializers.ModelSerializer):
@@ -24,10 +25,16 @@ class DownloadLogSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'user', 'target_user_for_download', 'url',
             'format_code_selected', 'format_type_selected',
-            'is_playlist_download', 'task_id', 'status',
-            'created_at', 'updated_at', 'downloaded_files_info', 'error_message'
+            'is_playlist_download', 'playlist_items', 'filename_template', 'clip_start', 'clip_end', 'accurate_cut', 'task_id', 'status',
+            'created_at', 'updated_at', 'downloaded_files_info', 'error_message',
+            'estimated_bytes', 'size_tier', 'finished_at', 'attempts', 'resumed_bytes', 'stall_events', 'transferred_bytes', 'storage_bytes', 'peak_rss_bytes', 'rss_delta_bytes', 'speculative', 'leader'
         ]
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['downloaded_files_info'] = refresh_urls(data['downloaded_files_info'])
+        return data
+
 # --- Forum Serializers ---
 
 # --- CORRECTED ForumPostSerializer ---
@@ -0,0 +1,252 @@
+# downloader_ytdlp/singleflight.py
+"""
+Single-flight merging of identical download requests.
+
+The first request for a (video, format recipe) pair becomes the leader and
+runs a normal download_video_task. Identical requests that arrive while the
+leader is in flight become followers: their DownloadLog is ATTACHED to the
+leader, status polls report the leader's progress, and when the leader
+succeeds each follower receives the leader's output files as hardlinks in its
+own download directory (a server-side copy with the S3 backend). If the leader fails, the oldest follower is promoted
+and dispatched in its place; the remaining followers move over to it.
+
+Finished downloads are remembered per recipe for DOWNLOAD_RESULT_CACHE_TIMEOUT:
+a later identical request (same video, format and clip range) attaches to the
+completed log and is served its files straight away, without a download.
+
+The registry lives in the Django cache: key = recipe, value = leader log id.
+"""
+import hashlib
+import json
+import logging
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .job_cost import get_probe
+from .models import DownloadLog
+from .scheduler import slot_lease, submit_log
+from .storage import FILE_DETAILS, get_storage, file_info
+from .usage import charge
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_LEADER_STATUSES = ('PENDING', 'STARTED', 'DOWNLOADING', 'VERIFYING', 'RETRYING')
+
+
+def registry_timeout():
+    """
+    Upper bound on a leader's run, so stale entries expire on their own but a live leader's
+    does not: its longest possible fair-share slot lease (every attempt running into the
+    hard time limit, plus the retry backoffs).
+    """
+    return slot_lease({})
+
+
+def canonical_video_id(url):
+    """'<extractor>:<id>' when the URL was probed, otherwise a normalised URL."""
+    probe = get_probe(url)
+    if probe and probe.get('id') and probe.get('extractor_key'):
+        return f"{probe['extractor_key']}:{probe['id']}"
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), query, ''))
+
+
+def _recipe_hash(log_entry):
+    recipe = [
+        canonical_video_id(log_entry.url), log_entry.format_code_selected, log_entry.format_type_selected,
+        bool(log_entry.is_playlist_download), log_entry.playlist_items or '', log_entry.filename_template or '',
+        log_entry.clip_start, log_entry.clip_end, bool(log_entry.accurate_cut),
+    ]
+    return hashlib.sha1(json.dumps(recipe).encode()).hexdigest()
+
+
+def recipe_key(log_entry):
+    return 'singleflight:' + _recipe_hash(log_entry)
+
+
+def completed_key(log_entry):
+    return 'singleflight-done:' + _recipe_hash(log_entry)
+
+
+def _source_key(item):
+    return item.get('storage_key') or item['file_url'][len(settings.MEDIA_URL):]
+
+
+def completed_result(log_entry):
+    """An earlier successful download of the same recipe whose files are all still stored, or None."""
+    key = completed_key(log_entry)
+    try:
+        done_id = cache.get(key)
+    except Exception as e:
+        logger.warning("Single-flight registry unavailable: %s", e)
+        return None
+    if not done_id:
+        return None
+    done = DownloadLog.objects.filter(id=done_id, status='SUCCESS').first()
+    storage = get_storage()
+    if done is None or not done.downloaded_files_info or not all(storage.exists(_source_key(item)) for item in done.downloaded_files_info):
+        try: cache.delete(key) # Files were cleaned up: download afresh
+        except Exception: pass
+        return None
+    return done
+
+
+def remember_result(leader):
+    try:
+        cache.set(completed_key(leader), str(leader.id), settings.DOWNLOAD_RESULT_CACHE_TIMEOUT)
+    except Exception as e:
+        logger.warning("Single-flight registry unavailable: %s", e)
+
+
+def forget_result(leader):
+    """Stop serving later requests from leader's files (they are about to be deleted)."""
+    try:
+        key = completed_key(leader)
+        if cache.get(key) == str(leader.id):
+            cache.delete(key)
+    except Exception as e:
+        logger.warning("Single-flight registry unavailable: %s", e)
+
+
+def _attach(log_entry, leader):
+    log_entry.leader = leader
+    log_entry.status = 'ATTACHED'
+    log_entry.save(update_fields=['leader', 'status', 'updated_at'])
+
+
+def attach_or_lead(log_entry):
+    """
+    Register log_entry as the leader for its recipe, or attach it to the running leader.
+    Returns the leader DownloadLog when attached, None when log_entry should be dispatched.
+    When the recipe was already downloaded, log_entry is served from that result and comes back SUCCESS.
+    """
+    done = completed_result(log_entry)
+    if done is not None:
+        _attach(log_entry, done)
+        logger.info("Served from completed download", extra={'log_id': log_entry.id, 'leader_id': done.id})
+        deliver_to_followers(done)
+        log_entry.refresh_from_db(fields=['status', 'downloaded_files_info', 'error_message', 'finished_at'])
+        return done
+
+    key = recipe_key(log_entry)
+    try:
+        if cache.add(key, str(log_entry.id), registry_timeout()):
+            return None
+        leader_id = cache.get(key)
+    except Exception as e: # Without the registry every request simply runs on its own
+        logger.warning("Single-flight registry unavailable: %s", e)
+        return None
+
+    leader = DownloadLog.objects.filter(id=leader_id, status__in=ACTIVE_LEADER_STATUSES).first() if leader_id else None
+    if leader is None:
+        # Stale entry (leader finished or vanished between add() and get()): take over
+        cache.set(key, str(log_entry.id), registry_timeout())
+        return None
+
+    _attach(log_entry, leader)
+    logger.info("Attached to in-flight leader", extra={'log_id': log_entry.id, 'leader_id': leader.id, 'task_id': leader.task_id})
+
+    # The leader may have finished while we attached; make sure nobody is left waiting
+    leader.refresh_from_db(fields=['status', 'downloaded_files_info'])
+    if leader.status == 'SUCCESS':
+        deliver_to_followers(leader)
+    elif leader.status not in ACTIVE_LEADER_STATUSES:
+        promote_follower(leader)
+    return leader
+
+
+def _claim_follower(follower, new_status):
+    """Atomically move a follower out of ATTACHED; False if someone else got there first."""
+    return DownloadLog.objects.filter(id=follower.id, status='ATTACHED').update(status=new_status, updated_at=timezone.now()) == 1
+
+
+def deliver_to_followers(leader):
+    """Hardlink the leader's output files into every attached follower's directory."""
+    for follower in leader.followers.filter(status='ATTACHED').select_related('user', 'target_user_for_download'):
+        if not _claim_follower(follower, 'LINKING'):
+            continue
+        try:
+            target = follower.target_user_for_download or follower.user
+            storage = get_storage()
+            files_info = []
+            for item in leader.downloaded_files_info or []:
+                src_key = _source_key(item)
+                dst_key = f"downloads/{target.username}/{follower.id}/{item['filename']}"
+                storage.link(src_key, dst_key) # Hardlink on local disk, server-side copy on S3
+                files_info.append(file_info(dst_key, item['filename'], {k: item[k] for k in FILE_DETAILS if k in item}))
+            follower.status = 'SUCCESS'
+            follower.downloaded_files_info = files_info
+            follower.finished_at = timezone.now()
+            with transaction.atomic():
+                follower.save(update_fields=['status', 'downloaded_files_info', 'finished_at', 'updated_at'])
+                charge(follower)
+            logger.info("Delivered %d file(s) to follower", len(files_info), extra={'log_id': follower.id, 'leader_id': leader.id})
+        except Exception as e:
+            logger.exception("Could not deliver files to follower", extra={'log_id': follower.id, 'leader_id': leader.id})
+            follower.status = 'FAILURE'
+            follower.error_message = f"Could not link leader output: {type(e).__name__}: {str(e)}"
+            follower.finished_at = timezone.now()
+            follower.save(update_fields=['status', 'error_message', 'finished_at', 'updated_at'])
+
+
+def promote_follower(leader):
+    """
+    The leader failed: hand the recipe to its oldest follower, move the others over,
+    and dispatch the new leader. Returns the promoted DownloadLog or None.
+    """
+    key = recipe_key(leader)
+    for candidate in leader.followers.filter(status='ATTACHED').order_by('created_at'):
+        if not _claim_follower(candidate, 'PENDING'):
+            continue
+        with transaction.atomic():
+            DownloadLog.objects.filter(id=candidate.id).update(leader=None)
+            leader.followers.filter(status='ATTACHED').update(leader=candidate)
+        candidate.refresh_from_db()
+        try:
+            cache.set(key, str(candidate.id), registry_timeout())
+        except Exception as e:
+            logger.warning("Single-flight registry unavailable: %s", e)
+        logger.info("Leader failed, promoting follower", extra={'log_id': candidate.id, 'leader_id': leader.id})
+        try:
+            submit_log(candidate)
+        except Exception as e:
+            logger.exception("Could not dispatch promoted follower", extra={'log_id': candidate.id})
+            candidate.status = 'FAILURE'; candidate.error_message = f"Queue fail: {str(e)}"; candidate.finished_at = timezone.now()
+            candidate.save(update_fields=['status', 'error_message', 'finished_at', 'updated_at'])
+            return promote_follower(candidate)
+        return candidate
+    release(leader, key)
+    return None
+
+
+def release(leader, key=None):
+    """Drop the registry entry if it still points at this leader."""
+    key = key or recipe_key(leader)
+    try:
+        if cache.get(key) == str(leader.id):
+            cache.delete(key)
+    except Exception as e:
+        logger.warning("Single-flight registry unavailable: %s", e)
+
+
+def leader_finished(leader):
+    """Called once the leader's log reached SUCCESS, FAILURE or CANCELLED."""
+    if leader.status == 'SUCCESS':
+        remember_result(leader)
+        release(leader)
+        deliver_to_followers(leader)
+    else:
+        promote_follower(leader)
+
+
+def notify_followers(log_entry):
+    """leader_finished that only logs its errors: the log's own outcome is already recorded by then."""
+    try:
+        leader_finished(log_entry)
+    except Exception:
+        logger.exception("Could not notify single-flight followers", extra={'log_id': log_entry.id})
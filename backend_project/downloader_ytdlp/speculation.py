@@ -0,0 +1,132 @@
+# downloader_ytdlp/speculation.py
+"""
+Speculative prefetch of the recommended format after a probe (opt-in with
+DOWNLOAD_SPECULATIVE_PREFETCH).
+
+Between POST /api/get_formats/ and the user choosing a format there are usually
+some seconds of nothing. With prefetch on, a successful probe also queues a
+download of the format listed first - the recommended MP4, or the best M4A
+for audio-only media - as a DownloadLog marked speculative, at the lowest
+priority and only while the queue is quiet.
+
+It is an ordinary single-flight leader, so nothing new is needed to use it: a
+download request for the same recipe attaches to it while it runs, or is served
+from its finished files through the completed-result cache. Adopting it moves
+it up to the priority a normal request would have had.
+
+It is queued under the scheduler's SPECULATIVE_QUEUE pseudo-user, not the
+prober's, so it never holds one of their DOWNLOAD_PER_USER_RUNNING_CAP slots.
+
+An unadopted speculative download is cancelled when the same user asks for
+something else (another format, or another video probed or submitted), or
+after DOWNLOAD_SPECULATIVE_TIMEOUT seconds (expire_speculative_download). One
+that already finished by then is evicted instead: it is charged to nobody, so
+nothing else would ever delete its files. Hits and bytes spent are reported by
+the report_speculation management command.
+"""
+import logging
+
+from django.conf import settings
+
+from .admission import get_snapshot
+from .cancellation import request_cancellation
+from .job_cost import classify_job
+from .models import DownloadLog
+from .scheduler import get_dispatcher, submit_log
+from .singleflight import ACTIVE_LEADER_STATUSES, attach_or_lead, canonical_video_id, completed_result, forget_result, recipe_key, release
+from .usage import evict
+
+logger = logging.getLogger(__name__)
+
+# The first entries of get_available_formats; the same codes give the same single-flight recipe
+SPECULATIVE_VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+SPECULATIVE_AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio'
+
+
+def default_choice(probe):
+    """(format_code, format_type) the user is most likely to pick for a probed video."""
+    if any(f['video'] for f in probe.get('formats') or []):
+        return SPECULATIVE_VIDEO_FORMAT, 'video'
+    return SPECULATIVE_AUDIO_FORMAT, 'audio'
+
+
+def worth_speculating(log_entry):
+    """Only small enough downloads of known size, and only while the workers have spare capacity."""
+    if log_entry.estimated_bytes is None or log_entry.estimated_bytes > settings.DOWNLOAD_SPECULATIVE_MAX_BYTES:
+        return False
+    snapshot = get_snapshot()
+    return snapshot is not None and snapshot['queue_depth'] <= settings.DOWNLOAD_SPECULATIVE_MAX_QUEUE_DEPTH and snapshot['active'] < settings.DOWNLOAD_ADMISSION_MAX_ACTIVE
+
+
+def start_speculative_download(log_entry):
+    """
+    Queue an unsaved DownloadLog built for the default format as a speculative download.
+    Returns it, or None when it was not worth it or the recipe is already in flight or done.
+    """
+    if not worth_speculating(log_entry) or completed_result(log_entry) is not None:
+        return None
+    log_entry.speculative = True
+    log_entry.save(force_insert=True)
+    if attach_or_lead(log_entry) is not None: # Somebody is already downloading it
+        log_entry.delete()
+        return None
+    supersede_speculative(log_entry.user, log_entry) # One speculative download per user: the previous video is not wanted any more
+    try:
+        submit_log(log_entry)
+    except Exception:
+        release(log_entry); log_entry.delete()
+        raise
+    from .tasks import expire_speculative_download # Avoid a circular import at module load
+    expire_speculative_download.apply_async(args=[str(log_entry.id)], countdown=settings.DOWNLOAD_SPECULATIVE_TIMEOUT)
+    logger.info("Speculative download queued", extra={'log_id': log_entry.id, 'task_id': log_entry.task_id, 'format_code': log_entry.format_code_selected, 'est_bytes': log_entry.estimated_bytes})
+    return log_entry
+
+
+def _unadopted(logs):
+    return [log for log in logs if not log.followers.exists()]
+
+
+def cancel_speculative(log_entry, why):
+    try:
+        request_cancellation(log_entry)
+        logger.info("Speculative download cancelled: %s", why, extra={'log_id': log_entry.id, 'task_id': log_entry.task_id})
+    except Exception:
+        logger.exception("Could not cancel speculative download", extra={'log_id': log_entry.id})
+
+
+def supersede_speculative(user, log_entry):
+    """
+    The user asked for log_entry: cancel their unadopted speculative downloads of other
+    recipes (another format of the same video, or a video they probed before).
+    """
+    recipe = recipe_key(log_entry)
+    running = DownloadLog.objects.filter(user=user, speculative=True, status__in=ACTIVE_LEADER_STATUSES).exclude(id=log_entry.id)
+    for speculative in _unadopted(running):
+        if recipe_key(speculative) != recipe:
+            same_video = canonical_video_id(speculative.url) == canonical_video_id(log_entry.url)
+            cancel_speculative(speculative, 'another format was chosen' if same_video else 'another video was probed')
+
+
+def adopt_speculative(leader):
+    """A request attached to leader; when it is a queued speculative download, give it a normal priority."""
+    if not leader.speculative or leader.status not in ACTIVE_LEADER_STATUSES:
+        return
+    _, priority = classify_job(leader.estimated_bytes, leader.is_playlist_download)
+    if get_dispatcher().reprioritize(leader.task_id, priority):
+        logger.info("Speculative download adopted while queued", extra={'log_id': leader.id, 'priority': priority})
+
+
+def expire(log_id):
+    """
+    Cancel a speculative download nobody adopted within DOWNLOAD_SPECULATIVE_TIMEOUT, or
+    delete its files when it already finished.
+    """
+    for speculative in _unadopted(DownloadLog.objects.filter(id=log_id, speculative=True, status__in=ACTIVE_LEADER_STATUSES + ('SUCCESS',))):
+        if speculative.status != 'SUCCESS':
+            cancel_speculative(speculative, 'timed out')
+            continue
+        forget_result(speculative)
+        if speculative.followers.exists(): # Served from the result cache just now
+            continue
+        evict(speculative)
+        logger.info("Speculative download evicted: timed out", extra={'log_id': speculative.id})
@@ -0,0 +1,217 @@
+# downloader_ytdlp/storage.py
+"""
+Storage backends for finished downloads.
+
+Workers always download into MEDIA_ROOT first (yt-dlp and ffmpeg need a real
+filesystem). The configured backend then decides where the finished file lives
+and how clients reach it:
+
+- 'local': the file stays under MEDIA_ROOT and is served from MEDIA_URL. Only
+  works when the web tier shares the workers' filesystem.
+- 's3': the file is uploaded to an S3-compatible bucket (AWS, MinIO, ...) with
+  parallel multipart upload, and clients get presigned URLs, so file bytes
+  never pass through Django and workers can run on any node.
+
+Objects are addressed by a storage key: the path relative to MEDIA_ROOT with
+forward slashes, e.g. 'downloads/alice/<log id>/clip.mp4'.
+
+Every stored file is described once, while it is still on local disk: size,
+duration (ffprobe) and SHA-256. The details travel in downloaded_files_info
+and feed the per-user usage counters (usage.py).
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def key_for_path(local_path):
+    return os.path.relpath(local_path, settings.MEDIA_ROOT).replace("\\", "/")
+
+
+def path_for_key(key):
+    return os.path.join(settings.MEDIA_ROOT, *key.split('/'))
+
+
+class LocalStorage:
+    name = 'local'
+
+    def store(self, local_path, key):
+        """The file is already in place under MEDIA_ROOT."""
+        return key
+
+    def url(self, key):
+        return settings.MEDIA_URL + key
+
+    def link(self, src_key, dst_key):
+        """Make dst_key refer to the same bytes as src_key: a hardlink, or a copy across filesystems."""
+        src, dst = path_for_key(src_key), path_for_key(dst_key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.exists(dst):
+            return dst_key
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        return dst_key
+
+    def exists(self, key):
+        return os.path.isfile(path_for_key(key))
+
+    def delete(self, key):
+        try:
+            os.remove(path_for_key(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    name = 's3'
+
+    def __init__(self):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError: # Optional dependency: only needed for the s3 backend
+            raise ImproperlyConfigured("DOWNLOAD_STORAGE_BACKEND='s3' requires boto3 (pip install boto3)")
+        if not settings.DOWNLOAD_S3_BUCKET:
+            raise ImproperlyConfigured("DOWNLOAD_S3_BUCKET must be set for the s3 storage backend")
+        self.bucket = settings.DOWNLOAD_S3_BUCKET
+        self.client = boto3.client(
+            's3', endpoint_url=settings.DOWNLOAD_S3_ENDPOINT_URL, region_name=settings.DOWNLOAD_S3_REGION,
+            aws_access_key_id=settings.DOWNLOAD_S3_ACCESS_KEY_ID, aws_secret_access_key=settings.DOWNLOAD_S3_SECRET_ACCESS_KEY,
+        )
+        # Parts of a large file are uploaded concurrently by boto3's transfer manager
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.DOWNLOAD_S3_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=settings.DOWNLOAD_S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=settings.DOWNLOAD_S3_UPLOAD_CONCURRENCY,
+            use_threads=True,
+        )
+
+    def store(self, local_path, key):
+        self.client.upload_file(local_path, self.bucket, key, Config=self.transfer_config)
+        if not settings.DOWNLOAD_S3_KEEP_LOCAL_COPY:
+            os.remove(local_path)
+        return key
+
+    def url(self, key):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=settings.DOWNLOAD_S3_PRESIGNED_URL_EXPIRY,
+        )
+
+    def link(self, src_key, dst_key):
+        # Server-side copy (multipart for big objects); no bytes go through the worker
+        self.client.copy({'Bucket': self.bucket, 'Key': src_key}, self.bucket, dst_key, Config=self.transfer_config)
+        return dst_key
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError # Installed with boto3
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+BACKENDS = {'local': LocalStorage, 's3': S3Storage}
+_backend = None
+
+def get_storage():
+    global _backend
+    if _backend is None:
+        try:
+            _backend = BACKENDS[settings.DOWNLOAD_STORAGE_BACKEND]()
+        except KeyError:
+            raise ImproperlyConfigured(f"Unknown DOWNLOAD_STORAGE_BACKEND {settings.DOWNLOAD_STORAGE_BACKEND!r}")
+    return _backend
+
+
+FILE_DETAILS = ('size', 'duration', 'sha256') # Keys describe_file() adds to a downloaded_files_info entry
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def media_duration(local_path):
+    """Duration in seconds from ffprobe (already required for post-processing), or None."""
+    try:
+        out = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', local_path],
+                             capture_output=True, text=True, timeout=30, check=True).stdout.strip()
+        return round(float(out), 3)
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def describe_file(local_path):
+    """{'size', 'duration', 'sha256'} of a finished local file."""
+    digest = hashlib.sha256()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return {'size': os.path.getsize(local_path), 'duration': media_duration(local_path), 'sha256': digest.hexdigest()}
+
+
+def file_info(key, filename, details=None):
+    """downloaded_files_info entry for a stored file; details as from describe_file()."""
+    return {'filename': filename, 'file_url': get_storage().url(key), 'storage_key': key, **(details or {})}
+
+
+def refresh_urls(files_info):
+    """Re-sign file URLs on read (presigned URLs expire); entries without a storage_key are left alone."""
+    if not files_info or not isinstance(files_info, list):
+        return files_info
+    storage = get_storage()
+    return [{**item, 'file_url': storage.url(item['storage_key'])} if isinstance(item, dict) and item.get('storage_key') else item for item in files_info]
+
+
+class BackgroundUploader:
+    """
+    Describes and stores finished files while yt-dlp carries on with the next playlist entry.
+    submit() is called from yt-dlp's post_hooks; wait() collects {local_path: (key, details)}.
+    """
+
+    def __init__(self, max_workers=2):
+        self.storage = get_storage()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) # Hashing too, so even the local backend has work to overlap
+        self.futures = {}
+
+    def _store(self, local_path, key):
+        details = describe_file(local_path) # Before store(): remote backends may remove the local copy
+        return self.storage.store(local_path, key), details
+
+    def submit(self, local_path):
+        if local_path in self.futures:
+            return
+        self.futures[local_path] = self.executor.submit(self._store, local_path, key_for_path(local_path))
+
+    def wait(self):
+        try:
+            return {path: f.result() for path, f in self.futures.items()}
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def stored(self):
+        """Wait for uploads in flight; {local_path: (key, details)} of those that succeeded (the task will retry)."""
+        self.executor.shutdown(wait=True)
+        done = {}
+        for path, f in self.futures.items():
+            try:
+                done[path] = f.result()
+            except Exception:
+                pass # Failed upload: the next attempt stores it again
+        return done
+
+    def discard(self):
+        """Wait for uploads in flight, then delete whatever was stored (the download was cancelled or failed)."""
+        self.executor.shutdown(wait=True)
+        for path, f in self.futures.items():
+            try:
+                self.storage.delete(f.result()[0])
+            except Exception:
+                pass # Failed upload: nothing stored
@@ -1,24 +1,61 @@
 # downloader_ytdlp/tasks.py
-import yt_dlp
+import logging
 import os
-import traceback # For printing detailed errors
+import shutil
 import uuid
+import random
 import time # Import time for sleep
 import json # Not strictly needed for return, but useful if parsing info.json for more details
 
 from celery import shared_task
+from celery.exceptions import Ignore, SoftTimeLimitExceeded, TimeLimitExceeded
+from celery.signals import task_failure, task_revoked, worker_process_init, worker_process_shutdown
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from pathvalidate import sanitize_filename # For sanitizing user input for filenames
 
+from . import speculation
+from .cancellation import CancelWatch, cancel_requested, mark_cancelled
+from .logs import FieldsAdapter, YtDlpLogger
+from .memory import TaskMemory, release_memory
 from .models import DownloadLog # Assuming DownloadLog model is in the same app's models.py
+from .scheduler import get_dispatcher, reconcile_running_slots
+from .singleflight import ACTIVE_LEADER_STATUSES, notify_followers
+from .storage import BackgroundUploader, file_info, get_storage
+from .usage import charge
+from .watchdog import STALL_RECOVERIES, DownloadStalled, StallWatchdog
+from .ytdl import get_yt_dlp, new_youtube_dl, warm_up, shutdown as shutdown_ytdl
+
+logger = logging.getLogger(__name__)
+
+# --- Worker process lifecycle ---
+@worker_process_init.connect
+def warm_up_ytdl(**kwargs):
+    """Load yt-dlp extractors and the shared HTTP pool once per worker process."""
+    elapsed = warm_up()
+    logger.info("yt-dlp warmed up in %.3fs", elapsed, extra={'pid': os.getpid()})
+
+@worker_process_shutdown.connect
+def close_ytdl_pool(**kwargs):
+    shutdown_ytdl()
 
 # --- Helper function for progress hook ---
-def update_progress(task_instance, d):
+def update_progress(task_instance, d, watch=None, stall=None):
     """
     Callback function used by yt-dlp's progress_hooks.
     Updates the Celery task state with progress information.
     Uses string literals for states.
+    Aborts the download when the user cancelled it or it stalled.
     """
+    if watch is not None:
+        watch.raise_if_cancelled() # Outside the try below: this one has to reach yt-dlp
+    if stall is not None:
+        stall.observe(d)
+        if stall.stalled():
+            raise get_yt_dlp().utils.DownloadCancelled(f"Stalled at {stall.last_rate:.0f} B/s")
     try:
         status_message = 'Downloading...'
         playlist_info = ""
@@ -49,44 +86,285 @@ def update_progress(task_instance, d):
                 meta={'status': f"Processing Item{playlist_info}...", 'progress': 99}
             )
         elif d['status'] == 'error':
-            print(f"Progress hook reported an error for task {task_instance.request.id}{playlist_info}")
+            logger.warning("Progress hook reported an error%s", playlist_info, extra={'task_id': task_instance.request.id})
     except Exception as exc:
-        print(f"!!! ERROR within progress hook for task {task_instance.request.id} !!!")
-        traceback.print_exc()
+        logger.exception("Error within progress hook", extra={'task_id': task_instance.request.id})
+
+
+def release_fair_share_slot(task_id):
+    """Tell the fair-share dispatcher this job is done so the next queued jobs can go."""
+    try:
+        get_dispatcher().finish(task_id)
+    except Exception:
+        logger.exception("Could not release fair-share slot", extra={'task_id': task_id})
+    reconcile_running_slots() # Also free slots other runs never gave back
+
+
+def task_download_dir(target_username, log_id, task_id):
+    """Working directory of a download: keyed by the DownloadLog id, so every attempt finds the same partial files."""
+    return os.path.join(settings.MEDIA_ROOT, 'downloads', target_username, str(log_id) if log_id else task_id)
+
+
+def discard_stored(uploader, files_info):
+    """The download will not finish: delete what this attempt's uploader and earlier attempts (files_info) stored."""
+    if uploader is not None:
+        uploader.discard()
+    storage = get_storage()
+    for item in files_info or []:
+        try:
+            storage.delete(item['storage_key'])
+        except Exception as e:
+            logger.warning("Could not delete stored file: %s", e, extra={'storage_key': item.get('storage_key')})
+
+
+def finish_cancelled(task_instance, log_entry, download_dir, uploader=None):
+    """Throw away what a cancelled run produced, record the cancellation and hand over to followers."""
+    discard_stored(uploader, earlier_stored(log_entry))
+    shutil.rmtree(download_dir, ignore_errors=True)
+    if log_entry is not None:
+        if log_entry.downloaded_files_info:
+            DownloadLog.objects.filter(id=log_entry.id).exclude(status='SUCCESS').update(downloaded_files_info=None)
+        if not mark_cancelled(log_entry):
+            log_entry.refresh_from_db(fields=['status'])
+        if log_entry.status == 'CANCELLED': # Also when the request marked it: its followers wait for this confirmation
+            notify_followers(log_entry)
+    task_instance.update_state(state='REVOKED', meta={'status': 'Cancelled', 'progress': 0})
+
+
+@task_revoked.connect
+def drop_revoked_download(sender=None, request=None, **kwargs):
+    """
+    A cancelled download's message was dropped before it ran: confirm the cancellation to its
+    followers, free its slot and any partial files of earlier attempts.
+    """
+    if getattr(sender, 'name', None) != download_video_task.name or request is None:
+        return
+    task_kwargs = request.kwargs or {}
+    try:
+        log_entry = DownloadLog.objects.filter(id=task_kwargs['log_id']).first() if task_kwargs.get('log_id') else None
+        if log_entry is not None and (mark_cancelled(log_entry) or log_entry.status == 'CANCELLED'):
+            notify_followers(log_entry)
+    except Exception:
+        logger.exception("Could not record revoked download", extra={'task_id': request.id})
+    release_fair_share_slot(request.id)
+    if task_kwargs.get('target_username'):
+        shutil.rmtree(task_download_dir(task_kwargs['target_username'], task_kwargs.get('log_id'), request.id), ignore_errors=True)
+
+
+@task_failure.connect
+def fail_timed_out_download(sender=None, task_id=None, exception=None, kwargs=None, **extra):
+    """
+    The hard time limit killed the pool process, so the task's own except/finally never ran.
+    Runs in the worker's main process: record the failure, hand over to followers, free the slot.
+    """
+    if getattr(sender, 'name', None) != download_video_task.name or not isinstance(exception, TimeLimitExceeded):
+        return
+    log_id = (kwargs or {}).get('log_id')
+    try:
+        if log_id:
+            now = timezone.now()
+            error_message = f"Time limit exceeded: killed after {exception.args[0] if exception.args else '?'}s"
+            if DownloadLog.objects.filter(id=log_id, status__in=ACTIVE_LEADER_STATUSES).update(status='FAILURE', error_message=error_message, finished_at=now, updated_at=now):
+                notify_followers(DownloadLog.objects.get(id=log_id))
+            logger.error("Download killed by the hard time limit", extra={'task_id': task_id, 'log_id': log_id})
+    except Exception:
+        logger.exception("Could not record timed out download", extra={'task_id': task_id, 'log_id': log_id})
+    finally:
+        release_fair_share_slot(task_id)
+
+
+@shared_task(ignore_result=True)
+def expire_speculative_download(log_id):
+    """Scheduled DOWNLOAD_SPECULATIVE_TIMEOUT after a speculative download was queued."""
+    speculation.expire(log_id)
+
+
+# Error text that no amount of retrying will fix
+PERMANENT_ERROR_MARKERS = ('Unsupported URL', 'Video unavailable', 'Private video', 'This video has been removed', 'Requested format is not available', 'Sign in to confirm your age')
+
+def is_retryable(exc):
+    """Network-ish failures are retried; bad URLs/formats and our own verification errors are not."""
+    yt_dlp = get_yt_dlp()
+    if isinstance(exc, yt_dlp.utils.DownloadError):
+        return not any(marker in str(exc) for marker in PERMANENT_ERROR_MARKERS)
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def retry_countdown(retries):
+    """Exponential backoff with a little jitter so retried jobs don't stampede."""
+    backoff = min(settings.DOWNLOAD_RETRY_BACKOFF * (2 ** retries), settings.DOWNLOAD_RETRY_BACKOFF_MAX)
+    return backoff + random.uniform(0, backoff / 4)
+
+
+def soft_deadline(request):
+    """time.monotonic() at which this execution's soft time limit runs out, or None without one."""
+    soft = (request.timelimit or (None, None))[1] # timelimit is (hard, soft)
+    return time.monotonic() + soft if soft else None
+
+
+def record_stall(log_entry, stall, action):
+    if log_entry is None:
+        return
+    log_entry.stall_events = (log_entry.stall_events or []) + [{
+        'at': timezone.now().isoformat(), 'attempt': log_entry.attempts, 'rate': round(stall.last_rate or 0),
+        'downloaded_bytes': stall.total, 'action': action,
+    }]
+    log_entry.save(update_fields=['stall_events', 'updated_at'])
+
+
+def download_with_stall_recovery(ydl_opts, url, stall, log_entry, log):
+    """
+    ydl.download([url]), restarted in place (partial files are resumed) with each of
+    STALL_RECOVERIES when the watchdog aborts it. Raises DownloadStalled once they are used up.
+    """
+    yt_dlp = get_yt_dlp()
+    recoveries = iter(STALL_RECOVERIES)
+    opts, pooled = ydl_opts, True
+    while True:
+        stall.reset()
+        try:
+            with new_youtube_dl(opts, pooled=pooled) as ydl:
+                ydl.download([url])
+            return
+        except yt_dlp.utils.DownloadCancelled: # Also MaxDownloadsReached and user cancellation
+            if not stall.tripped:
+                raise
+        recovery = next(recoveries, None)
+        action, overrides = recovery(opts) if recovery else ('failed', {})
+        record_stall(log_entry, stall, action)
+        log.warning("Download stalled at %.0f B/s: %s", stall.last_rate or 0, action, extra={'downloaded_bytes': stall.total})
+        if recovery is None:
+            raise DownloadStalled(
+                f"Download stalled: below {stall.min_rate / 1024:.0f} KiB/s for {stall.window:.0f}s, "
+                f"also after {len(STALL_RECOVERIES)} recovery attempt(s) ({stall.last_rate or 0:.0f} B/s)")
+        opts, pooled = {**opts, **overrides}, False # A YoutubeDL of its own: new connections, not the shared pool's
+
+
+def partial_download_bytes(directory):
+    """Bytes already on disk from an earlier attempt (.part files and fragments) that yt-dlp will resume from."""
+    total = 0
+    try:
+        for fname in os.listdir(directory):
+            if '.part' in fname or fname.endswith('.ytdl'):
+                try: total += os.path.getsize(os.path.join(directory, fname))
+                except OSError: pass
+    except FileNotFoundError:
+        pass
+    return total
+
+
+class StoredArchive(set):
+    """
+    yt-dlp's download_archive for one download: entries whose archive id is in it are skipped.
+    Seeded with the entries earlier attempts stored. yt-dlp add()s an entry's id right after
+    its post_hooks ran, which ties the id to the files those hooks just handed to the uploader.
+    """
+    def __init__(self, archive_ids=()):
+        super().__init__(archive_ids)
+        self.handed_over = [] # Paths given to the uploader since the last add()
+        self.paths_by_id = {}
+
+    def add(self, archive_id):
+        super().add(archive_id)
+        self.paths_by_id[archive_id] = self.handed_over
+        self.handed_over = []
+
+
+def earlier_stored(log_entry):
+    """downloaded_files_info items earlier attempts of an unfinished download already stored."""
+    if log_entry is None or log_entry.status == 'SUCCESS':
+        return []
+    return [item for item in (log_entry.downloaded_files_info or []) if isinstance(item, dict) and item.get('storage_key')]
+
+
+def stored_so_far(uploader, archive):
+    """
+    Before a retry: wait for this attempt's uploads and describe what got stored, tagged with the entry's
+    archive id where known, so the next attempt skips those entries instead of fetching them again.
+    """
+    if uploader is None:
+        return []
+    archive_ids = {path: archive_id for archive_id, paths in archive.paths_by_id.items() for path in paths}
+    return [{**file_info(key, os.path.basename(path), details), **({'archive_id': archive_ids[path]} if path in archive_ids else {})}
+            for path, (key, details) in uploader.stored().items()]
+
+
+def merge_stored(earlier, fresh):
+    """Files of earlier attempts followed by this attempt's, one item per storage key."""
+    keys = {item['storage_key'] for item in fresh}
+    return [item for item in earlier if item['storage_key'] not in keys] + fresh
 
 
 # --- Main Celery Task ---
-@shared_task(bind=True, throws=(yt_dlp.utils.DownloadError, FileNotFoundError, Exception))
-def download_video_task(self, *, url, format_code, format_type, target_username, is_playlist=False, filename_template=None, log_id=None):
+# acks_late + reject_on_worker_lost: a worker killed mid-download (OOM, deploy, node loss) leaves the
+# message unacknowledged, so the broker redelivers it and the next attempt resumes in the same directory.
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=settings.DOWNLOAD_MAX_RETRIES, throws=(FileNotFoundError, Exception))
+def download_video_task(self, *, url, format_code, format_type, target_username, is_playlist=False, playlist_items=None, filename_template=None, log_id=None, clip_start=None, clip_end=None, accurate_cut=False):
     """
     Downloads video/audio or playlist using yt-dlp.
     Embeds metadata and thumbnail into the output file where supported.
     Handles progress updates and reports success or failure via return/raise.
     Accepts keyword arguments.
     Updates DownloadLog model.
+    Retries transient failures with backoff; every attempt works in a directory keyed
+    by the DownloadLog id, so partial .part/fragment files are resumed rather than redone.
+    With clip_start/clip_end only that section of the media is fetched and processed.
     """
     task_id = self.request.id # Celery's internal task ID
-    print(f"Starting task {task_id} for target_user={target_username}, format_code={format_code}, type={format_type}, playlist={is_playlist}, template='{filename_template}', url={url}, log_id={log_id}")
+    yt_dlp = get_yt_dlp() # Already imported and warm in worker processes
+    log = FieldsAdapter(logger, {'task_id': task_id, 'log_id': log_id}) # Every record of this run carries its ids
+    log.info("Starting download", extra={'target_user': target_username, 'format_code': format_code, 'format_type': format_type, 'playlist': is_playlist, 'items': playlist_items,
+                                         'template': filename_template, 'clip': f"{clip_start}-{clip_end}{' (accurate)' if accurate_cut else ''}", 'url': url})
 
     log_entry = None
     if log_id:
         try:
             log_entry = DownloadLog.objects.get(id=log_id)
         except DownloadLog.DoesNotExist:
-            print(f"Error: Could not find DownloadLog with id {log_id} for task {task_id}")
+            log.error("DownloadLog not found")
             # Task will proceed but won't update this specific log entry if not found
 
+    # Setup download directory: stable across retries and redeliveries so partial data survives
+    task_specific_download_dir = task_download_dir(target_username, log_id, task_id)
+    if cancel_requested(task_id) or (log_entry and log_entry.status == 'CANCELLED'):
+        log.info("Cancelled before it started")
+        finish_cancelled(self, log_entry, task_specific_download_dir)
+        release_fair_share_slot(task_id)
+        raise Ignore()
+    os.makedirs(task_specific_download_dir, exist_ok=True)
+    log.debug("Download directory: %s", task_specific_download_dir)
+    resumable_bytes = partial_download_bytes(task_specific_download_dir)
+    if resumable_bytes:
+        log.info("Resuming with %d bytes of partial data from an earlier attempt", resumable_bytes)
+
     # Update log to STARTED if found
     if log_entry:
         log_entry.status = 'STARTED'
-        log_entry.save(update_fields=['status', 'updated_at'])
-
-    # Setup download directory
-    user_download_dir = os.path.join(settings.MEDIA_ROOT, 'downloads', target_username)
-    task_specific_download_dir = os.path.join(user_download_dir, task_id) # Use Celery task_id for unique folder
-    os.makedirs(task_specific_download_dir, exist_ok=True)
-    print(f"Task {task_id}: Download directory: {task_specific_download_dir}")
+        log_entry.attempts = F('attempts') + 1
+        log_entry.resumed_bytes = F('resumed_bytes') + resumable_bytes
+        log_entry.save(update_fields=['status', 'attempts', 'resumed_bytes', 'updated_at'])
+        log_entry.refresh_from_db(fields=['attempts', 'resumed_bytes'])
+        if log_entry.attempts > settings.DOWNLOAD_MAX_RETRIES + 1:
+            # max_retries only counts self.retry(): a download whose worker keeps getting killed (OOM, hard
+            # time limit, child recycling) is redelivered by the broker until we stop acking it here
+            discard_stored(None, earlier_stored(log_entry))
+            log_entry.status = 'FAILURE'
+            log_entry.error_message = f"Gave up after {log_entry.attempts - 1} attempts: the worker running it was lost each time"
+            log_entry.finished_at = timezone.now()
+            log_entry.downloaded_files_info = None
+            log_entry.save(update_fields=['status', 'error_message', 'finished_at', 'downloaded_files_info', 'updated_at'])
+            log.error("Download redelivered too often, giving up", extra={'attempts': log_entry.attempts - 1})
+            notify_followers(log_entry)
+            release_fair_share_slot(task_id)
+            return None
 
+    terminal = True # False when this attempt ends in a retry; slot and followers wait for the final outcome
+    # The watch also stops the run at the soft time limit: yt-dlp swallows SoftTimeLimitExceeded in playlists
+    watch = CancelWatch(task_id, deadline=soft_deadline(self.request)).start()
+    stall = StallWatchdog()
+    memory = TaskMemory()
+    carried = earlier_stored(log_entry) # Entries earlier attempts stored: skipped via the download archive
+    uploader = archive = None
     try:
         self.update_state(state='STARTED', meta={'status': 'Initializing...', 'progress': 0})
 
@@ -100,20 +378,22 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
         chosen_template = (sanitized_user_template if sanitized_user_template else 
                            (default_template_playlist if is_playlist else default_template_single))
         if os.path.isabs(chosen_template) or '..' in chosen_template.split(os.sep):
-            print(f"Task {task_id}: Invalid template path chars, reverting to default.")
+            log.warning("Invalid template path chars, reverting to default")
             chosen_template = default_template_playlist if is_playlist else default_template_single
         output_template_with_ext = os.path.join(task_specific_download_dir, chosen_template)
         # Forcing MP4/target audio extension often requires post-processing, so use yt-dlp's %(ext)s for initial download
         # The actual final extension is determined later.
-        print(f"Task {task_id}: Base output template pattern: {output_template_with_ext}")
+        log.debug("Base output template pattern: %s", output_template_with_ext)
 
         # --- Prepare yt-dlp Options ---
         ydl_opts = {
             'outtmpl': output_template_with_ext, # Let yt-dlp fill %(ext)s initially
-            'progress_hooks': [lambda d: update_progress(self, d)],
-            'nocheckcertificate': True, 'noplaylist': not is_playlist,
+            'progress_hooks': [lambda d: update_progress(self, d, watch, stall), memory.sample],
+            'noplaylist': not is_playlist,
+            'continuedl': True, # Resume .part files / fragments left by an earlier attempt
             'max_downloads': 1 if not is_playlist else None,
-            'quiet': False, 'no_warnings': False, 'ignoreerrors': is_playlist,
+            'quiet': True, 'noprogress': True, 'ignoreerrors': is_playlist, # Progress is reported by the hook above
+            'logger': YtDlpLogger(sample=settings.LOG_SAMPLE_EVERY if is_playlist else 1, task_id=task_id, log_id=log_id),
             'addmetadata': True, 'metadatacommand': 'ffmpeg', 'parsemetadata': '%(artist,title)s',
             'ppa': [
                 'Metadata+ffmpeg:-metadata', f'artist={'"%(uploader)s"'}',
@@ -139,7 +419,7 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
             elif target_final_codec == 'aac': pp = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'aac', 'preferredquality': '192'}; can_embed_thumbnail = True;
             elif target_final_codec == 'flac': pp = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'flac'}; can_embed_thumbnail = True;
             elif target_final_codec == 'opus': pp = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}; can_embed_thumbnail = True;
-            else: pp = None; print(f"Warning: Unsupported conversion target '{target_final_codec}'.")
+            else: pp = None; log.warning("Unsupported conversion target '%s'", target_final_codec)
             if pp: postprocessors.append(pp)
             ydl_opts['keepvideo'] = False # For audio extraction
         else: # Direct Download or Video Merge/Conversion
@@ -159,18 +439,18 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
                  elif 'wav' in format_code.lower(): expected_final_extension = '.wav'; can_embed_thumbnail = False;
                  elif 'flac' in format_code.lower(): expected_final_extension = '.flac'; can_embed_thumbnail = True;
                  elif 'opus' in format_code.lower(): expected_final_extension = '.opus'; can_embed_thumbnail = True; # Often in .ogg
-                 else: expected_final_extension = '.audio'; can_embed_thumbnail = False; # Fallback
+                 else: expected_final_extension = ''; can_embed_thumbnail = False; # Plain format id (e.g. a budget pick): accept any known media extension
 
         # Conditionally enable thumbnail embedding in options
         if can_embed_thumbnail:
-            print(f"Task {task_id}: Enabling thumbnail writing and embedding.")
+            log.debug("Enabling thumbnail writing and embedding")
             ydl_opts['writethumbnail'] = True
             ydl_opts['embedthumbnail'] = True
             # Add EmbedThumbnail PP explicitly if no other PPs will handle it
             if not any(pp.get('key') in ['FFmpegExtractAudio', 'FFmpegVideoConvertor'] for pp in postprocessors):
                 postprocessors.append({'key': 'EmbedThumbnail', 'already_have_thumbnail': False})
         else:
-            print(f"Task {task_id}: Thumbnail embedding disabled for target format '{target_final_codec or actual_format_code_for_yt_dlp}'.")
+            log.debug("Thumbnail embedding disabled for target format '%s'", target_final_codec or actual_format_code_for_yt_dlp)
             ydl_opts['writethumbnail'] = False # Ensure it's off
             ydl_opts['embedthumbnail'] = False
 
@@ -181,35 +461,67 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
             # Add new PPs, avoid duplicates if 'postprocessors' key was already there
             ydl_opts['postprocessors'] = existing_pps + [pp for pp in postprocessors if pp not in existing_pps]
 
+        if is_playlist and playlist_items:
+            ydl_opts['playlist_items'] = playlist_items # Only the entries the user picked
+        if is_playlist:
+            ydl_opts['extract_flat'] = 'discard_in_playlist' # Drop each entry's info dict once it is downloaded instead of holding all of them
+
+        if clip_start is not None or clip_end is not None:
+            # Only the section is fetched: the covering fragments for HLS/DASH, an ffmpeg seek into the stream otherwise
+            ydl_opts['download_ranges'] = yt_dlp.utils.download_range_func(None, [(clip_start or 0, clip_end if clip_end is not None else float('inf'))])
+            # Stream copy cuts on keyframes. Re-encoding is only needed for an exact video cut; audio copies cut cleanly
+            ydl_opts['force_keyframes_at_cuts'] = bool(accurate_cut) and format_type == 'video'
+
         # Clean up max_downloads option if None
         if ydl_opts.get('max_downloads') is None:
             del ydl_opts['max_downloads']
 
+        KNOWN_MEDIA_EXTENSIONS = {'.mp4', '.mkv', '.webm', '.flv', '.avi', '.mov', '.mp3', '.m4a', '.aac', '.wav', '.opus', '.flac'}
+        # Target extension for primary media file, taking from forced conversion or best guess
+        target_media_extension = expected_final_extension.lower() if '.' in expected_final_extension else None
+
+        def is_primary_target_media(fname):
+            ext_lower = os.path.splitext(fname)[1].lower()
+            if target_media_extension:
+                return ext_lower == target_media_extension
+            return ext_lower in KNOWN_MEDIA_EXTENSIONS # Fallback if ext wasn't certain
+
+        # Finished files go to the storage backend as soon as yt-dlp is done with them (post_hooks run
+        # after post-processing), so uploads overlap the next playlist entry's download.
+        uploader = BackgroundUploader()
+        archive = StoredArchive(item['archive_id'] for item in carried if item.get('archive_id'))
+        def hand_over(path):
+            if is_primary_target_media(os.path.basename(path)):
+                uploader.submit(path)
+                archive.handed_over.append(path)
+        ydl_opts['post_hooks'] = [hand_over]
+        ydl_opts['download_archive'] = archive
+
         # 3. Perform the download
         if log_entry: log_entry.status = 'DOWNLOADING'; log_entry.save(update_fields=['status', 'updated_at'])
         self.update_state(state='PROGRESS', meta={'status': 'Starting download...', 'progress': 5})
-        print(f"Task {task_id}: Running yt-dlp with final options: {ydl_opts}")
+        log.debug("Running yt-dlp with final options: %s", ydl_opts) # Formatted only when DEBUG is on
         download_success_flag = False
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+            download_with_stall_recovery(ydl_opts, url, stall, log_entry, log)
             download_success_flag = True
-            print(f"Task {task_id}: yt-dlp download process finished ok.")
+            log.info("yt-dlp download process finished ok")
         except yt_dlp.utils.MaxDownloadsReached:
             if not is_playlist:
                 download_success_flag = True
-                print(f"Task {task_id}: yt-dlp finished via MaxDownloadsReached (expected).")
+                log.debug("yt-dlp finished via MaxDownloadsReached (expected)")
             else:
-                print(f"Task {task_id}: WARNING - MaxDownloadsReached during playlist download?")
+                log.warning("MaxDownloadsReached during playlist download")
                 download_success_flag = True # Assume success for playlist and check files
 
         # 4. Find and verify downloaded files if download block seemed okay
         if not download_success_flag:
             raise Exception("Download process failed before file verification stage.")
+        watch.raise_if_cancelled() # Cancelled during the last post-processing step
 
         if log_entry: log_entry.status = 'VERIFYING'; log_entry.save(update_fields=['status', 'updated_at'])
         self.update_state(state='PROGRESS', meta={'status': 'Verifying output...', 'progress': 99})
-        print(f"Task {task_id}: Scanning {task_specific_download_dir} for final media file(s)...")
+        log.debug("Scanning %s for final media file(s)", task_specific_download_dir)
 
         downloaded_files_info_list = []
         temp_files_to_remove_list = []
@@ -217,16 +529,13 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
             possible_files_in_dir = os.listdir(task_specific_download_dir)
         except FileNotFoundError:
             possible_files_in_dir = []
-            print(f"Task {task_id}: Task directory not found during verification.")
+            log.warning("Task directory not found during verification")
 
-        if not possible_files_in_dir and download_success_flag:
+        # Files the post_hooks already handed over may be gone from disk (remote backends without a local copy)
+        if not possible_files_in_dir and not uploader.futures and not carried and download_success_flag:
             raise FileNotFoundError(f"No files found in {task_specific_download_dir} after download process claimed success.")
 
-        print(f"Task {task_id}: Found raw files in task directory: {possible_files_in_dir}")
-
-        KNOWN_MEDIA_EXTENSIONS = {'.mp4', '.mkv', '.webm', '.flv', '.avi', '.mov', '.mp3', '.m4a', '.aac', '.wav', '.opus', '.flac'}
-        # Target extension for primary media file, taking from forced conversion or best guess
-        target_media_extension = expected_final_extension.lower() if '.' in expected_final_extension else None
+        log.debug("Found raw files in task directory: %s", possible_files_in_dir)
 
         for fname in possible_files_in_dir:
             file_path = os.path.join(task_specific_download_dir, fname)
@@ -235,33 +544,29 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
             _, ext = os.path.splitext(fname)
             ext_lower = ext.lower()
 
-            is_primary_target_media = False
-            if target_media_extension and ext_lower == target_media_extension:
-                is_primary_target_media = True
-            elif not target_media_extension and ext_lower in KNOWN_MEDIA_EXTENSIONS: # Fallback if ext wasn't certain
-                is_primary_target_media = True # Could be the one if no specific ext was forced
-
-            if is_primary_target_media:
-                 relative_path = os.path.relpath(file_path, settings.MEDIA_ROOT)
-                 file_url = os.path.join(settings.MEDIA_URL, relative_path).replace("\\", "/")
-                 downloaded_files_info_list.append({'filename': fname, 'file_url': file_url})
-                 print(f"Task {task_id}: Found valid media file: {fname}")
+            if is_primary_target_media(fname):
+                 uploader.submit(file_path) # No-op if post_hooks already handed it over
+                 log.debug("Found valid media file: %s", fname)
             elif ext_lower in {'.json', '.jpg', '.jpeg', '.png', '.webp', '.part', '.ytdl', '.temp'} or \
                  (target_media_extension and ext_lower != target_media_extension and ext_lower in KNOWN_MEDIA_EXTENSIONS):
                  # If it's a known temp file OR a media file that isn't our *final target* extension (e.g. original webm after mp4 conversion)
                  temp_files_to_remove_list.append(file_path)
-                 print(f"Task {task_id}: Identified intermediate/temp file for removal: {fname}")
+                 log.debug("Identified intermediate/temp file for removal: %s", fname)
             else:
-                 print(f"Task {task_id}: Skipping unknown file type during filtering: {fname}")
+                 log.debug("Skipping unknown file type during filtering: %s", fname)
 
         # --- Optional Cleanup of temp files ---
-        print(f"Task {task_id}: Cleaning up {len(temp_files_to_remove_list)} intermediate/temp file(s)...")
+        log.debug("Cleaning up %d intermediate/temp file(s)", len(temp_files_to_remove_list))
         for temp_path in temp_files_to_remove_list:
             try:
-                print(f"Task {task_id}: Removing file: {os.path.basename(temp_path)}")
                 os.remove(temp_path)
             except OSError as rm_err:
-                print(f"Warning: Could not remove temp file {os.path.basename(temp_path)}: {rm_err}")
+                log.warning("Could not remove temp file %s: %s", os.path.basename(temp_path), rm_err)
+
+        # Wait for storage uploads (immediate for the local backend)
+        stored_files = uploader.wait()
+        downloaded_files_info_list = [file_info(key, os.path.basename(path), details) for path, (key, details) in stored_files.items()]
+        downloaded_files_info_list = [{k: v for k, v in item.items() if k != 'archive_id'} for item in merge_stored(carried, downloaded_files_info_list)]
 
         if not downloaded_files_info_list and download_success_flag:
             raise FileNotFoundError(f"No file with expected characteristics (e.g., extension '{expected_final_extension}') found in {task_specific_download_dir} after processing. Raw files: {possible_files_in_dir}")
@@ -270,17 +575,55 @@ def download_video_task(self, *, url, format_code, format_type, target_username,
         if log_entry:
             log_entry.status = 'SUCCESS'
             log_entry.downloaded_files_info = downloaded_files_info_list
-            log_entry.save(update_fields=['status', 'downloaded_files_info', 'updated_at'])
-        print(f"Task {task_id}: Success! Resulting files: {downloaded_files_info_list}")
+            log_entry.finished_at = timezone.now()
+            with transaction.atomic(): # The files and the owner's usage counter change together
+                log_entry.save(update_fields=['status', 'downloaded_files_info', 'finished_at', 'updated_at'])
+                charge(log_entry)
+            notify_followers(log_entry)
+        log.info("Download succeeded", extra={'files': len(downloaded_files_info_list)})
         return downloaded_files_info_list
 
     # --- Exception Handling ---
     except Exception as e: # Catches DownloadError, FileNotFoundError, and any other
+        if watch.check(force=True): # Whatever failed, it was because we stopped it (or it no longer matters)
+            log.info("Download cancelled")
+            finish_cancelled(self, log_entry, task_specific_download_dir, uploader)
+            raise Ignore()
         error_message = f'{type(e).__name__}: {str(e)}'
-        print(f"Task {task_id} failed: {error_message}")
+        timed_out = isinstance(e, SoftTimeLimitExceeded) or watch.timed_out()
+        if timed_out:
+            error_message = f"Time limit exceeded: not finished within {(self.request.timelimit or (None, None))[1] or '?'}s" # timelimit is (hard, soft)
+        if not timed_out and is_retryable(e) and self.request.retries < self.max_retries:
+            countdown = retry_countdown(self.request.retries)
+            log.warning("Attempt %d failed (%s); retrying in %.0fs", self.request.retries + 1, error_message, countdown)
+            stored = stored_so_far(uploader, archive) # Remote backends may have removed the local copies already
+            if log_entry:
+                log_entry.status = 'RETRYING'
+                log_entry.error_message = error_message
+                log_entry.downloaded_files_info = merge_stored(carried, stored) or None
+                log_entry.save(update_fields=['status', 'error_message', 'downloaded_files_info', 'updated_at'])
+            terminal = False
+            raise self.retry(exc=e, countdown=countdown) # Partial files stay in place for the next attempt
+        discard_stored(uploader, carried) # Nothing of a failed download is kept, so nothing is left unaccounted
         if log_entry:
             log_entry.status = 'FAILURE'
             log_entry.error_message = error_message # Store the simplified error
-            log_entry.save(update_fields=['status', 'error_message', 'updated_at'])
-        traceback.print_exc() # Log full traceback to Celery worker console
-        raise # Re-raise for Celery to store the actual exception object in result
\ No newline at end of file
+            log_entry.finished_at = timezone.now()
+            log_entry.downloaded_files_info = None
+            log_entry.save(update_fields=['status', 'error_message', 'finished_at', 'downloaded_files_info', 'updated_at'])
+            notify_followers(log_entry)
+        log.exception("Download failed: %s", error_message)
+        raise # Re-raise for Celery to store the actual exception object in result
+    finally:
+        watch.stop()
+        if terminal:
+            release_fair_share_slot(task_id)
+        try:
+            release_memory() # Lower the base the next task's peak starts from
+            peak_rss, rss_delta = memory.finish()
+            log.debug("Memory: peak RSS %s bytes, delta %s bytes", peak_rss, rss_delta)
+            if log_entry:
+                peak = {'peak_rss_bytes': Greatest(Coalesce('peak_rss_bytes', 0), peak_rss)} if peak_rss is not None else {} # Highest over all attempts
+                DownloadLog.objects.filter(id=log_entry.id).update(transferred_bytes=F('transferred_bytes') + stall.received, rss_delta_bytes=rss_delta, **peak)
+        except Exception: # Must not replace the task's own outcome (or its Retry); a DB error may be why it failed
+            log.exception("Could not record transfer and memory figures")
\ No newline at end of file
@@ -1,3 +1,1193 @@
-from django.test import TestCase
+import hashlib
+import heapq
+from datetime import timedelta
+import io
+import logging
+import logging.handlers
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import TimeLimitExceeded
+from celery.signals import task_failure, task_revoked
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import cancellation, job_cost, memory, scheduler, singleflight, speculation, storage, tasks, usage
+from .admission import admit
+from .auth_backends import CachedModelBackend, clear_user_cache
+from .logs import BackgroundQueueHandler, SamplingFilter, StructuredFormatter, YtDlpLogger
+from .models import DownloadLog, UserStorageUsage
+from .scheduler import FairShareDispatcher, InMemoryQueueStore, make_job
+from .tasks import finish_cancelled, update_progress
+from .ytdl import get_yt_dlp
+from .views import validate_download_request
+from .watchdog import DownloadStalled, StallWatchdog
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+NO_BROKER_ADMISSION = {'DOWNLOAD_ADMISSION_CHECK_BROKER': False, 'DOWNLOAD_ADMISSION_MIN_FREE_BYTES': 0}
+
+
+def simulate(jobs, workers, per_user_cap=None, job_duration=1.0):
+    """
+    Discrete-event run of (username, submit_time) jobs over a FIFO broker feeding
+    `workers` workers. per_user_cap=None sends jobs straight to the broker (the old
+    behaviour); otherwise they go through the fair-share dispatcher.
+    Returns {task_id: (username, wait_time)}.
+    """
+    broker = []
+    submitted_at, started_at = {}, {}
+    dispatcher = None
+    if per_user_cap is not None:
+        dispatcher = FairShareDispatcher(InMemoryQueueStore(), per_user_cap, broker.extend)
+
+    arrivals = sorted((t, i, username) for i, (username, t) in enumerate(jobs))
+    running = [] # heap of (finish_time, task_id)
+    idle, now = workers, 0.0
+    while arrivals or broker or running:
+        next_arrival = arrivals[0][0] if arrivals else float('inf')
+        next_finish = running[0][0] if running else float('inf')
+        if arrivals and next_arrival <= next_finish:
+            now, i, username = heapq.heappop(arrivals)
+            job = make_job(f"t{i}", i, username, {})
+            submitted_at[job['task_id']] = (username, now)
+            if dispatcher: dispatcher.submit(job)
+            else: broker.append(job)
+        else:
+            now, task_id = heapq.heappop(running)
+            idle += 1
+            if dispatcher: dispatcher.finish(task_id)
+        while idle and broker:
+            job = broker.pop(0)
+            started_at[job['task_id']] = now
+            heapq.heappush(running, (now + job_duration, job['task_id']))
+            idle -= 1
+    return {tid: (user, started_at[tid] - t) for tid, (user, t) in submitted_at.items()}
+
+
+class FairShareSimulationTests(SimpleTestCase):
+    WORKERS = 4
+
+    def skewed_load(self):
+        # One user dumps 100 jobs, then four users submit 3 jobs each a moment later
+        jobs = [('heavy', 0.0)] * 100
+        for n in range(4):
+            jobs += [(f'light{n}', 0.1)] * 3
+        return jobs
+
+    def max_wait(self, result, prefix):
+        return max(wait for user, wait in result.values() if user.startswith(prefix))
+
+    def test_light_users_wait_behind_everything_without_fair_share(self):
+        result = simulate(self.skewed_load(), self.WORKERS)
+        self.assertGreaterEqual(self.max_wait(result, 'light'), 100 / self.WORKERS - 1)
+
+    def test_light_user_wait_is_bounded_under_skewed_load(self):
+        result = simulate(self.skewed_load(), self.WORKERS, per_user_cap=2)
+        # Each light user needs two rounds of the 5-user rotation: a handful of job lengths
+        self.assertLessEqual(self.max_wait(result, 'light'), 5)
+        # The heavy user is held to its cap of 2 running jobs, but never starved
+        self.assertEqual(sum(1 for user, _ in result.values() if user == 'heavy'), 100)
+        self.assertLessEqual(self.max_wait(result, 'heavy'), 100 / 2 + 2)
+
+    def test_per_user_running_cap_is_enforced(self):
+        released = []
+        dispatcher = FairShareDispatcher(InMemoryQueueStore(), 2, released.extend)
+        for i in range(5):
+            dispatcher.submit(make_job(f"t{i}", i, 'alice', {}))
+        self.assertEqual([j['task_id'] for j in released], ['t0', 't1'])
+        self.assertEqual(dispatcher.queue_position('t2'), 1)
+        self.assertEqual(dispatcher.queue_position('t4'), 3)
+        dispatcher.finish('t0')
+        self.assertEqual([j['task_id'] for j in released], ['t0', 't1', 't2'])
+        self.assertIsNone(dispatcher.queue_position('t2'))
+        self.assertEqual(dispatcher.queue_position('t4'), 2)
+
+    def test_release_alternates_between_users(self):
+        released = []
+        dispatcher = FairShareDispatcher(InMemoryQueueStore(), 1, released.extend)
+        for i in range(3):
+            dispatcher.submit(make_job(f"a{i}", i, 'alice', {}))
+        for i in range(3):
+            dispatcher.submit(make_job(f"b{i}", i, 'bob', {}))
+        dispatcher.finish('a0'); dispatcher.finish('b0')
+        dispatcher.finish('a1'); dispatcher.finish('b1')
+        self.assertEqual([j['task_id'] for j in released], ['a0', 'b0', 'a1', 'b1', 'a2', 'b2'])
+
+    def test_smaller_jobs_overtake_and_waiting_jobs_age(self):
+        released, now = [], [0.0]
+        dispatcher = FairShareDispatcher(InMemoryQueueStore(), 1, released.extend, aging_seconds=300, clock=lambda: now[0])
+        dispatcher.submit(make_job('running', 0, 'alice', {}, priority=0, submitted_at=0))
+        dispatcher.submit(make_job('playlist', 1, 'alice', {}, priority=9, submitted_at=0))
+        dispatcher.submit(make_job('clip', 2, 'alice', {}, priority=0, submitted_at=1))
+        self.assertEqual(dispatcher.queue_position('clip'), 1) # Submitted later, but shorter
+        dispatcher.finish('running')
+        self.assertEqual(released[-1]['task_id'], 'clip')
+
+        # A steady stream of short jobs cannot hold the playlist back forever
+        now[0] = 300 * 7
+        dispatcher.submit(make_job('clip2', 3, 'alice', {}, priority=3, submitted_at=now[0]))
+        dispatcher.finish('clip')
+        self.assertEqual(released[-1]['task_id'], 'playlist')
+        self.assertEqual(released[-1]['effective_priority'], 2)
+
+    def test_jobs_wait_and_age_here_rather_than_in_the_broker(self):
+        released, now = [], [0.0]
+        dispatcher = FairShareDispatcher(InMemoryQueueStore(), 2, released.extend, aging_seconds=300, clock=lambda: now[0], max_in_flight=2)
+        dispatcher.submit(make_job('a0', 0, 'alice', {}, priority=0, submitted_at=0))
+        dispatcher.submit(make_job('a1', 1, 'alice', {}, priority=0, submitted_at=0))
+        dispatcher.submit(make_job('playlist', 2, 'bob', {}, priority=9, submitted_at=0))
+        self.assertEqual([j['task_id'] for j in released], ['a0', 'a1']) # Bob waits here, not in the broker
+
+        # Short jobs keep arriving, but the freed slot goes to Bob with the priority he has aged to
+        now[0] = 300 * 4
+        dispatcher.submit(make_job('c0', 3, 'carol', {}, priority=0, submitted_at=now[0]))
+        dispatcher.finish('a0')
+        self.assertEqual((released[-1]['task_id'], released[-1]['effective_priority']), ('playlist', 5))
+        dispatcher.finish('a1')
+        self.assertEqual([j['task_id'] for j in released], ['a0', 'a1', 'playlist', 'c0'])
+
+    def test_slots_never_given_back_are_reconciled(self):
+        released, now = [], [0.0]
+        dispatcher = FairShareDispatcher(InMemoryQueueStore(), 2, released.extend, clock=lambda: now[0], lease=lambda job: job['time_limit'])
+        dispatcher.submit(make_job('lost', 0, 'alice', {}, time_limit=100))
+        dispatcher.submit(make_job('hung', 1, 'alice', {}, time_limit=50))
+        dispatcher.submit(make_job('next', 2, 'alice', {}))
+        dispatcher.submit(make_job('last', 3, 'alice', {}))
+
+        # The worker died without running its finally: the log is terminal but the slot is still held
+        self.assertEqual(dispatcher.reconcile(lambda task_ids: ['lost']), {'lost'})
+        self.assertEqual([j['task_id'] for j in released], ['lost', 'hung', 'next'])
+
+        # A job whose log still looks active keeps its slot until its lease runs out
+        self.assertEqual(dispatcher.reconcile(lambda task_ids: []), set())
+        now[0] = 51
+        self.assertEqual(dispatcher.reconcile(lambda task_ids: []), {'hung'})
+        self.assertEqual(released[-1]['task_id'], 'last')
+        self.assertEqual(dispatcher.reconcile(lambda task_ids: []), set()) # 'next' has no lease
+
+    def test_lease_covers_every_attempt_running_to_its_hard_limit(self):
+        lease = scheduler.slot_lease(make_job('t', 0, 'alice', {}, time_limit=600))
+        self.assertGreater(lease, 600 * 6)
+        self.assertGreater(scheduler.slot_lease(make_job('t', 0, 'alice', {})), 6 * 11 * 60 * 60)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root))
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+
+    def request(self, user, n, **fields):
+        log_entry = DownloadLog.objects.create(
+            user=user, target_user_for_download=user, url='https://example.com/watch?v=abc',
+            format_code_selected='best', format_type_selected='video', task_id=f'task-{n}', **fields,
+        )
+        return log_entry, singleflight.attach_or_lead(log_entry)
+
+    def test_identical_request_follows_leader_and_gets_hardlink(self):
+        leader, attached_to = self.request(self.alice, 1)
+        self.assertIsNone(attached_to)
+        follower, attached_to = self.request(self.bob, 2)
+        self.assertEqual(attached_to, leader)
+        self.assertEqual(follower.status, 'ATTACHED')
+
+        leader_dir = os.path.join(self.media_root, 'downloads', 'alice', str(leader.id))
+        os.makedirs(leader_dir)
+        with open(os.path.join(leader_dir, 'clip.mp4'), 'wb') as f:
+            f.write(b'data')
+        leader.status = 'SUCCESS'
+        leader.downloaded_files_info = [{'filename': 'clip.mp4', 'file_url': f'/media/downloads/alice/{leader.id}/clip.mp4'}]
+        leader.save()
+        singleflight.leader_finished(leader)
+
+        follower.refresh_from_db()
+        self.assertEqual(follower.status, 'SUCCESS')
+        follower_file = os.path.join(self.media_root, 'downloads', 'bob', str(follower.id), 'clip.mp4')
+        self.assertTrue(os.path.samefile(follower_file, os.path.join(leader_dir, 'clip.mp4')))
+        # A later identical request is served from the finished download without running again
+        later, served_by = self.request(self.alice, 3)
+        self.assertEqual(served_by, leader)
+        self.assertEqual(later.status, 'SUCCESS')
+        later_file = os.path.join(self.media_root, 'downloads', 'alice', str(later.id), 'clip.mp4')
+        self.assertTrue(os.path.samefile(later_file, follower_file))
+        # ...unless its files are gone
+        os.remove(os.path.join(leader_dir, 'clip.mp4'))
+        self.assertIsNone(self.request(self.alice, 4)[1])
+
+    def test_registry_outlives_a_leader_running_every_attempt_to_the_time_limit(self):
+        with mock.patch.object(cache, 'add', wraps=cache.add) as add:
+            self.request(self.alice, 1)
+        timeout = add.call_args.args[2]
+        retries = settings.DOWNLOAD_MAX_RETRIES
+        self.assertGreater(timeout, (retries + 1) * settings.DOWNLOAD_TIME_LIMIT_MAX + retries * settings.DOWNLOAD_RETRY_BACKOFF_MAX)
+        with override_settings(DOWNLOAD_TIME_LIMIT_MAX=2 * settings.DOWNLOAD_TIME_LIMIT_MAX):
+            self.assertGreater(singleflight.registry_timeout(), timeout)
+
+    def test_clip_ranges_are_separate_recipes(self):
+        _, attached_to = self.request(self.alice, 1, clip_start=30.0, clip_end=60.0)
+        self.assertIsNone(attached_to)
+        self.assertIsNone(self.request(self.bob, 2)[1]) # The whole video is a different download
+        self.assertIsNone(self.request(self.bob, 3, clip_start=30.0, clip_end=60.0, accurate_cut=True)[1])
+        self.assertIsNotNone(self.request(self.bob, 4, clip_start=30.0, clip_end=60.0)[1])
+
+    def test_failed_leader_promotes_oldest_follower(self):
+        leader, _ = self.request(self.alice, 1)
+        first, _ = self.request(self.bob, 2)
+        second, _ = self.request(self.alice, 3)
+        leader.status = 'FAILURE'
+        leader.save()
+        with mock.patch.object(singleflight, 'submit_log') as submit_log:
+            singleflight.leader_finished(leader)
+        submit_log.assert_called_once()
+        self.assertEqual(submit_log.call_args.args[0].id, first.id)
+        first.refresh_from_db(); second.refresh_from_db()
+        self.assertEqual((first.status, first.leader_id), ('PENDING', None))
+        self.assertEqual((second.status, second.leader_id), ('ATTACHED', first.id))
+
+
+class ClipRequestTests(SimpleTestCase):
+    def clean(self, **data):
+        return validate_download_request({'url': 'https://example.com/watch?v=abc', 'format_code': 'best', 'format_type': 'video', **data})
+
+    def test_timestamps_parse_to_seconds(self):
+        cleaned, error = self.clean(start_time='1:02:03.5', end_time=3730, accurate_cut=True)
+        self.assertIsNone(error)
+        self.assertEqual((cleaned['clip_start'], cleaned['clip_end'], cleaned['accurate_cut']), (3723.5, 3730.0, True))
+        cleaned, _ = self.clean(start_time='0:00', accurate_cut=True) # Starting at 0 with no end is the whole video
+        self.assertEqual((cleaned['clip_start'], cleaned['clip_end'], cleaned['accurate_cut']), (None, None, False))
+
+    def test_bad_ranges_are_rejected(self):
+        for data in ({'start_time': '1:xx'}, {'start_time': -5}, {'start_time': 60, 'end_time': 30}, {'end_time': 'nan'}, {'end_time': 10, 'is_playlist': True}):
+            self.assertIsNotNone(self.clean(**data)[1], data)
+
+    def test_flags_are_read_like_form_booleans(self):
+        self.assertFalse(self.clean(is_playlist='false')[0]['is_playlist'])
+        self.assertTrue(self.clean(is_playlist='true')[0]['is_playlist'])
+        self.assertFalse(self.clean(start_time=5, accurate_cut='0')[0]['accurate_cut'])
+        self.assertIsNotNone(self.clean(is_playlist='sometimes')[1])
+
+    def test_clip_estimate_is_its_share_of_the_duration(self):
+        probe = {'duration': 3600, 'sizes': {'22': 360_000_000}, 'best_video': None, 'best_audio': None}
+        with mock.patch.object(job_cost, 'get_probe', return_value=probe):
+            self.assertEqual(job_cost.estimate_job_bytes('u', '22', 'video', False, 30, 60), 3_000_000)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class FormatBudgetTests(SimpleTestCase):
+    MB = 1024 ** 2
+    INFO = {'id': 'abc', 'extractor_key': 'Youtube', 'duration': 600, 'formats': [
+        {'format_id': '18', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 360, 'filesize': 30 * MB, 'tbr': 420},
+        {'format_id': '137', 'vcodec': 'avc1', 'acodec': 'none', 'height': 1080, 'filesize': 400 * MB, 'tbr': 5600},
+        {'format_id': '136', 'vcodec': 'avc1', 'acodec': 'none', 'height': 720, 'filesize_approx': 150 * MB, 'tbr': 2100},
+        {'format_id': '135', 'vcodec': 'avc1', 'acodec': 'none', 'height': 480, 'tbr': 1000}, # No size: derived from tbr
+        {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a', 'filesize': 10 * MB, 'tbr': 130},
+        {'format_id': '251', 'vcodec': 'none', 'acodec': 'opus', 'filesize': 12 * MB, 'tbr': 160},
+        {'format_id': 'sb0', 'vcodec': 'none', 'acodec': 'none', 'ext': 'mhtml'},
+    ]}
+
+    def setUp(self):
+        cache.clear()
+        self.probe = job_cost.remember_probe('https://example.com/watch?v=abc', self.INFO)
+
+    def test_best_pair_within_size_budget(self):
+        self.assertEqual(job_cost.pick_budget_format(self.probe, 'video', max_bytes=500 * self.MB), ('137+251', 412 * self.MB))
+        self.assertEqual(job_cost.pick_budget_format(self.probe, 'video', max_bytes=200 * self.MB)[0], '136+251')
+        self.assertEqual(job_cost.pick_budget_format(self.probe, 'video', max_bytes=40 * self.MB)[0], '18')
+        self.assertIsNone(job_cost.pick_budget_format(self.probe, 'video', max_bytes=5 * self.MB))
+        # A 30s clip of a 10min video only needs a twentieth of the bytes
+        self.assertEqual(job_cost.pick_budget_format(self.probe, 'video', max_bytes=25 * self.MB, share=0.05)[0], '137+251')
+
+    def test_bitrate_cap_and_audio(self):
+        self.assertEqual(job_cost.pick_budget_format(self.probe, 'video', max_kbps=1150)[0], '135+140')
+        self.assertEqual(job_cost.pick_budget_format(self.probe, 'audio', max_kbps=150)[0], '140')
+
+    def test_submission_without_format_code_gets_explicit_code(self):
+        cleaned, error = validate_download_request({'url': 'https://example.com/watch?v=abc', 'format_type': 'video', 'max_filesize': '200M'})
+        self.assertIsNone(error)
+        self.assertEqual(cleaned['format_code'], '136+251')
+        self.assertIsNotNone(validate_download_request({'url': 'https://example.com/watch?v=abc', 'format_type': 'video', 'max_filesize': 'lots'})[1])
+
+    def test_budget_without_cached_formats_is_rejected_without_probing(self):
+        with mock.patch('downloader_ytdlp.views.new_youtube_dl') as new_youtube_dl:
+            cleaned, error = validate_download_request({'url': 'https://example.com/watch?v=other', 'format_type': 'video', 'max_filesize': '200M'})
+        self.assertIsNone(cleaned)
+        self.assertIn('get_formats', error)
+        new_youtube_dl.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PlaylistEntriesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user('alice', password='x'))
+        self.calls = []
+
+    def listing(self, info):
+        calls = self.calls
+        class FlatYDL:
+            def __init__(self, opts): calls.append(opts['playlist_items'])
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def extract_info(self, url, download=False): return info
+        return mock.patch('downloader_ytdlp.views.new_youtube_dl', FlatYDL)
+
+    def page(self, **params):
+        return self.client.post('/api/playlist/entries/', {'url': 'https://example.com/list/1', **params}, content_type='application/json').json()
+
+    def test_indexes_are_playlist_positions_even_around_unavailable_entries(self):
+        entry = lambda n: {'id': f'v{n}', 'title': f'Video {n}', 'url': f'https://example.com/v/{n}'}
+        info = {'_type': 'playlist', 'id': 'PL1', 'title': 'List', 'playlist_count': 9, 'entries': [None, entry(5), entry(6), entry(7)], 'requested_entries': [4, 5, 6, 7]}
+        with self.listing(info):
+            data = self.page(page=2, page_size=3)
+            self.assertEqual(self.calls, ['4-7']) # One extra entry tells whether there is a next page
+            self.assertEqual([e['index'] for e in data['entries']], [5, 6]) # 4 is unavailable, 7 belongs to page 3
+            self.assertTrue(data['has_more'])
+            self.assertEqual(self.page(page=2, page_size=3), data) # Cached
+            self.assertEqual(len(self.calls), 1)
+
+        # Without requested_entries the positions are counted from the start of the slice
+        info = {'_type': 'playlist', 'id': 'PL2', 'entries': [entry(1), None, entry(3)]}
+        with self.listing(info):
+            data = self.page(page=1, page_size=3)
+        self.assertEqual(([e['index'] for e in data['entries']], data['has_more']), ([1, 3], False))
+        self.assertEqual(self.page(page=0)['error'], f'page must be >= 1 and page_size between 1 and {settings.PLAYLIST_MAX_PAGE_SIZE}')
+
+    @override_settings(**NO_BROKER_ADMISSION)
+    def test_picked_playlist_items_are_validated_and_reach_yt_dlp(self):
+        base = {'url': 'https://example.com/list/1', 'format_code': 'best', 'format_type': 'video'}
+        self.assertEqual(validate_download_request({**base, 'is_playlist': True, 'playlist_items': '1, 3,5-9'})[0]['playlist_items'], '1,3,5-9')
+        self.assertIn('requires is_playlist', validate_download_request({**base, 'playlist_items': '1,3'})[1])
+        self.assertIn('requires is_playlist', validate_download_request({**base, 'is_playlist': True, 'playlist_items': '1;3'})[1])
+
+        seen = {}
+        class FakeYDL:
+            def __init__(self, opts, pooled=True): seen.update(opts)
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls): open(os.path.join(os.path.dirname(seen['outtmpl']), '3 - clip [x].mp4'), 'wb').close()
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        published = []
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, published.extend)))
+        submitted = self.client.post('/api/download/', {**base, 'is_playlist': 'true', 'playlist_items': '3,5-6'}, content_type='application/json').json()
+        job = published[0]
+        self.assertEqual((job['task_id'], job['kwargs']['playlist_items']), (submitted['task_id'], '3,5-6'))
+        with mock.patch.object(tasks, 'new_youtube_dl', FakeYDL), mock.patch.object(tasks.download_video_task, 'update_state'):
+            result = tasks.download_video_task.apply(task_id=job['task_id'], kwargs=job['kwargs'])
+        self.assertTrue(result.successful(), result.result)
+        self.assertEqual(seen['playlist_items'], '3,5-6')
+
+
+class StructuredLoggingTests(SimpleTestCase):
+    def capture(self, name, *filters):
+        handler = logging.handlers.BufferingHandler(1000)
+        for f in filters: handler.addFilter(f)
+        logger = logging.getLogger(name)
+        logger.handlers, logger.propagate = [handler], False
+        logger.setLevel(logging.DEBUG)
+        self.addCleanup(logger.handlers.clear)
+        return logger, handler.buffer
+
+    def test_ytdlp_lines_get_levels_and_status_lines_are_sampled(self):
+        logger, records = self.capture('test.yt_dlp', SamplingFilter())
+        ytdl_logger = YtDlpLogger(sample=5, task_id='t1'); ytdl_logger.logger = logger
+        for i in range(10):
+            ytdl_logger.debug(f'[download] Downloading item {i + 1} of 10')
+        ytdl_logger.debug('[youtube] abc: Downloading webpage')
+        ytdl_logger.debug('[debug] Invoking http downloader')
+        ytdl_logger.warning('Falling back to generic n function search')
+        self.assertEqual([r.getMessage() for r in records], [
+            '[download] Downloading item 1 of 10', '[download] Downloading item 6 of 10',
+            '[youtube] abc: Downloading webpage', 'Invoking http downloader', 'Falling back to generic n function search'])
+        self.assertEqual([r.levelname for r in records[-2:]], ['DEBUG', 'WARNING'])
+        self.assertTrue(all(r.task_id == 't1' for r in records))
+
+    def test_background_handler_does_not_wait_for_slow_output(self):
+        released, written = threading.Event(), []
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                released.wait(5); written.append(self.format(record))
+        target = SlowHandler(); target.setFormatter(StructuredFormatter(fmt='%(levelname)s %(message)s'))
+        handler = BackgroundQueueHandler(__import__('queue').Queue())
+        handler.listener = logging.handlers.QueueListener(handler.queue, target)
+        logger = logging.getLogger('test.background')
+        logger.handlers, logger.propagate = [handler], False
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.handlers.clear)
+
+        started = time.perf_counter()
+        for i in range(50):
+            logger.info("Download %d queued", i, extra={'task_id': 'abc'})
+        self.assertLess(time.perf_counter() - started, 1) # Did not wait on SlowHandler
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception("Download failed")
+        released.set(); handler.stop()
+        self.assertEqual(len(written), 51)
+        self.assertEqual(written[0], 'INFO Download 0 queued task_id=abc')
+        self.assertTrue(written[-1].startswith('ERROR Download failed\nTraceback') and 'ValueError: boom' in written[-1])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, **NO_BROKER_ADMISSION)
+class BatchDownloadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.published = []
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 2, self.published.append)))
+        self.user = User.objects.create_user('alice', password='x')
+        self.client.force_login(self.user)
+
+    def test_batch_inserts_once_publishes_once_and_reports_per_item(self):
+        items = [{'url': f'https://example.com/v/{n}', 'format_code': 'best', 'format_type': 'video'} for n in range(3)]
+        items.append({'url': 'not a url', 'format_code': 'best', 'format_type': 'video'})
+        items.append(dict(items[0])) # Same recipe as item 0: follows it
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/download/batch/', {'items': items}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        statuses = [r['status'] for r in response.json()['results']]
+        self.assertEqual(statuses, ['queued', 'queued', 'queued', 'rejected', 'attached'])
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "downloader_ytdlp_downloadlog"')]
+        self.assertEqual(len(inserts), 1)
+        # Per-user cap is 2: two jobs go out in one publish, the third waits its turn
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(len(self.published[0]), 2)
+        self.assertEqual(response.json()['results'][2]['queue_position'], 1)
+        self.assertEqual(DownloadLog.objects.count(), 4)
+
+    def test_failed_publish_resends_only_what_did_not_go_out(self):
+        logs = [DownloadLog.objects.create(user=self.user, url=f'https://example.com/v/{n}', format_code_selected='best', format_type_selected='video', task_id=f'p{n}') for n in range(3)]
+        scheduler._dispatcher.store.mark_running('alice', 'p2')
+        sends, failures = [], {'p1': 1, 'p2': 1} # The connection drops at p1; p2 cannot be sent at all
+        def signature(kwargs, task_id, **options):
+            def apply_async(**kw):
+                sends.append(task_id)
+                if failures.get(task_id):
+                    failures[task_id] -= 1
+                    raise ConnectionError('broker went away')
+            return mock.Mock(apply_async=apply_async)
+        with mock.patch.object(tasks.download_video_task, 'signature', side_effect=signature), mock.patch('celery.app.base.Celery.producer_or_acquire'):
+            scheduler.publish_to_celery([make_job(log.task_id, log.id, 'alice', {}) for log in logs])
+        self.assertEqual(sends, ['p0', 'p1', 'p1', 'p2']) # p0 is not sent twice
+        self.assertEqual(DownloadLog.objects.get(task_id='p2').status, 'FAILURE')
+        self.assertEqual(scheduler._dispatcher.store.running_count('alice'), 0)
+
+    def test_batch_with_only_invalid_items_is_rejected(self):
+        response = self.client.post('/api/download/batch/', {'items': [{'url': 'x'}]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(DownloadLog.objects.count(), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, **NO_BROKER_ADMISSION)
+class AdmissionControlTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.published = []
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 2, self.published.append)))
+        self.user = User.objects.create_user('alice', password='x')
+        self.client.force_login(self.user)
+
+    def submit(self, n=0):
+        return self.client.post('/api/download/', {'url': f'https://example.com/v/{n}', 'format_code': 'best', 'format_type': 'video'}, content_type='application/json')
+
+    def finished_recently(self, count, user=None):
+        # `count` downloads finished inside the throughput window: the recent rate
+        for n in range(count):
+            DownloadLog.objects.create(user=user or self.user, url=f'https://example.com/done/{n}', format_code_selected='best', format_type_selected='video', task_id=f'done-{n}', status='SUCCESS', finished_at=timezone.now() - timedelta(seconds=n))
+
+    @override_settings(DOWNLOAD_ADMISSION_THROUGHPUT_WINDOW=600)
+    def test_accepted_submission_carries_eta(self):
+        self.finished_recently(6) # 0.01 jobs/s
+        response = self.submit()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['eta_seconds'], 100) # Empty queue: just this job
+
+    @override_settings(DOWNLOAD_ADMISSION_MAX_QUEUE_DEPTH=1, DOWNLOAD_ADMISSION_THROUGHPUT_WINDOW=600)
+    def test_full_queue_is_refused_with_retry_after_from_throughput(self):
+        scheduler._dispatcher.per_user_cap = 0 # Nothing is released: submissions pile up in the pending queue
+        self.finished_recently(3, user=User.objects.create_user('bob', password='x')) # 0.005 jobs/s
+        self.assertEqual(self.submit(1).status_code, 202)
+        cache.clear() # Drop the shared load snapshot so the queued job is seen
+        response = self.submit(2)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '200') # One job has to drain
+        self.assertEqual(DownloadLog.objects.filter(user=self.user).count(), 1)
+
+    @override_settings(DOWNLOAD_ADMISSION_MAX_OUTSTANDING_PER_USER=2)
+    def test_user_over_outstanding_limit_gets_429_and_batch_is_trimmed(self):
+        response = self.client.post('/api/download/batch/', {'items': [{'url': f'https://example.com/v/{n}', 'format_code': 'best', 'format_type': 'video'} for n in range(3)]}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([r['status'] for r in response.json()['results']], ['queued', 'queued', 'throttled'])
+        response = self.submit(9)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response['Retry-After']), response.json()['retry_after'])
+        self.assertEqual(DownloadLog.objects.count(), 2)
+
+    @override_settings(DOWNLOAD_ADMISSION_MAX_OUTSTANDING_PER_USER=1)
+    def test_follower_being_linked_is_outstanding(self):
+        DownloadLog.objects.create(user=self.user, url='https://example.com/v/linking', format_code_selected='best', format_type_selected='video', task_id='linking', status='LINKING')
+        self.assertEqual(self.submit().status_code, 429)
+
+    def test_low_disk_space_is_refused(self):
+        with override_settings(DOWNLOAD_ADMISSION_MIN_FREE_BYTES=1 << 62):
+            response = self.submit()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, **NO_BROKER_ADMISSION)
+class CancellationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.published = []
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, self.published.append)))
+        self.revoke = self.enterContext(mock.patch.object(cancellation, 'revoke_task'))
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+
+    def submit(self, user, n):
+        self.client.force_login(user)
+        return self.client.post('/api/download/', {'url': f'https://example.com/v/{n}', 'format_code': 'best', 'format_type': 'video'}, content_type='application/json').json()
+
+    def cancel(self, user, submitted):
+        self.client.force_login(user)
+        return self.client.post(f"/api/download/{submitted['log_id']}/cancel/")
+
+    def test_queued_jobs_and_followers_are_cancelled_on_the_spot(self):
+        published, waiting = self.submit(self.alice, 1), self.submit(self.alice, 2) # Per-user cap 1: the second waits
+        follower = self.submit(self.bob, 1)
+        self.assertEqual(self.cancel(self.bob, waiting).status_code, 404) # Not bob's
+
+        response = self.cancel(self.alice, waiting)
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'CANCELLED'))
+        self.assertEqual(scheduler._dispatcher.store.pending_count(), 0)
+        self.revoke.assert_not_called() # It never left the fair-share queue
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(f"/api/task_status/{waiting['task_id']}/").json()['status'], 'CANCELLED')
+        self.assertEqual(self.cancel(self.alice, waiting).status_code, 409)
+
+        # A follower just detaches; the leader keeps downloading for everyone else
+        self.assertEqual(self.cancel(self.bob, follower).json()['status'], 'CANCELLED')
+        self.assertEqual(DownloadLog.objects.get(id=published['log_id']).status, 'PENDING')
+
+        # Published but not started: revoked, so the worker drops the message
+        self.assertEqual(self.cancel(self.alice, published).json()['status'], 'CANCELLED')
+        self.revoke.assert_called_once_with(published['task_id'])
+
+    def test_followers_are_handed_over_once_the_worker_confirms(self):
+        published, waiting = self.submit(self.alice, 1), self.submit(self.alice, 2)
+        follows_published = self.submit(self.bob, 1)
+
+        # An error handing over followers does not hide a cancellation that was recorded
+        with mock.patch.object(singleflight, 'leader_finished', side_effect=DatabaseError('gone')):
+            response = self.cancel(self.alice, waiting)
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'CANCELLED'))
+
+        # Published: a worker may be running it already, so its follower is not promoted yet
+        self.assertEqual(self.cancel(self.alice, published).json()['status'], 'CANCELLED')
+        self.assertEqual(DownloadLog.objects.get(id=follows_published['log_id']).status, 'ATTACHED')
+        request = mock.Mock(id=published['task_id'], kwargs={'log_id': published['log_id'], 'target_username': 'alice'})
+        task_revoked.send(sender=tasks.download_video_task, request=request, terminated=False, signum=None, expired=False)
+        promoted = DownloadLog.objects.get(id=follows_published['log_id'])
+        self.assertEqual((promoted.status, promoted.leader_id), ('PENDING', None))
+        self.assertEqual(self.published[-1][-1]['task_id'], promoted.task_id)
+
+    def test_running_download_is_aborted_and_cleaned_up(self):
+        submitted = self.submit(self.alice, 1)
+        log_entry = DownloadLog.objects.get(id=submitted['log_id'])
+        log_entry.status = 'DOWNLOADING'; log_entry.save()
+        response = self.cancel(self.alice, submitted)
+        self.assertEqual((response.status_code, response.json()['status']), (202, 'CANCELLING'))
+
+        # The progress hook aborts yt-dlp even though it swallows its own errors
+        watch = cancellation.CancelWatch(log_entry.task_id)
+        with self.assertRaises(get_yt_dlp().utils.DownloadCancelled):
+            update_progress(mock.Mock(), {'status': 'downloading', 'downloaded_bytes': 1, 'total_bytes': 2}, watch)
+        # ffmpeg started by the task is terminated
+        child = subprocess.Popen(['sleep', '30'])
+        self.addCleanup(child.kill)
+        with mock.patch.object(cancellation, 'CHILD_PROCESS_NAMES', ('sleep',)):
+            watch.kill_children()
+        self.assertEqual(child.wait(timeout=5), -signal.SIGTERM)
+
+        download_dir = tempfile.mkdtemp()
+        open(os.path.join(download_dir, 'video.mp4.part'), 'wb').close()
+        finish_cancelled(mock.Mock(), log_entry, download_dir)
+        self.assertFalse(os.path.exists(download_dir))
+        log_entry.refresh_from_db()
+        self.assertEqual(log_entry.status, 'CANCELLED')
+
+
+
+class StallWatchdogTests(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.stall = StallWatchdog(window=60, min_rate=1000, clock=lambda: self.now)
+
+    def feed(self, seconds, rate, start=0, name='v.mp4.part'):
+        """One progress update a second at `rate` bytes/s. Returns whether the watchdog tripped."""
+        downloaded = start
+        for _ in range(seconds):
+            self.now += 1; downloaded += rate
+            self.stall.observe({'status': 'downloading', 'downloaded_bytes': downloaded, 'tmpfilename': name})
+        return self.stall.stalled()
+
+    def test_slow_window_trips_and_time_limits_scale(self):
+        self.assertFalse(self.feed(30, 10)) # Not a whole window yet
+        self.stall.reset()
+        self.assertFalse(self.feed(120, 5000, start=10 ** 9)) # A resumed part file is not throughput
+        self.assertFalse(self.feed(30, 10, name='w.mp4.part')) # Still fast over the last window
+        self.assertTrue(self.feed(40, 10, name='w.mp4.part'))
+        self.assertLess(self.stall.last_rate, 1000)
+        self.stall.reset(); self.stall.observe({'status': 'finished'}); self.now += 600
+        self.assertFalse(self.stall.stalled()) # Post-processing is not a stall
+
+        small, big = job_cost.time_limits(10 * 1024 ** 2, False), job_cost.time_limits(20 * 1024 ** 3, False)
+        self.assertLess(small[0], big[0]); self.assertEqual(big[1] - big[0], 5 * 60)
+        self.assertEqual(job_cost.time_limits(None, True)[0], 11 * 60 * 60)
+
+    def test_stalled_download_is_retried_then_failed_with_events(self):
+        user = User.objects.create_user('alice', password='x')
+        log_entry = DownloadLog.objects.create(user=user, url='https://example.com/v/1', format_code_selected='best', format_type_selected='video', task_id='t1', attempts=1)
+        test = self; builds = []
+
+        class StallingYDL:
+            outcomes = ['stall', 'stall', 'ok']
+            def __init__(self, opts, pooled=True):
+                self.opts = opts; builds.append((opts.get('concurrent_fragment_downloads'), pooled))
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                rate = 10 if self.outcomes.pop(0) == 'stall' else 5000
+                for i in range(1, 62):
+                    test.now += 1
+                    self.opts['progress_hooks'][0]({'status': 'downloading', 'downloaded_bytes': i * rate, 'filename': 'v.mp4'})
+
+        opts = {'progress_hooks': [lambda d: update_progress(mock.Mock(), d, stall=self.stall)]}
+        with mock.patch.object(tasks, 'new_youtube_dl', StallingYDL):
+            tasks.download_with_stall_recovery(opts, 'https://example.com/v/1', self.stall, log_entry, logging.getLogger(__name__))
+            self.assertEqual(builds, [(None, True), (None, False), (4, False)]) # Fresh connections, then more fragments
+            log_entry.refresh_from_db()
+            self.assertEqual([e['action'] for e in log_entry.stall_events], ['retry with fresh connections', 'retry with fresh connections and 4 concurrent fragments'])
+            self.assertEqual(log_entry.stall_events[0]['rate'], 10)
+
+            StallingYDL.outcomes = ['stall'] * 3
+            with self.assertRaisesMessage(DownloadStalled, 'Download stalled'):
+                tasks.download_with_stall_recovery(opts, 'https://example.com/v/1', self.stall, log_entry, logging.getLogger(__name__))
+        log_entry.refresh_from_db()
+        self.assertEqual(log_entry.stall_events[-1]['action'], 'failed')
+        self.assertFalse(tasks.is_retryable(DownloadStalled('x')))
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_time_limits_end_playlists_and_hard_kills_are_cleaned_up(self):
+        alice, bob = User.objects.create_user('alice', password='x'), User.objects.create_user('bob', password='x')
+        dispatcher = self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, lambda jobs: None)))
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        log_entry = DownloadLog.objects.create(user=alice, url='https://example.com/list/1', format_code_selected='best', format_type_selected='video', is_playlist_download=True, task_id='slow-list')
+        dispatcher.submit(make_job('slow-list', log_entry.id, 'alice', {}))
+
+        class IgnoringYDL: # Like yt-dlp with ignoreerrors: entry errors are swallowed, DownloadCancelled is not
+            def __init__(self, opts, pooled=True): self.opts = opts
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                for n in range(3):
+                    try: self.opts['progress_hooks'][0]({'status': 'downloading', 'downloaded_bytes': n, 'filename': f'{n}.mp4'})
+                    except get_yt_dlp().utils.DownloadCancelled: raise
+                    except Exception: pass
+
+        with mock.patch.object(tasks, 'new_youtube_dl', IgnoringYDL), mock.patch.object(tasks.download_video_task, 'update_state'), \
+             mock.patch.object(tasks, 'soft_deadline', return_value=time.monotonic() - 1): # Soft limit already passed
+            result = tasks.download_video_task.apply(task_id='slow-list', kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', is_playlist=True, log_id=str(log_entry.id)))
+        self.assertTrue(result.failed())
+        log_entry.refresh_from_db()
+        self.assertEqual((log_entry.status, log_entry.attempts), ('FAILURE', 1)) # Not retried
+        self.assertIn('Time limit exceeded', log_entry.error_message)
+        self.assertEqual(dispatcher.store.running_count('alice'), 0)
+
+        # Hard limit: the pool process is gone, the worker's main process cleans up
+        leader = DownloadLog.objects.create(user=alice, url='https://example.com/v/1', format_code_selected='best', format_type_selected='video', task_id='killed', status='DOWNLOADING')
+        follower = DownloadLog.objects.create(user=bob, url=leader.url, format_code_selected='best', format_type_selected='video', task_id='f1', status='ATTACHED', leader=leader)
+        dispatcher.submit(make_job('killed', leader.id, 'alice', {}))
+        task_failure.send(sender=tasks.download_video_task, task_id='killed', exception=TimeLimitExceeded(3900), args=(), kwargs={'log_id': str(leader.id)})
+        leader.refresh_from_db(); follower.refresh_from_db()
+        self.assertEqual((leader.status, leader.error_message), ('FAILURE', 'Time limit exceeded: killed after 3900s'))
+        self.assertEqual((follower.status, follower.leader_id), ('PENDING', None)) # Promoted and queued in its place
+        self.assertEqual(dispatcher.store.running_count('alice'), 0)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RetryTests(TestCase):
+    def test_transient_errors_are_retried_and_permanent_ones_are_not(self):
+        DownloadError = get_yt_dlp().utils.DownloadError
+        self.assertTrue(tasks.is_retryable(DownloadError('ERROR: Unable to download webpage: Connection reset by peer')))
+        self.assertTrue(tasks.is_retryable(ConnectionError()))
+        self.assertTrue(tasks.is_retryable(TimeoutError()))
+        self.assertFalse(tasks.is_retryable(DownloadError('ERROR: [youtube] abc: Video unavailable')))
+        self.assertFalse(tasks.is_retryable(DownloadError('ERROR: Requested format is not available')))
+        self.assertFalse(tasks.is_retryable(FileNotFoundError('no output')))
+
+    @override_settings(DOWNLOAD_RETRY_BACKOFF=30, DOWNLOAD_RETRY_BACKOFF_MAX=15 * 60)
+    def test_backoff_doubles_with_jitter_up_to_the_cap(self):
+        for retries, backoff in ((0, 30), (1, 60), (4, 480), (5, 900), (9, 900)):
+            countdown = tasks.retry_countdown(retries)
+            self.assertGreaterEqual(countdown, backoff)
+            self.assertLessEqual(countdown, backoff * 1.25)
+
+    def test_retry_resumes_from_the_partial_file_in_the_log_directory(self):
+        alice = User.objects.create_user('alice', password='x')
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        dispatcher = self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, lambda jobs: None)))
+        log_entry = DownloadLog.objects.create(user=alice, url='https://example.com/v/1', format_code_selected='best', format_type_selected='video', task_id='flaky')
+        dispatcher.submit(make_job('flaky', log_entry.id, 'alice', {}))
+        attempts = []
+
+        class FlakyYDL: # The first attempt dies half way, the second finds the .part file where it left it
+            def __init__(self, opts, pooled=True): self.opts = opts
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                directory = os.path.dirname(self.opts['outtmpl'])
+                attempts.append((directory, sorted(os.listdir(directory))))
+                part = os.path.join(directory, 'clip [1].mp4.part')
+                if len(attempts) == 1:
+                    with open(part, 'wb') as f: f.write(b'x' * 1000)
+                    raise get_yt_dlp().utils.DownloadError('ERROR: Connection reset by peer')
+                os.rename(part, os.path.join(directory, 'clip [1].mp4'))
+
+        with mock.patch.object(tasks, 'new_youtube_dl', FlakyYDL), mock.patch.object(tasks.download_video_task, 'update_state'):
+            result = tasks.download_video_task.apply(task_id='flaky', kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', log_id=str(log_entry.id)))
+        self.assertTrue(result.successful(), result.result)
+        log_directory = tasks.task_download_dir('alice', log_entry.id, 'flaky')
+        self.assertEqual(attempts, [(log_directory, []), (log_directory, ['clip [1].mp4.part'])])
+        log_entry.refresh_from_db()
+        self.assertEqual((log_entry.status, log_entry.attempts, log_entry.resumed_bytes), ('SUCCESS', 2, 1000))
+        self.assertEqual(dispatcher.store.running_count('alice'), 0) # Kept across the retry, given back at the end
+
+    @override_settings(DOWNLOAD_MAX_RETRIES=2)
+    def test_redelivery_after_lost_workers_gives_up(self):
+        alice, bob = User.objects.create_user('alice', password='x'), User.objects.create_user('bob', password='x')
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        published = []
+        dispatcher = self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, published.extend)))
+        log_entry = DownloadLog.objects.create(user=alice, url='https://example.com/v/1', format_code_selected='best', format_type_selected='video', task_id='oom')
+        follower = DownloadLog.objects.create(user=bob, url=log_entry.url, format_code_selected='best', format_type_selected='video', task_id='f1', status='ATTACHED', leader=log_entry)
+        dispatcher.submit(make_job('oom', log_entry.id, 'alice', {}))
+        downloads = []
+
+        class WorkerKilled(BaseException): # Like SIGKILL: no except clause sees it
+            pass
+        class KilledYDL:
+            def __init__(self, opts, pooled=True): pass
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls): downloads.append(urls); raise WorkerKilled()
+
+        kwargs = dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', log_id=str(log_entry.id))
+        with mock.patch.object(tasks, 'new_youtube_dl', KilledYDL), mock.patch.object(tasks.download_video_task, 'update_state'):
+            for delivery in range(3): # The first run and the two retries the limit allows
+                with self.assertRaises(WorkerKilled):
+                    tasks.download_video_task.apply(task_id='oom', kwargs=kwargs)
+            # The broker redelivers the unacknowledged message once more: this time it is not run
+            result = tasks.download_video_task.apply(task_id='oom', kwargs=kwargs)
+        self.assertTrue(result.successful(), result.result) # Acked, so it is not redelivered again
+        self.assertEqual(len(downloads), 3)
+        log_entry.refresh_from_db()
+        self.assertEqual((log_entry.status, log_entry.attempts), ('FAILURE', 4))
+        self.assertIn('Gave up after 3 attempts', log_entry.error_message)
+        follower.refresh_from_db()
+        self.assertEqual((follower.status, follower.leader_id), ('PENDING', None)) # Promoted to try on its own
+        self.assertEqual(dispatcher.store.running_count('alice'), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TaskMemoryTests(TestCase):
+    MB = 1024 ** 2
+
+    def test_peak_and_delta_of_a_temporary_allocation(self):
+        meter = memory.TaskMemory()
+        if meter.start_rss is None:
+            self.skipTest('No /proc on this platform')
+        block = bytearray(80 * self.MB) # Zero-filled, so every page is touched
+        meter.sampled_peak = max(meter.sampled_peak, memory.current_rss()) # What the progress hook would have seen
+        del block; memory.release_memory()
+        peak, delta = meter.finish()
+        self.assertGreaterEqual(peak, meter.start_rss + 70 * self.MB)
+        self.assertLess(delta, 20 * self.MB) # Freed and returned to the OS
+
+    def test_playlist_task_discards_entries_and_records_memory(self):
+        if memory.current_rss() is None:
+            self.skipTest('No /proc on this platform')
+        user = User.objects.create_user('alice', password='x')
+        log_entry = DownloadLog.objects.create(user=user, url='https://example.com/list/1', format_code_selected='best', format_type_selected='video', is_playlist_download=True, task_id='mem-task')
+        seen = {}
+
+        class FakeYDL:
+            def __init__(self, opts, pooled=True): seen.update(opts)
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                block = bytearray(60 * TaskMemoryTests.MB); del block
+                open(os.path.join(os.path.dirname(seen['outtmpl']), '1 - clip [x].mp4'), 'wb').close()
+
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.enterContext(mock.patch.object(tasks, 'new_youtube_dl', FakeYDL))
+        self.enterContext(mock.patch.object(tasks.download_video_task, 'update_state'))
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, lambda jobs: None)))
+        before = memory.current_rss()
+        result = tasks.download_video_task.apply(task_id='mem-task', kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', is_playlist=True, log_id=str(log_entry.id)))
+        self.assertTrue(result.successful(), result.result)
+        self.assertEqual(seen['extract_flat'], 'discard_in_playlist')
+        log_entry.refresh_from_db()
+        self.assertGreaterEqual(log_entry.peak_rss_bytes, before + 50 * self.MB)
+        self.assertIsNotNone(log_entry.rss_delta_bytes)
+
+    def test_accounting_errors_do_not_hide_the_outcome_or_keep_the_slot(self):
+        user = User.objects.create_user('alice', password='x')
+        log_entry = DownloadLog.objects.create(user=user, url='https://example.com/v/gone', format_code_selected='best', format_type_selected='video', task_id='acct-task')
+        dispatcher = self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, lambda jobs: None)))
+        dispatcher.submit(make_job('acct-task', log_entry.id, 'alice', {}))
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        ydl = mock.MagicMock()
+        ydl.__enter__.return_value.download.side_effect = get_yt_dlp().utils.DownloadError('Video unavailable')
+        with mock.patch.object(tasks, 'new_youtube_dl', return_value=ydl), mock.patch.object(tasks.download_video_task, 'update_state'), \
+             mock.patch.object(memory.TaskMemory, 'finish', side_effect=DatabaseError('connection lost')):
+            result = tasks.download_video_task.apply(task_id='acct-task', kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', log_id=str(log_entry.id)))
+        self.assertIsInstance(result.result, get_yt_dlp().utils.DownloadError)
+        self.assertEqual(dispatcher.store.running_count('alice'), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class StorageBackendTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, self.media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media))
+
+    def s3(self):
+        """S3Storage on a mock client (no bucket, no boto3 needed)."""
+        backend = storage.S3Storage.__new__(storage.S3Storage)
+        backend.bucket, backend.transfer_config, backend.client = 'bucket', None, mock.Mock()
+        backend.client.generate_presigned_url.side_effect = lambda op, Params, ExpiresIn: f"https://s3.test/{Params['Key']}"
+        return backend
+
+    def test_local_link_is_a_hardlink_and_delete_is_idempotent(self):
+        backend = storage.LocalStorage()
+        os.makedirs(os.path.join(self.media, 'downloads', 'alice'))
+        with open(storage.path_for_key('downloads/alice/a.mp4'), 'wb') as f: f.write(b'data')
+        backend.link('downloads/alice/a.mp4', 'downloads/bob/1/a.mp4')
+        self.assertTrue(os.path.samefile(storage.path_for_key('downloads/alice/a.mp4'), storage.path_for_key('downloads/bob/1/a.mp4')))
+        backend.delete('downloads/bob/1/a.mp4'); backend.delete('downloads/bob/1/a.mp4')
+        self.assertFalse(backend.exists('downloads/bob/1/a.mp4'))
+        self.assertEqual(backend.url('downloads/alice/a.mp4'), '/media/downloads/alice/a.mp4')
+
+    @override_settings(DOWNLOAD_S3_KEEP_LOCAL_COPY=False)
+    def test_task_succeeds_when_uploads_already_removed_the_local_files(self):
+        backend = self.s3()
+        self.enterContext(mock.patch.object(storage, '_backend', backend))
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, lambda jobs: None)))
+        user = User.objects.create_user('alice', password='x')
+        log_entry = DownloadLog.objects.create(user=user, url='https://example.com/v/1', format_code_selected='best', format_type_selected='video', task_id='s3-task')
+
+        class UploadingYDL:
+            def __init__(self, opts, pooled=True): self.opts = opts
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                path = os.path.join(os.path.dirname(self.opts['outtmpl']), 'clip [1].mp4')
+                with open(path, 'wb') as f: f.write(b'x' * 1000)
+                self.opts['post_hooks'][0](path)
+                for _ in range(500): # Let the upload thread finish and remove it before verification looks
+                    if not os.path.exists(path): break
+                    time.sleep(0.01)
+
+        with mock.patch.object(tasks, 'new_youtube_dl', UploadingYDL), mock.patch.object(tasks.download_video_task, 'update_state'):
+            result = tasks.download_video_task.apply(task_id='s3-task', kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', log_id=str(log_entry.id)))
+        self.assertTrue(result.successful(), result.result)
+        key = f'downloads/alice/{log_entry.id}/clip [1].mp4'
+        backend.client.upload_file.assert_called_once_with(storage.path_for_key(key), 'bucket', key, Config=None)
+        self.assertFalse(os.path.exists(storage.path_for_key(key)))
+        log_entry.refresh_from_db()
+        self.assertEqual(log_entry.status, 'SUCCESS')
+        self.assertEqual([(f['storage_key'], f['file_url'], f['size']) for f in log_entry.downloaded_files_info], [(key, f'https://s3.test/{key}', 1000)])
+
+    def run_playlist(self, backend, script):
+        """Run a two-entry playlist download; script[attempt] is (entries to fetch, exception to end with or None)."""
+        self.enterContext(mock.patch.object(storage, '_backend', backend))
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, lambda jobs: None)))
+        user = User.objects.create_user('alice', password='x')
+        log_entry = DownloadLog.objects.create(user=user, url='https://example.com/list/1', format_code_selected='best', format_type_selected='video', is_playlist_download=True, task_id='s3-list')
+        fetched = []
+
+        class PlaylistYDL: # Entry by entry like yt-dlp: skip what the archive has, post_hooks, then record it
+            def __init__(self, opts, pooled=True): self.opts = opts
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                entries, error = script[len(fetched)]
+                fetched.append([])
+                for n in entries:
+                    if f'fake {n}' in self.opts['download_archive']: continue
+                    path = os.path.join(os.path.dirname(self.opts['outtmpl']), f'{n} - clip [{n}].mp4')
+                    with open(path, 'wb') as f: f.write(b'x' * 100 * n)
+                    fetched[-1].append(n)
+                    self.opts['post_hooks'][0](path)
+                    self.opts['download_archive'].add(f'fake {n}')
+                if error: raise error
+
+        with mock.patch.object(tasks, 'new_youtube_dl', PlaylistYDL), mock.patch.object(tasks.download_video_task, 'update_state'):
+            result = tasks.download_video_task.apply(task_id='s3-list', kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username='alice', is_playlist=True, log_id=str(log_entry.id)))
+        log_entry.refresh_from_db()
+        return result, log_entry, fetched
+
+    @override_settings(DOWNLOAD_S3_KEEP_LOCAL_COPY=False)
+    def test_retry_keeps_stored_entries_and_skips_them(self):
+        backend = self.s3()
+        reset = get_yt_dlp().utils.DownloadError('ERROR: Connection reset by peer')
+        result, log_entry, fetched = self.run_playlist(backend, [((1,), reset), ((1, 2), None)])
+        self.assertTrue(result.successful(), result.result)
+        self.assertEqual(fetched, [[1], [2]]) # The entry stored before the retry was not downloaded again
+        self.assertEqual(backend.client.upload_file.call_count, 2)
+        self.assertEqual(log_entry.status, 'SUCCESS')
+        self.assertEqual([(f['filename'], f['size']) for f in log_entry.downloaded_files_info], [('1 - clip [1].mp4', 100), ('2 - clip [2].mp4', 200)])
+        self.assertNotIn('archive_id', log_entry.downloaded_files_info[0])
+        self.assertEqual(log_entry.storage_bytes, 300) # Both entries count towards the quota
+
+    @override_settings(DOWNLOAD_S3_KEEP_LOCAL_COPY=False)
+    def test_failed_download_deletes_what_every_attempt_stored(self):
+        backend = self.s3()
+        DownloadError = get_yt_dlp().utils.DownloadError
+        result, log_entry, fetched = self.run_playlist(backend, [((1,), DownloadError('ERROR: Connection reset by peer')), ((1, 2), DownloadError('ERROR: Video unavailable'))])
+        self.assertTrue(result.failed())
+        self.assertEqual(fetched, [[1], [2]])
+        self.assertEqual(sorted(call.kwargs['Key'] for call in backend.client.delete_object.call_args_list),
+                         [f'downloads/alice/{log_entry.id}/1 - clip [1].mp4', f'downloads/alice/{log_entry.id}/2 - clip [2].mp4'])
+        self.assertEqual((log_entry.status, log_entry.downloaded_files_info, log_entry.storage_bytes), ('FAILURE', None, 0))
+
+    def test_discarded_uploads_are_deleted_from_the_backend(self):
+        backend = self.s3()
+        self.enterContext(mock.patch.object(storage, '_backend', backend))
+        path = os.path.join(self.media, 'downloads', 'alice', 'x', 'a.mp4')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f: f.write(b'data')
+        uploader = storage.BackgroundUploader()
+        uploader.submit(path); uploader.submit(path) # Once per file, whoever hands it over
+        uploader.discard()
+        backend.client.upload_file.assert_called_once()
+        backend.client.delete_object.assert_called_once_with(Bucket='bucket', Key='downloads/alice/x/a.mp4')
+
+
+@override_settings(CACHES=LOCMEM_CACHE, DOWNLOAD_STORAGE_BACKEND='local', **NO_BROKER_ADMISSION)
+class StorageUsageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 2, lambda jobs: None)))
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+
+    def run_download(self, user, payload=b'x' * 300_000):
+        log_entry = DownloadLog.objects.create(user=user, target_user_for_download=user, url='https://example.com/v/1', format_code_selected='best', format_type_selected='video', task_id=f'task-{user.username}')
+        class FakeYDL:
+            def __init__(self, opts, pooled=True): self.opts = opts
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def download(self, urls):
+                with open(os.path.join(os.path.dirname(self.opts['outtmpl']), 'clip [1].mp4'), 'wb') as f: f.write(payload)
+        with mock.patch.object(tasks, 'new_youtube_dl', FakeYDL), mock.patch.object(tasks.download_video_task, 'update_state'):
+            result = tasks.download_video_task.apply(task_id=log_entry.task_id, kwargs=dict(url=log_entry.url, format_code='best', format_type='video', target_username=user.username, log_id=str(log_entry.id)))
+        self.assertTrue(result.successful(), result.result)
+        log_entry.refresh_from_db()
+        return log_entry
+
+    def test_files_are_described_and_counted_until_evicted(self):
+        leader = self.run_download(self.alice)
+        item = leader.downloaded_files_info[0]
+        self.assertEqual((item['size'], item['sha256']), (300_000, hashlib.sha256(b'x' * 300_000).hexdigest()))
+        self.assertIn('duration', item) # None here: not a real media file
+        self.assertEqual(leader.storage_bytes, 300_000)
+
+        # A follower gets the same details and is charged for its copy
+        follower = DownloadLog.objects.create(user=self.bob, target_user_for_download=self.bob, url=leader.url, format_code_selected='best', format_type_selected='video', task_id='f1', status='ATTACHED', leader=leader)
+        singleflight.deliver_to_followers(leader)
+        follower.refresh_from_db()
+        self.assertEqual(follower.downloaded_files_info[0]['sha256'], item['sha256'])
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get('/api/storage/usage/').json()['bytes_used'], 300_000)
+        self.assertEqual(self.client.get('/api/storage/usage/?username=alice').status_code, 403)
+
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.delete(f'/api/download/{follower.id}/files/').status_code, 404) # Bob's
+        response = self.client.delete(f'/api/download/{leader.id}/files/')
+        self.assertEqual((response.status_code, response.json()['bytes_freed'], response.json()['usage']['bytes_used']), (200, 300_000, 0))
+        self.assertFalse(os.path.exists(storage.path_for_key(item['storage_key'])))
+        self.assertEqual(self.client.delete(f'/api/download/{leader.id}/files/').status_code, 409)
+        self.assertEqual(UserStorageUsage.objects.get(user=self.bob).files, 1) # Bob's hardlink is his own
+
+    @override_settings(DOWNLOAD_USER_QUOTA_BYTES=1_000_000)
+    def test_quota_is_checked_from_the_counter_at_submission(self):
+        self.run_download(self.alice, b'x' * 900_000)
+        self.client.force_login(self.alice)
+        job_cost.remember_probe('https://example.com/v/2', {'id': '2', 'extractor_key': 'Generic', 'duration': 10, 'formats': [{'format_id': 'best', 'vcodec': 'avc1', 'acodec': 'mp4a', 'filesize': 200_000}]})
+        response = self.client.post('/api/download/', {'url': 'https://example.com/v/2', 'format_code': 'best', 'format_type': 'video'}, content_type='application/json')
+        self.assertEqual(response.status_code, 507)
+        self.assertIn('Storage quota', response.json()['error'])
+
+        UserStorageUsage.objects.filter(user=self.alice).update(bytes_used=0, quota_bytes=10_000_000) # Drifted counter, raised quota
+        self.assertEqual(usage.recount(), 1)
+        self.assertEqual(usage.usage_of(self.alice)['bytes_used'], 900_000)
+        self.assertEqual(self.client.post('/api/download/', {'url': 'https://example.com/v/2', 'format_code': 'best', 'format_type': 'video'}, content_type='application/json').status_code, 202)
+
+    @override_settings(DOWNLOAD_USER_QUOTA_BYTES=1_000_000, **NO_BROKER_ADMISSION)
+    def test_quota_is_checked_against_the_user_who_is_charged(self):
+        UserStorageUsage.objects.create(user=self.alice, bytes_used=950_000)
+        def entry(owner): return DownloadLog(user=self.alice, target_user_for_download=owner, url='https://example.com/v/3', estimated_bytes=400_000)
+
+        # Alice is nearly full, but files downloaded for Bob are charged to Bob
+        self.assertEqual(admit(self.alice, [entry(self.bob), entry(self.bob)])[:2], (2, None))
+        admitted, refusal, _ = admit(self.alice, [entry(self.bob), entry(self.alice), entry(self.bob)])
+        self.assertEqual((admitted, refusal['status']), (1, 507))
+        # Bob's spare room is used up by the entries before the one that does not fit
+        UserStorageUsage.objects.create(user=self.bob, bytes_used=500_000)
+        self.assertEqual(admit(self.alice, [entry(self.bob), entry(self.bob)])[0], 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, DOWNLOAD_SPECULATIVE_PREFETCH=True, **NO_BROKER_ADMISSION)
+class SpeculativePrefetchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.published = []
+        self.enterContext(mock.patch.object(scheduler, '_dispatcher', FairShareDispatcher(InMemoryQueueStore(), 1, self.published.append)))
+        self.enterContext(mock.patch.object(cancellation, 'revoke_task'))
+        self.expiry = self.enterContext(mock.patch.object(tasks.expire_speculative_download, 'apply_async'))
+        ydl = mock.MagicMock()
+        ydl.__enter__.return_value.extract_info.side_effect = lambda url, download=False: {**FormatBudgetTests.INFO, 'id': url[-3:], 'webpage_url': url}
+        self.enterContext(mock.patch('downloader_ytdlp.views.new_youtube_dl', return_value=ydl))
+        self.user = User.objects.create_user('alice', password='x')
+        self.client.force_login(self.user)
+
+    def probe(self, url):
+        self.assertEqual(self.client.post('/api/get_formats/', {'url': url}, content_type='application/json').status_code, 200)
+        return DownloadLog.objects.filter(speculative=True, url=url).first()
+
+    def submit(self, url, format_code, format_type='video'):
+        return self.client.post('/api/download/', {'url': url, 'format_code': format_code, 'format_type': format_type}, content_type='application/json').json()
+
+    def test_speculation_does_not_take_the_probing_users_slot(self):
+        speculative = self.probe('https://example.com/v/abc')
+        self.submit('https://example.com/v/other', 'best')
+        store = scheduler._dispatcher.store
+        self.assertEqual([job['task_id'] for jobs in self.published for job in jobs][0], speculative.task_id)
+        self.assertEqual((store.running_count(scheduler.SPECULATIVE_QUEUE), store.running_count('alice')), (1, 1))
+
+    def test_matching_request_adopts_queued_speculation_with_normal_priority(self):
+        self.client.force_login(User.objects.create_user('bob', password='x'))
+        self.probe('https://example.com/v/bob') # Takes the only speculative worker slot
+        self.client.force_login(self.user)
+        speculative = self.probe('https://example.com/v/abc')
+        self.assertEqual(speculative.format_code_selected, speculation.SPECULATIVE_VIDEO_FORMAT)
+        self.expiry.assert_called_with(args=[str(speculative.id)], countdown=120)
+        pending = scheduler._dispatcher.store.pending_jobs(scheduler.SPECULATIVE_QUEUE)
+        self.assertEqual([(job['task_id'], job['priority']) for job in pending], [(speculative.task_id, 9)])
+
+        response = self.submit('https://example.com/v/abc', speculation.SPECULATIVE_VIDEO_FORMAT)
+        self.assertEqual(response['attached_to'], str(speculative.id))
+        self.assertLess(scheduler._dispatcher.store.pending_jobs(scheduler.SPECULATIVE_QUEUE)[0]['priority'], 9)
+        speculation.expire(speculative.id) # Adopted: the timeout leaves it alone
+        speculative.refresh_from_db()
+        self.assertEqual(speculative.status, 'PENDING')
+        self.assertIsNone(self.probe('https://example.com/v/abc').leader) # Probing again does not start a second one
+
+        DownloadLog.objects.filter(id=speculative.id).update(transferred_bytes=40 * 1024 ** 2)
+        out = io.StringIO(); call_command('report_speculation', stdout=out)
+        self.assertIn('hit rate 50.0%', out.getvalue()) # Bob's was not adopted
+        self.assertIn('Transferred: 40.0 MiB', out.getvalue())
+
+    def test_other_format_and_timeout_cancel_speculation(self):
+        speculative = self.probe('https://example.com/v/abc')
+        self.submit('https://example.com/v/abc', 'bestaudio[ext=m4a]/bestaudio', 'audio')
+        speculative.refresh_from_db()
+        self.assertEqual((speculative.status, speculative.error_message), ('CANCELLED', 'Speculative download not needed'))
+
+        with override_settings(DOWNLOAD_SPECULATIVE_PREFETCH=False):
+            self.assertIsNone(self.probe('https://example.com/v/def'))
+        self.client.post('/api/get_formats/', {'url': 'https://example.com/v/ghi', 'prefetch': False}, content_type='application/json')
+        self.assertFalse(DownloadLog.objects.filter(url='https://example.com/v/ghi').exists()) # The client opted out
+        speculative = self.probe('https://example.com/v/xyz')
+        speculation.expire(speculative.id)
+        speculative.refresh_from_db()
+        self.assertEqual(speculative.status, 'CANCELLED')
+        self.assertEqual(DownloadLog.objects.filter(speculative=True).count(), 2)
+
+    def test_timeout_evicts_finished_unadopted_speculation(self):
+        media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, media, True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        speculative = self.probe('https://example.com/v/abc')
+        key = f'downloads/alice/{speculative.id}/abc.mp4'
+        os.makedirs(os.path.dirname(storage.path_for_key(key)))
+        with open(storage.path_for_key(key), 'wb') as f: f.write(b'x' * 10)
+        speculative.status, speculative.downloaded_files_info = 'SUCCESS', [storage.file_info(key, 'abc.mp4', {'size': 10})]
+        speculative.save()
+        singleflight.remember_result(speculative)
+        self.assertEqual(singleflight.completed_result(speculative), speculative)
+
+        speculation.expire(speculative.id)
+        speculative.refresh_from_db()
+        self.assertEqual((speculative.status, speculative.downloaded_files_info), ('EVICTED', []))
+        self.assertFalse(os.path.exists(storage.path_for_key(key)))
+        self.assertIsNone(cache.get(singleflight.completed_key(speculative)))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CachedAuthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_user_cache()
+        self.user = User.objects.create_user('alice', password='pw-alice-123')
+        self.client.post('/api/auth/login/', {'username': 'alice', 'password': 'pw-alice-123'}, content_type='application/json')
+
+    def test_auth_status_needs_no_queries_once_warm(self):
+        self.client.get('/api/auth/status/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/auth/status/')
+        self.assertEqual(response.json(), {'isAuthenticated': True, 'username': 'alice'})
+
+    def test_changing_a_returned_user_does_not_change_the_cached_one(self):
+        backend = CachedModelBackend()
+        first = backend.get_user(self.user.pk) # Cache miss
+        first.username = 'mutated'
+        self.assertEqual(backend.get_user(self.user.pk).username, 'alice')
+        hit = backend.get_user(self.user.pk)
+        hit.username = 'mutated'
+        self.assertEqual(backend.get_user(self.user.pk).username, 'alice')
+
+    def test_user_changes_and_logout_are_not_served_from_cache(self):
+        self.client.get('/api/auth/status/')
+        User.objects.filter(pk=self.user.pk).update(username='stale') # Bypasses signals: still cached
+        self.assertEqual(self.client.get('/api/auth/status/').json()['username'], 'alice')
+        self.user.username = 'alice2'; self.user.save() # Saved through the ORM: invalidated
+        self.assertEqual(self.client.get('/api/auth/status/').json()['username'], 'alice2')
+        self.client.post('/api/auth/logout/')
+        self.assertEqual(self.client.get('/api/auth/status/').json(), {'isAuthenticated': False})
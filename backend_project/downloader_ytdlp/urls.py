@@ -5,8 +5,13 @@ from . import views
 urlpatterns = [
     # --- Existing Download URLs ---
     path('download/', views.DownloadView.as_view(), name='download'),
+    path('download/batch/', views.BatchDownloadView.as_view(), name='download_batch'),
+    path('download/<uuid:log_id>/cancel/', views.cancel_download, name='download_cancel'),
+    path('download/<uuid:log_id>/files/', views.evict_download, name='download_files'),
+    path('storage/usage/', views.storage_usage, name='storage_usage'),
     path('task_status/<str:task_id>/', views.get_task_status, name='task_status'),
     path('get_formats/', views.get_available_formats, name='get_formats'),
+    path('playlist/entries/', views.get_playlist_entries, name='playlist_entries'),
 
     # --- NEW Forum URLs ---
     path('forum/topics/', views.forum_topic_list_create, name='forum_topic_list_create'),
@@ -0,0 +1,106 @@
+# downloader_ytdlp/usage.py
+"""
+Per-user storage accounting.
+
+Each stored file's size is recorded in downloaded_files_info (storage.py). When
+a download succeeds, the sum is written to DownloadLog.storage_bytes and added
+to the target user's UserStorageUsage row, in the same transaction that saves
+the log as SUCCESS. Evicting a download's files subtracts it again, in the
+same transaction that clears the files from the log. The counters therefore
+always equal the sum of storage_bytes over the user's logs, which is what
+recount() rebuilds them from.
+
+A user is charged for every file they hold, including followers' hardlinks
+that share disk with the leader. Speculative downloads belong to nobody until
+a request adopts them; the adopting follower is then charged.
+
+Reading the usage is a single primary-key lookup, so the quota check at
+submission time (admission.py) is O(1) however many downloads a user has.
+"""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DownloadLog, UserStorageUsage
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def owner_id(log_entry):
+    """The user whose storage a download's files count against (admission checks the same quota)."""
+    return log_entry.target_user_for_download_id or log_entry.user_id
+
+
+def _adjust(user_id, delta_bytes, delta_files):
+    UserStorageUsage.objects.get_or_create(user_id=user_id)
+    UserStorageUsage.objects.filter(user_id=user_id).update(bytes_used=F('bytes_used') + delta_bytes, files=F('files') + delta_files, updated_at=timezone.now())
+
+
+def charge(log_entry):
+    """
+    Add a successful download's files to its owner's usage. Call inside the transaction
+    that saves it as SUCCESS. Charges each log once, so a redelivered task cannot double count.
+    """
+    if log_entry.speculative:
+        return
+    files = log_entry.downloaded_files_info or []
+    size = sum(item.get('size') or 0 for item in files)
+    if DownloadLog.objects.filter(id=log_entry.id, storage_bytes=0).update(storage_bytes=size) and size:
+        log_entry.storage_bytes = size
+        _adjust(owner_id(log_entry), size, len(files))
+
+
+def evict(log_entry):
+    """Delete a finished download's files and give its bytes back to the owner. Returns the bytes freed."""
+    with transaction.atomic():
+        locked = DownloadLog.objects.select_for_update().filter(id=log_entry.id, status='SUCCESS').first()
+        if locked is None:
+            return 0
+        files, freed = locked.downloaded_files_info or [], locked.storage_bytes
+        DownloadLog.objects.filter(id=locked.id).update(status='EVICTED', downloaded_files_info=[], storage_bytes=0, updated_at=timezone.now())
+        if freed:
+            _adjust(owner_id(locked), -freed, -len(files))
+    storage = get_storage()
+    for item in files:
+        try:
+            storage.delete(item.get('storage_key') or item['file_url'][len(settings.MEDIA_URL):])
+        except Exception: # Already accounted for; the file is an orphan now
+            logger.exception("Could not delete evicted file", extra={'log_id': locked.id, 'filename': item.get('filename')})
+    log_entry.status, log_entry.downloaded_files_info, log_entry.storage_bytes = 'EVICTED', [], 0
+    logger.info("Download evicted", extra={'log_id': locked.id, 'bytes': freed, 'files': len(files)})
+    return freed
+
+
+def quota_for(usage):
+    """A user's quota in bytes, or None for no limit."""
+    if usage is not None and usage.quota_bytes is not None:
+        return usage.quota_bytes
+    return settings.DOWNLOAD_USER_QUOTA_BYTES
+
+
+def usage_of(user):
+    """{'bytes_used', 'files', 'quota_bytes', 'bytes_available'} from the user's counter row."""
+    usage = UserStorageUsage.objects.filter(user=user).first()
+    used, files = (usage.bytes_used, usage.files) if usage else (0, 0)
+    quota = quota_for(usage)
+    return {'bytes_used': used, 'files': files, 'quota_bytes': quota, 'bytes_available': None if quota is None else max(0, quota - used)}
+
+
+def recount(user_ids=None):
+    """Rebuild the counters from DownloadLog.storage_bytes (e.g. after restoring a backup). Returns the users with usage."""
+    totals = {}
+    for log_entry in DownloadLog.objects.filter(storage_bytes__gt=0).only('user_id', 'target_user_for_download_id', 'storage_bytes', 'downloaded_files_info'):
+        owner = owner_id(log_entry)
+        if user_ids is None or owner in user_ids:
+            size, files = totals.get(owner, (0, 0))
+            totals[owner] = (size + log_entry.storage_bytes, files + len(log_entry.downloaded_files_info or []))
+    with transaction.atomic():
+        rows = UserStorageUsage.objects.all() if user_ids is None else UserStorageUsage.objects.filter(user_id__in=user_ids)
+        rows.update(bytes_used=0, files=0, updated_at=timezone.now())
+        for owner, (size, files) in totals.items():
+            UserStorageUsage.objects.update_or_create(user_id=owner, defaults={'bytes_used': size, 'files': files})
+    return len(totals)
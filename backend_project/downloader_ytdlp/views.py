@@ -1,7 +1,8 @@
 # downloader_ytdlp/views.py
-import traceback
-import yt_dlp
-import pprint
+import hashlib
+import logging
+import math
+import re
 import uuid
 
 from rest_framework.views import APIView
@@ -9,14 +10,26 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.fields import BooleanField
 
 from celery.result import AsyncResult
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
 
-from .tasks import download_video_task
+from .admission import admit, eta_seconds
+from .cancellation import CANCELLABLE_STATUSES, request_cancellation
+from .job_cost import remember_probe, get_probe, estimate_job_bytes, classify_job, clip_share, pick_budget_format
+from .logs import YtDlpLogger
+from .scheduler import get_dispatcher, submit_log, submit_logs
+from .singleflight import attach_or_lead
+from .speculation import adopt_speculative, default_choice, start_speculative_download, supersede_speculative
+from .storage import refresh_urls
+from .usage import evict, usage_of
+from .ytdl import get_yt_dlp, new_youtube_dl
 from .models import DownloadLog, ForumTopic, ForumPost
 from .serializers import (
     UserSerializer, DownloadLogSerializer,
@@ -24,6 +37,8 @@ from .serializers import (
     BasicUserSerializer
 )
 
+logger = logging.getLogger(__name__)
+
 # Helper Decorator
 def admin_required(view_func):
     def _wrapped_view(request, *args, **kwargs):
@@ -32,30 +47,181 @@ def admin_required(view_func):
         return view_func(request, *args, **kwargs)
     return _wrapped_view
 
+PLAYLIST_ITEMS_RE = re.compile(r'^\d+(-\d+)?(,\d+(-\d+)?)*$') # e.g. "1,4,10-20" (yt-dlp playlist_items syntax, 1-based)
+TIMESTAMP_PART_RE = re.compile(r'^\d+(\.\d+)?$')
+SIZE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([kmg])?i?b?$', re.IGNORECASE)
+
+def parse_timestamp(value):
+    """Seconds from 90, 90.5, '1:30' or '01:02:03.250'; None when empty. Raises ValueError when malformed."""
+    if value is None or value == '': return None
+    if isinstance(value, bool): raise ValueError(value)
+    if isinstance(value, (int, float)): seconds = float(value)
+    else:
+        parts = str(value).strip().split(':')
+        if len(parts) > 3 or not all(TIMESTAMP_PART_RE.match(part) for part in parts): raise ValueError(value)
+        seconds = 0.0
+        for part in parts: seconds = seconds * 60 + float(part)
+    if not math.isfinite(seconds) or seconds < 0: raise ValueError(value)
+    return round(seconds, 3)
+
+def parse_flag(value):
+    """True/False from a JSON boolean or a form string ('true', '0', 'off', ...) as DRF's BooleanField reads them; missing is False. Raises ValueError."""
+    if value is None or value == '': return False
+    if value in BooleanField.TRUE_VALUES: return True
+    if value in BooleanField.FALSE_VALUES: return False
+    raise ValueError(value)
+
+def parse_budget(data):
+    """(max_bytes, max_kbps) from max_filesize (bytes, '500M', '1.5GB') and max_bitrate (kbit/s). Raises ValueError."""
+    max_bytes = data.get('max_filesize'); max_kbps = data.get('max_bitrate')
+    if isinstance(max_bytes, bool) or isinstance(max_kbps, bool): raise ValueError('boolean budget')
+    if max_bytes not in (None, ''):
+        match = SIZE_RE.match(str(max_bytes).strip())
+        if not match: raise ValueError(max_bytes)
+        max_bytes = int(float(match.group(1)) * 1024 ** ' kmg'.index((match.group(2) or ' ').lower()))
+        if max_bytes <= 0: raise ValueError(max_bytes)
+    else: max_bytes = None
+    if max_kbps not in (None, ''):
+        max_kbps = float(max_kbps)
+        if not math.isfinite(max_kbps) or max_kbps <= 0: raise ValueError(max_kbps)
+    else: max_kbps = None
+    return max_bytes, max_kbps
+
+def validate_download_request(data):
+    """
+    Shared checks for single and batch submissions. Returns (cleaned, error_message).
+    Without a format_code (or with 'budget'), max_filesize/max_bitrate pick the best format that fits,
+    from the probe get_formats cached (never a fresh one: no extraction in the request), and cleaned carries that explicit code.
+    """
+    url = data.get('url'); format_code = data.get('format_code'); format_type = data.get('format_type')
+    try: max_bytes, max_kbps = parse_budget(data)
+    except (TypeError, ValueError): return None, 'max_filesize must be bytes or like "500M"/"1.5G"; max_bitrate is in kbit/s'
+    use_budget = format_code in (None, '', 'budget') and (max_bytes is not None or max_kbps is not None)
+    if not url or not format_type or not (format_code or use_budget) or (format_code == 'budget' and not use_budget): return None, 'URL, code, type required'
+    try: URLValidator()(url)
+    except ValidationError: return None, 'Invalid URL'
+    if format_type not in ['video', 'audio']: return None, 'Invalid format_type'
+    try: is_playlist = parse_flag(data.get('is_playlist')); accurate_cut = parse_flag(data.get('accurate_cut'))
+    except (TypeError, ValueError): return None, 'is_playlist and accurate_cut must be true or false'
+    playlist_items = data.get('playlist_items') or None
+    if playlist_items is not None:
+        playlist_items = str(playlist_items).replace(' ', '')
+        if not is_playlist or not PLAYLIST_ITEMS_RE.match(playlist_items): return None, 'playlist_items must look like "1,3,5-9" and requires is_playlist'
+    try: clip_start = parse_timestamp(data.get('start_time')) or None; clip_end = parse_timestamp(data.get('end_time')) # A start of 0 is no start
+    except ValueError: return None, 'start_time and end_time must be seconds or [HH:]MM:SS(.mmm)'
+    is_clip = clip_start is not None or clip_end is not None
+    if is_clip and is_playlist: return None, 'start_time/end_time apply to single videos, not playlists'
+    if clip_end is not None and clip_end <= (clip_start or 0): return None, 'end_time must be after start_time'
+    if use_budget:
+        if is_playlist: return None, 'max_filesize/max_bitrate apply to single videos, not playlists'
+        probe = get_probe(url)
+        if not probe or 'formats' not in probe: return None, 'Formats for this URL are not known yet: call get_formats first, then submit max_filesize/max_bitrate'
+        picked = pick_budget_format(probe, format_type, max_bytes, max_kbps, clip_share(probe.get('duration'), clip_start, clip_end))
+        if picked is None: return None, 'No format fits within max_filesize/max_bitrate'
+        format_code = picked[0]
+    return {'url': url, 'format_code': format_code, 'format_type': format_type, 'is_playlist': is_playlist, 'playlist_items': playlist_items, 'filename_template': data.get('filename_template', None),
+            'clip_start': clip_start, 'clip_end': clip_end, 'accurate_cut': is_clip and accurate_cut}, None
+
+def build_download_log(user, cleaned):
+    """Unsaved DownloadLog with id and task_id assigned up front, so it can be bulk-inserted and polled right away."""
+    estimated_bytes = estimate_job_bytes(cleaned['url'], cleaned['format_code'], cleaned['format_type'], cleaned['is_playlist'], cleaned['clip_start'], cleaned['clip_end'])
+    size_tier, _ = classify_job(estimated_bytes, cleaned['is_playlist'])
+    return DownloadLog(
+        id=uuid.uuid4(), task_id=str(uuid.uuid4()), user=user, target_user_for_download=user,
+        url=cleaned['url'], format_code_selected=cleaned['format_code'], format_type_selected=cleaned['format_type'],
+        is_playlist_download=cleaned['is_playlist'], playlist_items=cleaned['playlist_items'], filename_template=cleaned['filename_template'],
+        clip_start=cleaned['clip_start'], clip_end=cleaned['clip_end'], accurate_cut=cleaned['accurate_cut'],
+        estimated_bytes=estimated_bytes, size_tier=size_tier,
+    )
+
+def admission_refused(refusal, **extra):
+    """429/503 response for a refused submission; Retry-After tells the client when to come back."""
+    return Response({'error': refusal['error'], 'retry_after': refusal['retry_after'], **extra}, status=refusal['status'], headers={'Retry-After': str(refusal['retry_after'])})
+
 # DownloadView
 class DownloadView(APIView):
     permission_classes = [IsAuthenticated]
     def post(self, request, *args, **kwargs):
-        url = request.data.get('url'); format_code = request.data.get('format_code'); format_type = request.data.get('format_type'); is_playlist = request.data.get('is_playlist', False); filename_template = request.data.get('filename_template', None)
-        acting_user = request.user; user_to_download_for = acting_user;
-        if not url or not format_code or not format_type: return Response({'error': 'URL, code, type required'}, status=status.HTTP_400_BAD_REQUEST)
-        validator = URLValidator();
-        try: validator(url)
-        except ValidationError: return Response({'error': 'Invalid URL'}, status=status.HTTP_400_BAD_REQUEST)
-        if format_type not in ['video', 'audio']: return Response({'error': 'Invalid format_type'}, status=status.HTTP_400_BAD_REQUEST)
-        log_entry = None
+        cleaned, error = validate_download_request(request.data)
+        if error: return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        acting_user = request.user
+        log_entry = build_download_log(acting_user, cleaned); task_id = log_entry.task_id
+        admitted, refusal, load = admit(acting_user, [log_entry])
+        if not admitted: return admission_refused(refusal)
         try:
-            log_entry = DownloadLog.objects.create(user=acting_user,target_user_for_download=user_to_download_for,url=url,format_code_selected=format_code,format_type_selected=format_type,is_playlist_download=is_playlist)
-        except Exception as e: print(f"Error creating DownloadLog: {e}"); traceback.print_exc(); return Response({'error': 'Could not initiate download log.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        print(f"Dispatching: User '{acting_user.username}' (LogID:{log_entry.id}), Template:'{filename_template if filename_template else 'Default'}'")
+            log_entry.save(force_insert=True)
+        except Exception: logger.exception("Could not create DownloadLog", extra={'user': acting_user.username}); return Response({'error': 'Could not initiate download log.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        logger.info("Dispatching download", extra={'user': acting_user.username, 'log_id': log_entry.id, 'template': cleaned['filename_template'] or 'default'})
         try:
-            task = download_video_task.delay(url=url,format_code=format_code,format_type=format_type,target_username=user_to_download_for.username,is_playlist=is_playlist,filename_template=filename_template,log_id=log_entry.id)
-            log_entry.task_id = task.id; log_entry.save(update_fields=['task_id','updated_at'])
-            print(f"Task dispatched: {task.id}")
-            return Response({'task_id': task.id, 'log_id': str(log_entry.id)}, status=status.HTTP_202_ACCEPTED)
+            supersede_speculative(acting_user, log_entry)
+            leader = attach_or_lead(log_entry)
+            if leader is not None:
+                # Identical download already in flight (or finished): follow it instead of downloading the same bytes again
+                adopt_speculative(leader)
+                return Response({'task_id': task_id, 'log_id': str(log_entry.id), 'attached_to': str(leader.id), 'queue_position': None, 'eta_seconds': 0 if log_entry.status == 'SUCCESS' else eta_seconds(load)}, status=status.HTTP_202_ACCEPTED)
+            dispatcher = submit_log(log_entry)
+            logger.info("Task queued for fair-share dispatch", extra={'task_id': task_id, 'tier': log_entry.size_tier, 'est_bytes': log_entry.estimated_bytes})
+            return Response({'task_id': task_id, 'log_id': str(log_entry.id), 'queue_position': dispatcher.queue_position(task_id), 'eta_seconds': eta_seconds(load)}, status=status.HTTP_202_ACCEPTED)
         except Exception as e:
             log_entry.status='FAILURE'; log_entry.error_message=f"Queue fail: {str(e)}"; log_entry.task_id=f"FAIL_Q_{uuid.uuid4()}"; log_entry.save(update_fields=['status','error_message','task_id','updated_at'])
-            print(f"Error dispatching Celery task: {e}"); traceback.print_exc(); return Response({'error': 'Failed to queue download task.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            logger.exception("Could not dispatch Celery task", extra={'task_id': task_id}); return Response({'error': 'Failed to queue download task.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# BatchDownloadView
+class BatchDownloadView(APIView):
+    """
+    POST {'items': [{url, format_code, format_type, is_playlist?, filename_template?, start_time?, end_time?, accurate_cut?}, ...]}
+    Validates every item, inserts all logs with one bulk_create and publishes all
+    releasable tasks over one broker connection. Responds with one result per item, in order.
+    Items beyond what admission control allows come back 'throttled' with a retry_after.
+    """
+    permission_classes = [IsAuthenticated]
+    def post(self, request, *args, **kwargs):
+        items = request.data.get('items')
+        if not isinstance(items, list) or not items: return Response({'error': 'items must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.DOWNLOAD_BATCH_MAX_ITEMS: return Response({'error': f'At most {settings.DOWNLOAD_BATCH_MAX_ITEMS} items per batch'}, status=status.HTTP_400_BAD_REQUEST)
+        acting_user = request.user
+        results = [None] * len(items); accepted = []
+        for index, item in enumerate(items):
+            cleaned, error = validate_download_request(item) if isinstance(item, dict) else (None, 'Item must be an object')
+            if error: results[index] = {'index': index, 'status': 'rejected', 'error': error}
+            else: accepted.append((index, build_download_log(acting_user, cleaned)))
+        if not accepted: return Response({'results': results}, status=status.HTTP_400_BAD_REQUEST)
+        admitted, refusal, load = admit(acting_user, [log_entry for _, log_entry in accepted])
+        for index, _ in accepted[admitted:]: results[index] = {'index': index, 'status': 'throttled', 'error': refusal['error'], 'retry_after': refusal['retry_after']}
+        if not admitted: return admission_refused(refusal, results=results)
+        accepted = accepted[:admitted]; eta = {log_entry.id: eta_seconds(load, position) for position, (_, log_entry) in enumerate(accepted, 1)}
+
+        try:
+            DownloadLog.objects.bulk_create([log_entry for _, log_entry in accepted])
+        except Exception as e:
+            logger.exception("Could not bulk-create DownloadLogs", extra={'user': acting_user.username, 'count': len(accepted)})
+            return Response({'error': 'Could not initiate download logs.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        leaders = []
+        for index, log_entry in accepted:
+            supersede_speculative(acting_user, log_entry)
+            leader = attach_or_lead(log_entry)
+            if leader is not None: adopt_speculative(leader); results[index] = {'index': index, 'status': 'attached', 'task_id': log_entry.task_id, 'log_id': str(log_entry.id), 'attached_to': str(leader.id), 'eta_seconds': 0 if log_entry.status == 'SUCCESS' else eta[log_entry.id]}
+            else: leaders.append((index, log_entry))
+        try:
+            dispatcher = submit_logs([log_entry for _, log_entry in leaders]) if leaders else None
+        except Exception as e:
+            logger.exception("Could not dispatch batch", extra={'user': acting_user.username, 'count': len(leaders)})
+            DownloadLog.objects.filter(id__in=[log_entry.id for _, log_entry in leaders]).update(status='FAILURE', error_message=f"Queue fail: {str(e)}")
+            for index, log_entry in leaders: results[index] = {'index': index, 'status': 'failed', 'log_id': str(log_entry.id), 'error': 'Failed to queue download task.'}
+            dispatcher = None; leaders = []
+        for index, log_entry in leaders:
+            results[index] = {'index': index, 'status': 'queued', 'task_id': log_entry.task_id, 'log_id': str(log_entry.id), 'queue_position': dispatcher.queue_position(log_entry.task_id), 'eta_seconds': eta[log_entry.id]}
+        logger.info("Batch submitted", extra={'user': acting_user.username, 'items': len(items), 'queued': len(leaders), 'attached_or_failed': len(accepted) - len(leaders), 'rejected_or_throttled': len(items) - len(accepted)})
+        any_ok = any(r['status'] in ('queued', 'attached') for r in results)
+        return Response({'results': results}, status=status.HTTP_202_ACCEPTED if any_ok else status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def speculate(user, url, probe):
+    """Start downloading the recommended format while the user decides (see speculation.py). Never fails the probe."""
+    format_code, format_type = default_choice(probe)
+    cleaned = {'url': url, 'format_code': format_code, 'format_type': format_type, 'is_playlist': False, 'playlist_items': None, 'filename_template': None, 'clip_start': None, 'clip_end': None, 'accurate_cut': False}
+    try: start_speculative_download(build_download_log(user, cleaned))
+    except Exception: logger.exception("Could not start speculative download", extra={'url': url})
 
 # get_available_formats (Corrected)
 @api_view(['POST'])
@@ -70,18 +236,20 @@ def get_available_formats(request):
         validator(url)
     except ValidationError:
         return Response({'error': 'Invalid URL format'}, status=status.HTTP_400_BAD_REQUEST)
+    try: max_bytes, max_kbps = parse_budget(request.data) # Optional: also suggest the best format within this budget
+    except (TypeError, ValueError): return Response({'error': 'max_filesize must be bytes or like "500M"/"1.5G"; max_bitrate is in kbit/s'}, status=status.HTTP_400_BAD_REQUEST)
 
-    print(f"Fetching formats for URL: {url}")
+    logger.info("Fetching formats", extra={'url': url})
+    yt_dlp = get_yt_dlp() # Imported lazily so web processes don't pay for it at startup
     try:
-        ydl_opts = {'quiet': True, 'no_warnings': True, 'noplaylist': True, 'nocheckcertificate': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl_opts = {'quiet': True, 'noplaylist': True, 'logger': YtDlpLogger(url=url)}
+        with new_youtube_dl(ydl_opts) as ydl:
             info_dict = ydl.extract_info(url, download=False)
+        probe = remember_probe(url, info_dict) # Sizes/duration for size-aware dispatch of the follow-up download
 
-        print(f"--- INFO DICT for {url} (get_available_formats) ---"); pprint.pprint(info_dict)
         raw_formats_from_yt_dlp = info_dict.get('formats', [])
-        print(f"--- RAW FORMATS COUNT from yt-dlp: {len(raw_formats_from_yt_dlp)} ---")
-        if raw_formats_from_yt_dlp: print("--- FIRST RAW FORMAT EXAMPLE: ---"); pprint.pprint(raw_formats_from_yt_dlp[0])
-        else: print("--- No formats found in raw info_dict from yt-dlp ---")
+        # Only a summary: the info dict runs to hundreds of KB; ask yt-dlp itself (-J) for the full thing
+        logger.debug("Probed formats", extra={'url': url, 'raw_formats': len(raw_formats_from_yt_dlp), 'first_format': raw_formats_from_yt_dlp[0].get('format_id') if raw_formats_from_yt_dlp else None})
 
         processed_formats = []
 
@@ -155,33 +323,144 @@ def get_available_formats(request):
         for pf in processed_formats:
             if pf['code']not in seen_codes:final_unique_formats.append(pf);seen_codes.add(pf['code'])
 
-        print(f"Processed and sending {len(final_unique_formats)} unique formats for {url} to frontend.")
+        if max_bytes is not None or max_kbps is not None:
+            budget_desc = ', '.join(part for part in (f"{round(max_bytes/(1024*1024),1)}MB" if max_bytes else '', f"{round(max_kbps)}kbps" if max_kbps else '') if part)
+            for budget_type in ('audio', 'video'): # Video ends up first
+                picked = pick_budget_format(probe, budget_type, max_bytes, max_kbps)
+                if picked: final_unique_formats.insert(0, {'code': picked[0], 'description': f"Best {budget_type} within {budget_desc} ({picked[0]}, ~{round(picked[1]/(1024*1024),1) if picked[1] else '?'}MB)", 'type': budget_type, 'extension': 'mp4' if budget_type == 'video' else 'audio', 'filesize': picked[1], 'sort_key': 20000, 'budget': True})
+
+        logger.info("Sending formats", extra={'url': url, 'formats': len(final_unique_formats)})
+        if settings.DOWNLOAD_SPECULATIVE_PREFETCH and request.data.get('prefetch', True) is not False: speculate(request.user, url, probe)
         return Response({'formats': final_unique_formats}, status=status.HTTP_200_OK)
 
-    except yt_dlp.utils.DownloadError as e: print(f"yt-dlp DL Error fetching formats for {url}: {e}"); return Response({'error':f'Could not retrieve formats: {str(e)}'},status=status.HTTP_400_BAD_REQUEST)
-    except Exception as e: print(f"Unexpected error fetching formats for {url}:"); traceback.print_exc(); return Response({'error':'An unexpected error occurred while fetching formats.'},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except yt_dlp.utils.DownloadError as e: logger.warning("yt-dlp could not fetch formats: %s", e, extra={'url': url}); return Response({'error':f'Could not retrieve formats: {str(e)}'},status=status.HTTP_400_BAD_REQUEST)
+    except Exception: logger.exception("Unexpected error fetching formats", extra={'url': url}); return Response({'error':'An unexpected error occurred while fetching formats.'},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# get_playlist_entries
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def get_playlist_entries(request):
+    """
+    One page of a playlist/channel: [{index, id, title, duration, url}], via flat extraction.
+    yt-dlp pulls playlist entries lazily and stops once the requested slice is filled, so
+    page 1 of a 5,000-video channel only fetches the first listing page(s). Pages are cached.
+    """
+    url = request.data.get('url')
+    if not url: return Response({'error': 'URL is required'}, status=status.HTTP_400_BAD_REQUEST)
+    try: URLValidator()(url)
+    except ValidationError: return Response({'error': 'Invalid URL format'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        page = int(request.data.get('page', 1)); page_size = int(request.data.get('page_size', settings.PLAYLIST_PAGE_SIZE))
+    except (TypeError, ValueError): return Response({'error': 'page and page_size must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    if page < 1 or not 1 <= page_size <= settings.PLAYLIST_MAX_PAGE_SIZE: return Response({'error': f'page must be >= 1 and page_size between 1 and {settings.PLAYLIST_MAX_PAGE_SIZE}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    cache_key = 'playlist_page:' + hashlib.sha1(f"{url}|{page}|{page_size}".encode()).hexdigest()
+    try: cached = cache.get(cache_key)
+    except Exception as cache_exc: logger.warning("Playlist page cache unavailable: %s", cache_exc); cached = None
+    if cached is not None: return Response(cached, status=status.HTTP_200_OK)
+
+    first = (page - 1) * page_size + 1; last = first + page_size # One extra entry tells us whether there is a next page
+    logger.info("Fetching playlist entries %d-%d", first, last - 1, extra={'url': url})
+    yt_dlp = get_yt_dlp()
+    try:
+        ydl_opts = {'quiet': True, 'extract_flat': 'in_playlist', 'playlist_items': f'{first}-{last}', 'logger': YtDlpLogger(sample=settings.LOG_SAMPLE_EVERY, url=url)}
+        with new_youtube_dl(ydl_opts) as ydl:
+            info_dict = ydl.extract_info(url, download=False)
+        if info_dict.get('_type') not in ('playlist', 'multi_video'): return Response({'error': 'URL is not a playlist or channel'}, status=status.HTTP_400_BAD_REQUEST)
+        raw_entries = list(info_dict.get('entries') or [])
+        positions = info_dict.get('requested_entries') or range(first, first + len(raw_entries)) # Playlist index of each entry, taken before unavailable (None) ones are dropped
+        entries = [{'index': index, 'id': e.get('id'), 'title': e.get('title'), 'duration': e.get('duration'), 'url': e.get('url') or e.get('webpage_url')} for index, e in zip(positions, raw_entries) if e and index < last]
+        data = {'title': info_dict.get('title'), 'playlist_id': info_dict.get('id'), 'playlist_count': info_dict.get('playlist_count'), 'page': page, 'page_size': page_size, 'has_more': max(positions, default=0) >= last, 'entries': entries}
+        try: cache.set(cache_key, data, settings.PLAYLIST_PAGE_CACHE_TIMEOUT)
+        except Exception as cache_exc: logger.warning("Could not cache playlist page: %s", cache_exc)
+        return Response(data, status=status.HTTP_200_OK)
+    except yt_dlp.utils.DownloadError as e: logger.warning("yt-dlp could not fetch playlist entries: %s", e, extra={'url': url}); return Response({'error':f'Could not retrieve playlist: {str(e)}'},status=status.HTTP_400_BAD_REQUEST)
+    except Exception: logger.exception("Unexpected error fetching playlist entries", extra={'url': url}); return Response({'error':'An unexpected error occurred while fetching the playlist.'},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # get_task_status
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_task_status(request, task_id):
     try:
-        task_result = AsyncResult(task_id)
+        log_entry = DownloadLog.objects.filter(task_id=task_id).select_related('leader').first()
+        if log_entry is not None and log_entry.status == 'CANCELLED':
+            return Response({'task_id': task_id, 'status': 'CANCELLED', 'info': {'status': 'Cancelled', 'progress': 0}, 'result': None})
+        follower = log_entry if log_entry is not None and log_entry.leader_id else None
+        if follower is not None and follower.status != 'ATTACHED':
+            # Single-flight follower that has settled: it never had a Celery task of its own
+            response_data = {'task_id': task_id, 'status': follower.status, 'info': None, 'result': refresh_urls(follower.downloaded_files_info)}
+            if follower.status == 'FAILURE': response_data['result'] = {'exc_type': 'FollowerError', 'exc_message': follower.error_message}
+            return Response(response_data)
+        # Attached followers report the leader's progress under their own task_id
+        task_result = AsyncResult(follower.leader.task_id if follower is not None else task_id)
         response_data = {'task_id': task_id, 'status': task_result.status, 'info': None, 'result': None}
         try:
              if isinstance(task_result.info, dict): response_data['info'] = task_result.info
-             elif task_result.info is not None: print(f"Warning: Task {task_id} info not dict: {type(task_result.info)}")
-        except Exception as info_exc: print(f"Error retrieving info: {info_exc}"); response_data['info'] = {'error': 'Could not retrieve metadata'}
+             elif task_result.info is not None: logger.warning("Task info is not a dict: %s", type(task_result.info).__name__, extra={'task_id': task_id})
+        except Exception as info_exc: logger.warning("Could not read task info: %s", info_exc, extra={'task_id': task_id}); response_data['info'] = {'error': 'Could not retrieve metadata'}
+        if follower is not None and task_result.ready():
+            # Leader done; hardlinking to this follower is still in progress
+            response_data['status'] = 'PROGRESS'; response_data['info'] = {'status': 'Linking shared download...', 'progress': 99}
+            return Response(response_data)
+        if task_result.status == 'PENDING' and follower is None:
+            # Still waiting in the fair-share queue? Report where.
+            try: response_data['queue_position'] = get_dispatcher().queue_position(task_id)
+            except Exception as queue_exc: logger.warning("Could not read queue position: %s", queue_exc, extra={'task_id': task_id})
+            if response_data.get('queue_position'): response_data['info'] = {'status': f"Queued (position {response_data['queue_position']} in your queue)", 'progress': 0}
         if task_result.ready():
             if task_result.successful():
                 response_data['status'] = 'SUCCESS'
-                response_data['result'] = task_result.result
+                response_data['result'] = refresh_urls(task_result.result) # Presigned URLs are re-signed on every poll
             elif task_result.failed():
                 response_data['status'] = 'FAILURE'
                 exc = task_result.result; response_data['result'] = {'exc_type': type(exc).__name__, 'exc_message': str(exc)}
                 if response_data.get('info') and 'status' in response_data['info']: response_data['status_message'] = response_data['info'].get('status')
         return Response(response_data)
-    except Exception as e: print(f"--- ERROR in get_task_status for {task_id} ---"); traceback.print_exc(); return Response({'error': 'Internal error checking status.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except Exception: logger.exception("Error checking task status", extra={'task_id': task_id}); return Response({'error': 'Internal error checking status.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# cancel_download
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def cancel_download(request, log_id):
+    """
+    Cancel one of your downloads. 200 + CANCELLED when it was stopped before running (or was a follower),
+    202 + CANCELLING while the worker aborts it (poll task_status), 409 when it already finished.
+    """
+    log_entry = DownloadLog.objects.filter(id=log_id).first()
+    if log_entry is None or not (request.user.is_staff or request.user.id in (log_entry.user_id, log_entry.target_user_for_download_id)): return Response({'error': 'Download not found'}, status=status.HTTP_404_NOT_FOUND)
+    if log_entry.status not in CANCELLABLE_STATUSES: return Response({'error': f'Download already finished ({log_entry.status})', 'status': log_entry.status}, status=status.HTTP_409_CONFLICT)
+    try: new_status = request_cancellation(log_entry)
+    except Exception: logger.exception("Could not cancel download", extra={'log_id': log_id}); return Response({'error': 'Could not cancel the download right now, try again.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    body = {'log_id': str(log_entry.id), 'task_id': log_entry.task_id}
+    if new_status == 'CANCELLED': return Response({**body, 'status': 'CANCELLED'}, status=status.HTTP_200_OK)
+    if new_status in CANCELLABLE_STATUSES: return Response({**body, 'status': 'CANCELLING'}, status=status.HTTP_202_ACCEPTED)
+    return Response({**body, 'error': f'Download already finished ({new_status})', 'status': new_status}, status=status.HTTP_409_CONFLICT)
+
+# evict_download
+@api_view(['DELETE'])
+@permission_classes([IsAuthenticated])
+def evict_download(request, log_id):
+    """Delete a finished download's files; the bytes are given back to the owner's quota."""
+    log_entry = DownloadLog.objects.filter(id=log_id).first()
+    if log_entry is None or not (request.user.is_staff or request.user.id in (log_entry.user_id, log_entry.target_user_for_download_id)): return Response({'error': 'Download not found'}, status=status.HTTP_404_NOT_FOUND)
+    if log_entry.status != 'SUCCESS': return Response({'error': f'No files to delete ({log_entry.status})', 'status': log_entry.status}, status=status.HTTP_409_CONFLICT)
+    try: freed = evict(log_entry)
+    except Exception: logger.exception("Could not evict download", extra={'log_id': log_id}); return Response({'error': 'Could not delete the files right now, try again.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({'log_id': str(log_entry.id), 'status': log_entry.status, 'bytes_freed': freed, 'usage': usage_of(log_entry.target_user_for_download or log_entry.user)}, status=status.HTTP_200_OK)
+
+# storage_usage
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def storage_usage(request):
+    """Your stored bytes, file count and quota. Staff may pass ?username= for someone else's."""
+    username = request.query_params.get('username')
+    if username and username != request.user.username:
+        if not request.user.is_staff: return Response({'error': 'Admin privileges required.'}, status=status.HTTP_403_FORBIDDEN)
+        user = User.objects.filter(username=username).first()
+        if user is None: return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+    else: user = request.user
+    return Response({'username': user.username, **usage_of(user)})
 
 # Forum Views
 @api_view(['GET', 'POST'])
@@ -0,0 +1,107 @@
+# downloader_ytdlp/watchdog.py
+"""
+Stall detection for running downloads.
+
+The progress hook feeds every 'downloading' update to a StallWatchdog, which
+keeps the bytes received over the last DOWNLOAD_STALL_WINDOW seconds. A
+download whose rate stays under DOWNLOAD_STALL_MIN_RATE for a whole window is
+stalled and the hook aborts it. A connection on which nothing arrives at all
+fires no hooks; the socket timeout in ytdl.BASE_NETWORK_OPTS turns it into an
+ordinary (retried) network error instead.
+
+download_video_task then retries in place (partial files are resumed) with
+each of STALL_RECOVERIES in turn - fresh connections, then a different
+fragment concurrency - and fails with DownloadStalled when none helps. Each
+stall is appended to DownloadLog.stall_events.
+
+Only time spent downloading counts: extraction and ffmpeg post-processing
+report no progress and are bounded by the task's time limits instead
+(job_cost.time_limits).
+"""
+import collections
+import time
+
+from django.conf import settings
+
+
+class DownloadStalled(Exception):
+    """The download stayed below the minimum rate after every recovery attempt."""
+
+
+class StallWatchdog:
+    SAMPLE_INTERVAL = 1.0 # Progress hooks fire per chunk; one sample a second is plenty
+
+    def __init__(self, window=None, min_rate=None, clock=time.monotonic):
+        self.window = window or settings.DOWNLOAD_STALL_WINDOW
+        self.min_rate = min_rate if min_rate is not None else settings.DOWNLOAD_STALL_MIN_RATE
+        self.clock = clock
+        self.last_rate = None
+        self.received = 0 # Bytes received over every attempt of this run
+        self.reset()
+
+    def reset(self):
+        """Forget the current attempt; the next download starts a fresh window."""
+        self.tripped = False # stalled() said yes during this attempt
+        self.active = False # Between a file's first 'downloading' update and its 'finished'
+        self.total = 0 # Bytes received this attempt, across files
+        self.samples = collections.deque() # (time, total)
+        self._file = None
+        self._file_bytes = 0
+        self._since = None
+
+    def observe(self, d):
+        now = self.clock()
+        if d.get('status') != 'downloading':
+            self.active = False # Finished or failed file: post-processing or the next extraction follows
+            self.samples.clear()
+            return
+        downloaded = d.get('downloaded_bytes') or 0
+        name = d.get('tmpfilename') or d.get('filename')
+        if name != self._file: # New file; bytes resumed from an earlier attempt are not throughput
+            self._file, self._file_bytes = name, downloaded
+        received = max(0, downloaded - self._file_bytes)
+        self.total += received; self.received += received
+        self._file_bytes = downloaded
+        if not self.active:
+            self.active, self._since = True, now
+            self.samples.append((now, self.total))
+        elif now - self.samples[-1][0] >= self.SAMPLE_INTERVAL:
+            self.samples.append((now, self.total))
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft() # Keep one sample at or before the window start
+
+    def rate(self):
+        """Bytes/s over the last window, or None until a whole window has been spent downloading."""
+        if not self.active:
+            return None
+        now = self.clock()
+        if now - self._since < self.window:
+            return None
+        start = self.samples[0] # Last sample at or before the window start (no updates at all means the window saw nothing)
+        for sample in self.samples:
+            if sample[0] > now - self.window:
+                break
+            start = sample
+        return (self.total - start[1]) / self.window
+
+    def stalled(self):
+        rate = self.rate()
+        if rate is not None:
+            self.last_rate = rate
+        if rate is not None and rate < self.min_rate:
+            self.tripped = True
+        return self.tripped
+
+
+def fresh_connections(opts):
+    return 'retry with fresh connections', {}
+
+
+def other_fragment_concurrency(opts):
+    """A single throttled connection can be outrun with more fragments in flight; too many can trip rate limits."""
+    n = 1 if opts.get('concurrent_fragment_downloads', 1) > 1 else settings.DOWNLOAD_STALL_FRAGMENT_CONCURRENCY
+    return f'retry with fresh connections and {n} concurrent fragments', {'concurrent_fragment_downloads': n}
+
+
+# Tried in order after a stall; each gets its own YoutubeDL with its own connection pool
+STALL_RECOVERIES = (fresh_connections, other_fragment_concurrency)
@@ -0,0 +1,107 @@
+# downloader_ytdlp/ytdl.py
+"""
+Lazy yt-dlp access and per-process warm-up.
+
+Web processes only need yt-dlp when a format probe actually runs, so nothing
+here imports it at module import time. Celery worker processes call warm_up()
+from the worker_process_init signal: the extractor registry is loaded and
+resolved once, and a single request director (yt-dlp's HTTP handler pool) is
+built and then shared by every YoutubeDL instance the process creates, so
+keep-alive connections survive from one task to the next.
+"""
+import threading
+import time
+
+# Options shared by every YoutubeDL built in this app that affect the HTTP layer.
+# The shared request director is built from these, so they must stay consistent.
+# socket_timeout: a connection that goes quiet errors out (and yt-dlp retries it) rather than hanging
+# the download; see watchdog.py.
+BASE_NETWORK_OPTS = {'nocheckcertificate': True, 'socket_timeout': 30}
+
+_lock = threading.Lock()
+_pooled_class = None
+_shared_director = None
+_default_ies = None  # Extractor list resolved once; resolving it costs ~100ms per YoutubeDL
+_warm_ydl = None  # Owns the shared director (and its logger)
+
+
+def get_yt_dlp():
+    """Import yt_dlp on first use and return the module."""
+    import yt_dlp
+    return yt_dlp
+
+
+def _get_pooled_class():
+    global _pooled_class
+    if _pooled_class is None:
+        yt_dlp = get_yt_dlp()
+        from yt_dlp.networking.common import Request
+
+        class PooledYoutubeDL(yt_dlp.YoutubeDL):
+            """
+            YoutubeDL that sends requests through the process-wide request director.
+            Cookies stay per-instance: each request carries this instance's cookiejar.
+            close() leaves the shared director open because it never lands in __dict__.
+            """
+            @property
+            def _request_director(self):
+                return _shared_director
+
+            def add_default_info_extractors(self):
+                for ie in _default_ies:
+                    # Classes are shared; the few pre-instantiated extractors get fresh instances
+                    self.add_info_extractor(ie if isinstance(ie, type) else type(ie)())
+
+            def urlopen(self, req):
+                if isinstance(req, str):
+                    req = Request(req)
+                if isinstance(req, Request):
+                    req.extensions.setdefault('cookiejar', self.cookiejar)
+                return super().urlopen(req)
+
+        _pooled_class = PooledYoutubeDL
+    return _pooled_class
+
+
+def warm_up():
+    """
+    Load yt-dlp, its extractor registry and the shared request director.
+    Safe to call more than once; returns the seconds spent (0.0 if already warm).
+    """
+    global _shared_director, _default_ies, _warm_ydl
+    with _lock:
+        if _shared_director is not None:
+            return 0.0
+        start = time.perf_counter()
+        yt_dlp = get_yt_dlp()
+        yt_dlp.extractor.import_extractors()
+        _warm_ydl = yt_dlp.YoutubeDL({**BASE_NETWORK_OPTS, 'quiet': True, 'no_warnings': True})
+        _default_ies = list(_warm_ydl._ies.values())
+        _shared_director = _warm_ydl._request_director
+        return time.perf_counter() - start
+
+
+def is_warm():
+    return _shared_director is not None
+
+
+def shutdown():
+    """Close pooled connections (worker_process_shutdown)."""
+    global _shared_director, _default_ies, _warm_ydl
+    with _lock:
+        if _warm_ydl is not None:
+            _warm_ydl.close()
+        _shared_director = None
+        _default_ies = None
+        _warm_ydl = None
+
+
+def new_youtube_dl(opts, pooled=True):
+    """
+    Build a YoutubeDL for one task or probe. Uses the shared connection pool when
+    this process has been warmed up, otherwise (or with pooled=False, to get away
+    from a stalled connection) a plain YoutubeDL with connections of its own.
+    """
+    if pooled and is_warm():
+        return _get_pooled_class()({**BASE_NETWORK_OPTS, **opts})
+    return get_yt_dlp().YoutubeDL({**BASE_NETWORK_OPTS, **opts})